@@ -0,0 +1,188 @@
+// ✅ 分桶儲存：每位使用者每天一個（或幾個）文件，裡面是精簡過的對話陣列
+// 一般訊息一則一個文件、一半欄位是空字串；分桶之後讀最近 N 則通常只要讀一個文件，索引也只剩一個
+const mongoose = require('mongoose');
+
+const BUCKET_SIZE = parseInt(process.env.BUCKET_SIZE, 10) || 200;   // 一個桶子最多幾則，滿了同一天再開新的
+const BUCKET_RETRY_BATCH = 50;                                         // 重送佇列一次處理幾筆
+const EXPORT_SETTLE_MS = parseInt(process.env.EXPORT_SETTLE_MS, 10) || 60000;  // 寫入時間晚於「現在 - 這麼久」的先不匯出
+
+// 精簡格式：空的欄位不存，message_type 是 "text" 也不存
+const turnSchema = new mongoose.Schema({
+    q: String,                        // message_text
+    a: String,                        // bot_response
+    k: String,                        // message_type
+    at: { type: Date, required: true },
+    w: Date                           // 寫進桶子的時間（匯出游標用；at 是客戶端給的，補送時會比較舊）
+}, { _id: false });
+
+const messageBucketSchema = new mongoose.Schema({
+    user_id: { type: String, required: true },
+    day: { type: String, required: true },    // UTC 日期 YYYY-MM-DD
+    start: Date,                              // 桶內最早、最晚一則的時間
+    end: Date,
+    count: { type: Number, default: 0 },
+    updated: Date,                            // 最後一次寫入的時間
+    migrated: Boolean,                        // 搬遷腳本寫入的桶子，重跑時整批換掉，線上寫入不會接到這裡
+    turns: [turnSchema]
+}, { versionKey: false });
+// 唯一的索引：依使用者取最新的桶子
+messageBucketSchema.index({ user_id: 1, end: -1 });
+const MessageBucket = mongoose.model("MessageBucket", messageBucketSchema);
+
+// dual 模式分桶寫失敗的訊息先放這裡，背景定時重送（搬遷腳本結束前也會清空）
+const bucketRetrySchema = new mongoose.Schema({
+    docs: { type: [mongoose.Schema.Types.Mixed], required: true },
+    created_at: { type: Date, default: Date.now }
+}, { versionKey: false });
+const BucketRetry = mongoose.model("BucketRetry", bucketRetrySchema);
+
+const bucketDay = (date) => date.toISOString().slice(0, 10);
+
+const toTurn = (m, writtenAt) => {
+    const turn = { at: m.timestamp, w: writtenAt };
+    if (m.message_text) turn.q = m.message_text;
+    if (m.bot_response) turn.a = m.bot_response;
+    if (m.message_type && m.message_type !== "text") turn.k = m.message_type;
+    return turn;
+};
+
+const fromTurn = (turn) => ({
+    message_text: turn.q || "",
+    bot_response: turn.a || "",
+    message_type: turn.k || "text",
+    timestamp: turn.at
+});
+
+// 依 (使用者, 日期) 分組、保持原本順序，每組最多 BUCKET_SIZE 則
+const groupTurns = (docs, writtenAt = new Date()) => {
+    const groups = [];
+    const open = new Map();
+    for (const doc of docs) {
+        const key = `${doc.user_id}\u0000${bucketDay(doc.timestamp)}`;
+        let group = open.get(key);
+        if (!group || group.turns.length >= BUCKET_SIZE) {
+            group = { user_id: doc.user_id, day: bucketDay(doc.timestamp), turns: [], docs: [] };
+            open.set(key, group);
+            groups.push(group);
+        }
+        group.turns.push(toTurn(doc, writtenAt));
+        group.docs.push(doc);
+    }
+    return groups;
+};
+
+// ✅ 寫入：每組一個 upsert，接到當天還放得下的桶子，沒有就開新桶（整批一次 bulkWrite）
+// 失敗時 err.unwritten 是還沒寫進去的訊息（ordered 寫入，錯誤之前的組已經寫好了）
+const appendToBuckets = async (docs) => {
+    const writtenAt = new Date();
+    const groups = groupTurns(docs, writtenAt);
+    const ops = groups.map(({ user_id, day, turns }) => {
+        const times = turns.map(t => t.at.getTime());
+        return {
+            updateOne: {
+                filter: { user_id, day, count: { $lte: BUCKET_SIZE - turns.length }, migrated: { $exists: false } },
+                update: {
+                    $push: { turns: { $each: turns } },
+                    $inc: { count: turns.length },
+                    $min: { start: new Date(Math.min(...times)) },
+                    $max: { end: new Date(Math.max(...times)), updated: writtenAt }
+                },
+                upsert: true
+            }
+        };
+    });
+    if (ops.length) {
+        try {
+            // ordered: true → 同一位使用者的前一組先寫完，下一組才看得到桶子滿了沒
+            await MessageBucket.bulkWrite(ops, { ordered: true });
+        } catch (err) {
+            // 有 writeErrors 就知道從哪一組開始沒寫進去；連線錯誤之類的不知道，整批都算
+            const failedAt = err.writeErrors && err.writeErrors.length ? err.writeErrors[0].index : 0;
+            err.unwritten = groups.slice(failedAt).flatMap(group => group.docs);
+            throw err;
+        }
+    }
+    return ops.length;
+};
+
+// ✅ 重送佇列
+const queueBucketRetry = async (docs) => {
+    await BucketRetry.create({ docs });
+};
+
+// 依放進去的順序重送，成功一筆刪一筆；回傳重送成功的筆數
+const drainBucketRetries = async (limit = BUCKET_RETRY_BATCH) => {
+    const entries = await BucketRetry.find().sort({ _id: 1 }).limit(limit).lean();
+    let drained = 0;
+    for (const entry of entries) {
+        const docs = entry.docs.map(doc => ({ ...doc, timestamp: new Date(doc.timestamp) }));
+        try {
+            await appendToBuckets(docs);
+        } catch (err) {
+            if (err.unwritten && err.unwritten.length < docs.length) {
+                await BucketRetry.updateOne({ _id: entry._id }, { $set: { docs: err.unwritten } });
+            }
+            throw err;
+        }
+        await BucketRetry.deleteOne({ _id: entry._id });
+        drained += 1;
+    }
+    return drained;
+};
+
+// 同一個時間可能有好幾則，翻頁要用 (時間, 桶子 _id, 桶內第幾則) 排序才不會漏或重複
+// cursor 是 { at, tie }，tie 是「桶子 _id.桶內第幾則」；沒有 tie 就只比時間
+const compareTurns = (x, y) => (x.at - y.at) || (x.b < y.b ? -1 : x.b > y.b ? 1 : x.i - y.i);
+const cursorTurn = ({ at, tie }) => {
+    const [b, i] = tie.split(".");
+    return { at, b, i: Number(i) };
+};
+const afterCursor = (turn, cursor) => cursor.tie ? compareTurns(turn, cursorTurn(cursor)) > 0 : turn.at > cursor.at;
+const beforeCursor = (turn, cursor) => cursor.tie ? compareTurns(turn, cursorTurn(cursor)) < 0 : turn.at < cursor.at;
+
+// ✅ 讀取：照 end 由新到舊一個一個桶子拿，湊滿 limit 則、而且下一個桶子不可能有更新的就停
+// since 模式反過來由舊到新；回傳的每一則多一個 _id（「桶子 _id.桶內第幾則」）給呼叫端組翻頁游標
+const readBucketHistory = async (user_id, { since, before, limit }) => {
+    const filter = { user_id };
+    if (before) filter.start = { $lte: before.at };
+    if (since) filter.end = { $gte: since.at };
+    const forward = Boolean(since && !before);
+    const inRange = (turn) => (!since || afterCursor(turn, since)) && (!before || beforeCursor(turn, before));
+    const order = forward ? compareTurns : (x, y) => compareTurns(y, x);
+
+    // 桶子很大，一次只跟資料庫拿兩個
+    const cursor = MessageBucket.find(filter, "_id start end turns")
+        .sort({ end: forward ? 1 : -1 })
+        .lean()
+        .cursor({ batchSize: 2 });
+    let picked = [];
+    try {
+        for await (const bucket of cursor) {
+            if (picked.length >= limit) {
+                const edge = picked[limit - 1].at;
+                if (forward ? bucket.start > edge : bucket.end < edge) break;
+            }
+            const b = String(bucket._id);
+            const turns = bucket.turns.map((turn, i) => ({ ...turn, b, i }));
+            picked = picked.concat(turns.filter(inRange)).sort(order);
+        }
+    } finally {
+        await cursor.close();
+    }
+    picked = picked.slice(0, limit);
+    if (!forward) picked.reverse();
+    return picked.map(turn => ({ _id: `${turn.b}.${turn.i}`, ...fromTurn(turn) }));
+};
+
+module.exports = {
+    BUCKET_SIZE,
+    EXPORT_SETTLE_MS,
+    MessageBucket,
+    appendToBuckets,
+    bucketDay,
+    drainBucketRetries,
+    fromTurn,
+    groupTurns,
+    queueBucketRetry,
+    readBucketHistory
+};
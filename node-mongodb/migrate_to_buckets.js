@@ -0,0 +1,108 @@
+// ✅ 把原本一則一個文件的 messages 搬進分桶格式（MessageBucket）
+// 用法：node migrate_to_buckets.js [--before 2024-05-01T00:00:00Z] [--batch 5000]
+//
+// 建議流程：伺服器先切 STORAGE_LAYOUT=dual（新訊息兩邊都寫），記下切換的時間當 --before，
+// 跑完這支腳本確認筆數後再切 STORAGE_LAYOUT=bucket。
+// 每位使用者搬之前會先刪掉自己上次搬的桶子（migrated: true），所以中斷了直接重跑就好；
+// dual 模式線上寫入的桶子不會被動到。dual 模式分桶寫失敗的訊息在重送佇列裡（伺服器會定時重送），
+// 腳本最後也會把佇列清空，切 bucket 之前確認佇列是空的就不會漏。
+require('dotenv').config();
+const mongoose = require('mongoose');
+const { MessageBucket, drainBucketRetries, groupTurns } = require('./buckets');
+
+const args = process.argv.slice(2);
+const option = (name, fallback) => {
+    const i = args.indexOf(`--${name}`);
+    return i >= 0 && args[i + 1] ? args[i + 1] : fallback;
+};
+const BEFORE = new Date(option("before", new Date().toISOString()));
+const BATCH = parseInt(option("batch", "5000"), 10);   // 累積多少則訊息寫一次
+
+if (isNaN(BEFORE)) {
+    console.error("❌ --before 格式錯誤");
+    process.exit(1);
+}
+
+const indexBytes = async (name) => {
+    try {
+        const stats = await mongoose.connection.db.command({ collStats: name });
+        return stats.totalIndexSize;
+    } catch (err) {
+        return null;
+    }
+};
+
+const migrate = async () => {
+    await mongoose.connect(process.env.MONGO_URI);
+    await MessageBucket.createIndexes();
+    console.log(`🔄 搬移 ${BEFORE.toISOString()} 以前的訊息...`);
+
+    // 排序剛好是 (user_id, timestamp) 索引倒著走，不用在記憶體排序
+    const cursor = mongoose.connection.collection("messages")
+        .find({ timestamp: { $lt: BEFORE } },
+              { projection: { _id: 0, user_id: 1, message_text: 1, bot_response: 1, message_type: 1, timestamp: 1 } })
+        .sort({ user_id: -1, timestamp: 1 })
+        .batchSize(1000);
+
+    let currentUser = null;
+    let pending = [];
+    let messages = 0, buckets = 0, users = 0;
+
+    const flush = async () => {
+        if (!pending.length) return;
+        const writtenAt = new Date();
+        const docs = groupTurns(pending, writtenAt).map(({ user_id, day, turns }) => {
+            const times = turns.map(t => t.at.getTime());
+            return {
+                user_id,
+                day,
+                turns,
+                start: new Date(Math.min(...times)),
+                end: new Date(Math.max(...times)),
+                count: turns.length,
+                updated: writtenAt,
+                migrated: true
+            };
+        });
+        await MessageBucket.insertMany(docs, { ordered: false });
+        buckets += docs.length;
+        pending = [];
+    };
+
+    for await (const doc of cursor) {
+        if (!doc.user_id || !(doc.message_text || doc.bot_response)) continue;
+        if (doc.user_id !== currentUser) {
+            currentUser = doc.user_id;
+            users += 1;
+            await MessageBucket.deleteMany({ user_id: currentUser, migrated: true });
+        }
+        pending.push({ ...doc, timestamp: doc.timestamp || BEFORE });
+        if (pending.length >= BATCH) {
+            // 分批寫入：切在使用者中間的話，那天會多一個沒滿的桶子，不影響讀取
+            await flush();
+        }
+        messages += 1;
+        if (messages % 10000 === 0) {
+            console.log(`📦 已處理 ${messages} 則（${users} 位使用者，${buckets} 個桶子）`);
+        }
+    }
+    await flush();
+
+    let retried = 0;
+    for (let drained; (drained = await drainBucketRetries()) > 0;) {
+        retried += drained;
+    }
+
+    console.log(`✅ 搬移完成：${messages} 則 → ${buckets} 個桶子（${users} 位使用者），重送佇列補了 ${retried} 批`);
+    const [flatIndex, bucketIndex] = await Promise.all([indexBytes("messages"), indexBytes("messagebuckets")]);
+    if (flatIndex !== null && bucketIndex !== null) {
+        console.log(`📏 索引大小：messages ${flatIndex} bytes，messagebuckets ${bucketIndex} bytes`);
+    }
+};
+
+migrate()
+    .catch(err => {
+        console.error("❌ 搬移失敗:", err);
+        process.exitCode = 1;
+    })
+    .finally(() => mongoose.disconnect());
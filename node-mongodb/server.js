@@ -3,6 +3,10 @@ const express = require('express');
 const mongoose = require('mongoose');
 const bodyParser = require('body-parser');
 const axios = require('axios');
+const { once } = require('events');
+const {
+    EXPORT_SETTLE_MS, MessageBucket, appendToBuckets, drainBucketRetries, fromTurn, queueBucketRetry, readBucketHistory
+} = require('./buckets');
 
 const app = express();
 app.use(bodyParser.json());
@@ -31,8 +35,48 @@ const messageSchema = new mongoose.Schema({
     //constructive_contribution: { type: Boolean, default: false }, // ✅ 加這個
     timestamp: { type: Date, default: Date.now }
 });
+// 複合索引：依使用者取最新 N 筆 / 往前翻頁都只需要走索引（_id 是同一時間內的翻頁順序）
+messageSchema.index({ user_id: 1, timestamp: -1, _id: -1 });
 const Message = mongoose.model("Message", messageSchema);
 
+// 儲存格式：flat = 一則一個文件（原本的 messages）；bucket = 分桶（見 buckets.js）
+// dual = 兩邊都寫、照舊讀 flat，搬遷期間用：先切 dual，再跑 migrate_to_buckets.js，最後切 bucket
+const STORAGE_LAYOUT = process.env.STORAGE_LAYOUT || "flat";
+if (!["flat", "bucket", "dual"].includes(STORAGE_LAYOUT)) {
+    throw new Error(`STORAGE_LAYOUT 只能是 flat / bucket / dual：${STORAGE_LAYOUT}`);
+}
+
+// 依儲存格式寫入，回傳存進去的筆數；dual 模式以 flat 為準，分桶沒寫進去的放進重送佇列
+// （搬遷腳本只搬 --before 以前的訊息，切換之後寫失敗的要靠佇列補）
+const BUCKET_RETRY_INTERVAL = parseInt(process.env.BUCKET_RETRY_INTERVAL, 10) || 60000;
+
+const storeMessages = async (docs) => {
+    if (STORAGE_LAYOUT === "bucket") {
+        await appendToBuckets(docs);
+        return docs.length;
+    }
+    // ordered: false → 單筆失敗不會擋住其他筆
+    const inserted = await Message.insertMany(docs, { ordered: false });
+    if (STORAGE_LAYOUT === "dual") {
+        try {
+            await appendToBuckets(docs);
+        } catch (err) {
+            console.error("❌ 分桶寫入失敗（dual 模式，flat 已存入），放進重送佇列:", err);
+            try {
+                await queueBucketRetry(err.unwritten || docs);
+            } catch (queueErr) {
+                console.error("❌ 分桶重送佇列寫入失敗:", queueErr);
+            }
+        }
+    }
+    return inserted.length;
+};
+
+// Python 端只會讀這些欄位（_id 只拿來組翻頁游標，回應前會拿掉）
+const HISTORY_FIELDS = "_id message_text bot_response message_type timestamp";
+const HISTORY_DEFAULT_LIMIT = 20;
+const HISTORY_MAX_LIMIT = 100;
+
 // ✅ 儲存訊息 API
 app.post("/save_message", async (req, res) => {
     const { user_id, message_text, message_type, bot_response, interaction_rounds, constructive_contribution } = req.body;
@@ -43,15 +87,15 @@ app.post("/save_message", async (req, res) => {
     }
 
     try {
-        const message = new Message({
+        await storeMessages([{
             user_id,
-            message_text,
-            bot_response,
-            message_type
+            message_text: message_text || "",
+            bot_response: bot_response || "",
+            message_type,
             //interaction_rounds: interaction_rounds || 0, // 🔥 預設0
             //constructive_contribution: constructive_contribution || false // 🔥 預設false
-        });
-        await message.save();
+            timestamp: new Date()
+        }]);
         console.log("✅ 成功存入 MongoDB");
         res.json({ status: "success", message: "Message saved" });
     } catch (err) {
@@ -60,14 +104,120 @@ app.post("/save_message", async (req, res) => {
     }
 });
 
+// ✅ 批次儲存訊息 API（Python 端會累積多筆後一次送出）
+app.post("/save_messages", async (req, res) => {
+    const { messages } = req.body;
+    if (!Array.isArray(messages) || messages.length === 0) {
+        return res.status(400).json({ error: "Invalid data" });
+    }
+
+    const docs = messages
+        .filter(m => m && m.user_id && (m.message_text || m.bot_response))
+        .map(m => ({
+            user_id: m.user_id,
+            message_text: m.message_text || "",
+            bot_response: m.bot_response || "",
+            message_type: m.message_type || "text",
+            timestamp: m.timestamp ? new Date(m.timestamp) : new Date()
+        }));
+    const skipped = messages.length - docs.length;
+
+    try {
+        const inserted = docs.length ? await storeMessages(docs) : 0;
+        console.log(`✅ 批次存入 MongoDB：${inserted} 筆（略過 ${skipped} 筆）`);
+        res.json({ status: "success", inserted, skipped });
+    } catch (err) {
+        console.error("❌ MongoDB 批次存入錯誤:", err);
+        res.status(500).json({ error: "Database error" });
+    }
+});
+
 // ✅ 定義新的資料表
 const userStatsSchema = new mongoose.Schema({
     user_id: { type: String, required: true, unique: true },
     interaction_rounds: { type: Number, default: 0 },
-    constructive_count: { type: Number, default: 0 }
+    constructive_count: { type: Number, default: 0 },
+    // 各模式的訊息數，例如 { passive: 3, active: 12 }
+    mode_rounds: { type: Map, of: Number, default: {} },
+    // 最近套用過的批次（Python 端逾時重送同一批時用來略過）
+    applied_batches: { type: [String], default: undefined, select: false }
 });
 const UserStats = mongoose.model("UserStats", userStatsSchema);
 
+// ✅ 批次累加用戶統計（Python 端先在記憶體累積，定時一次送來）
+// body: { batch_id, updates: [{ user_id, inc: { interaction_rounds: 2, constructive_count: 1, "mode_rounds.active": 3 } }] }
+// 同一個 batch_id 對同一位使用者只會加一次（每位使用者記最近 USER_STATS_BATCH_HISTORY 個）
+const USER_STATS_FIELDS = /^(interaction_rounds|constructive_count|mode_rounds\.[a-z_]+)$/;
+const USER_STATS_MAX_UPDATES = 5000;
+const USER_STATS_BATCH_HISTORY = 50;
+
+app.post("/update_user_stats_bulk", async (req, res) => {
+    const { updates, batch_id } = req.body;
+    if (!Array.isArray(updates) || updates.length === 0 || updates.length > USER_STATS_MAX_UPDATES) {
+        return res.status(400).json({ error: "Invalid data" });
+    }
+    if (batch_id !== undefined && (typeof batch_id !== "string" || !batch_id || batch_id.length > 64)) {
+        return res.status(400).json({ error: "Invalid batch_id" });
+    }
+
+    const ops = [];
+    for (const u of updates) {
+        if (!u || !u.user_id || !u.inc || typeof u.inc !== "object") continue;
+        const inc = {};
+        for (const [field, value] of Object.entries(u.inc)) {
+            if (USER_STATS_FIELDS.test(field) && Number.isInteger(value) && value !== 0) {
+                inc[field] = value;
+            }
+        }
+        if (!Object.keys(inc).length) continue;
+        if (batch_id) {
+            ops.push({ updateOne: {
+                filter: { user_id: u.user_id, applied_batches: { $ne: batch_id } },
+                update: { $inc: inc, $push: { applied_batches: { $each: [batch_id], $slice: -USER_STATS_BATCH_HISTORY } } },
+                upsert: true
+            } });
+        } else {
+            ops.push({ updateOne: { filter: { user_id: u.user_id }, update: { $inc: inc }, upsert: true } });
+        }
+    }
+    const skipped = updates.length - ops.length;
+    if (!ops.length) {
+        return res.json({ status: "success", applied: 0, skipped });
+    }
+
+    try {
+        // ordered: false → 單筆失敗不會擋住其他筆
+        let result;
+        let duplicates = 0;
+        try {
+            result = await UserStats.bulkWrite(ops, { ordered: false });
+        } catch (err) {
+            // 帶 batch_id 時 filter 對不到已套用過這批的文件，upsert 會撞 user_id 唯一索引（11000）；
+            // 真的套用過就算重複，否則是兩個請求同時新增同一位使用者，文件已經有了，不用 upsert 再送一次
+            const writeErrors = err.writeErrors || [];
+            if (!batch_id || !writeErrors.length || writeErrors.some((e) => e.code !== 11000)) throw err;
+            for (const e of writeErrors) {
+                const { filter, update } = ops[e.index].updateOne;
+                const retried = await UserStats.updateOne(filter, update);
+                if (retried.matchedCount === 0) duplicates += 1;
+            }
+            result = err.result;
+        }
+        console.log(`✅ 批次更新用戶統計：${ops.length - duplicates} 位（略過 ${skipped} 筆，重複 ${duplicates} 筆）`);
+        res.json({
+            status: "success",
+            applied: ops.length - duplicates,
+            skipped,
+            duplicates,
+            matched: result.matchedCount,
+            upserted: result.upsertedCount
+        });
+    } catch (err) {
+        console.error("❌ 批次更新用戶統計失敗:", err);
+        res.status(500).json({ error: "Database error" });
+    }
+});
+
 // ✅ 每次互動時更新互動次數
 app.post("/update_user_stats", async (req, res) => {
     const { user_id, constructive } = req.body;
@@ -93,39 +243,189 @@ app.post("/update_user_stats", async (req, res) => {
 });
 
 // ✅ 取得歷史訊息 API
+// 預設回傳「最新 N 筆」（依時間由舊到新排列）；
+// before=<游標> 往更舊的翻頁，since=<游標> 只取比它新的訊息
+// 游標是「時間|同一時間內的排序鍵」（flat 是 _id，bucket 是「桶子 _id.桶內第幾則」），
+// 同一個時間有好幾則時才不會在頁與頁之間漏掉；只給時間也可以，就是單純比時間
+const parseHistoryCursor = (value) => {
+    const sep = value.lastIndexOf("|");
+    const at = new Date(sep >= 0 ? value.slice(0, sep) : value);
+    const tie = sep >= 0 ? value.slice(sep + 1) : null;
+    const tiePattern = STORAGE_LAYOUT === "bucket" ? /^[0-9a-f]{24}\.\d+$/ : /^[0-9a-f]{24}$/;
+    if (isNaN(at) || (tie !== null && !tiePattern.test(tie))) return null;
+    return { at, tie };
+};
+
+// flat 的 (timestamp, _id) 範圍條件；op 是 $lt 或 $gt
+const flatBound = (op, { at, tie }) => tie
+    ? { $or: [{ timestamp: { [op]: at } }, { timestamp: at, _id: { [op]: new mongoose.Types.ObjectId(tie) } }] }
+    : { timestamp: { [op]: at } };
+
+const historyCursor = (m) => `${m.timestamp.toISOString()}|${m._id}`;
+
 app.get("/get_history", async (req, res) => {
     const { user_id } = req.query;
     if (!user_id) {
         return res.status(400).json({ error: "缺少 user_id" });
     }
 
+    // 0 或負數也當作至少一筆，不然 Mongo 的 limit(負數) 會變成別的意思
+    const limit = Math.max(1, Math.min(parseInt(req.query.limit, 10) || HISTORY_DEFAULT_LIMIT, HISTORY_MAX_LIMIT));
+    const since = req.query.since ? parseHistoryCursor(req.query.since) : undefined;
+    const before = req.query.before ? parseHistoryCursor(req.query.before) : undefined;
+    if (since === null || before === null) {
+        return res.status(400).json({ error: "since/before 格式錯誤" });
+    }
+    const filter = { user_id };
+    const bounds = [since && flatBound("$gt", since), before && flatBound("$lt", before)].filter(Boolean);
+    if (bounds.length) filter.$and = bounds;
+
     try {
-        const messages = await Message.find({ user_id }).sort({ timestamp: 1 }).limit(20);
-        res.json({ messages });
+        let messages;
+        if (STORAGE_LAYOUT === "bucket") {
+            messages = await readBucketHistory(user_id, { since, before, limit });
+        } else if (since && !before) {
+            // 往後追：從 since 之後最舊的開始
+            messages = await Message.find(filter, HISTORY_FIELDS)
+                .sort({ timestamp: 1, _id: 1 })
+                .limit(limit)
+                .lean();
+        } else {
+            // 取尾端：索引倒序掃 limit 筆，再翻回時間順序
+            messages = (await Message.find(filter, HISTORY_FIELDS)
+                .sort({ timestamp: -1, _id: -1 })
+                .limit(limit)
+                .lean()).reverse();
+        }
+
+        const oldest = messages.length ? historyCursor(messages[0]) : null;
+        const newest = messages.length ? historyCursor(messages[messages.length - 1]) : null;
+        res.json({
+            messages: messages.map(({ _id, ...m }) => m),
+            next_before: messages.length === limit ? oldest : null,
+            next_since: newest || req.query.since || null
+        });
     } catch (err) {
         console.error("❌ 取得對話紀錄錯誤:", err);
         res.status(500).json({ error: "伺服器錯誤" });
     }
 });
 
+// ✅ 匯出訊息 API（給微調資料匯出用）
+// 依 _id 由舊到新，after=<上一頁最後一筆的 _id> 往後翻；回應是 NDJSON（一行一筆），用 cursor 邊讀邊寫
+// 有設 EXPORT_TOKEN 時要帶 X-Export-Token
+// bucket 模式的桶子會一直被接著寫、補送的訊息也可能落在舊的桶子，所以游標改用寫入時間：
+// 一輪只匯出寫入時間落在 (W, H] 的訊息，H 是這輪開始時的「現在 - EXPORT_SETTLE_MS」，
+// 這一輪照桶子 _id、桶內順序走完，下一輪從 W = H 開始。_id 是「W:H:桶子 _id:桶內第幾則」
+const EXPORT_FIELDS = "_id user_id message_text bot_response message_type timestamp";
+const EXPORT_DEFAULT_LIMIT = 1000;
+const EXPORT_MAX_LIMIT = 10000;
+
+const parseExportCursor = (after, bucketed) => {
+    if (!after) {
+        return bucketed ? { low: 0, high: Date.now() - EXPORT_SETTLE_MS } : {};
+    }
+    const parts = after.split(":");
+    if (!bucketed) {
+        return parts.length === 1 && mongoose.Types.ObjectId.isValid(after) ? { id: after } : null;
+    }
+    const [low, high, id, index] = parts;
+    if (parts.length !== 4 || ![low, high, index].every(p => /^\d+$/.test(p)) || !mongoose.Types.ObjectId.isValid(id)) {
+        return null;
+    }
+    return { low: Number(low), high: Number(high), id, index: Number(index) };
+};
+
+// 一輪之內的訊息；桶子很大，一次只跟資料庫拿 20 個
+async function* bucketSweep({ low, high, id, index }) {
+    const filter = { updated: { $gt: new Date(low) } };
+    if (id) filter._id = { $gte: new mongoose.Types.ObjectId(id) };
+    const cursor = MessageBucket.find(filter, "_id user_id turns").sort({ _id: 1 }).lean().cursor({ batchSize: 20 });
+    try {
+        for await (const bucket of cursor) {
+            const skip = id && bucket._id.equals(id) ? index + 1 : 0;
+            for (let i = skip; i < bucket.turns.length; i++) {
+                const turn = bucket.turns[i];
+                // 加上 w 欄位之前寫的訊息沒有寫入時間，用對話時間代替
+                const written = (turn.w || turn.at).getTime();
+                if (written > low && written <= high) {
+                    yield { _id: `${low}:${high}:${bucket._id}:${i}`, user_id: bucket.user_id, ...fromTurn(turn) };
+                }
+            }
+        }
+    } finally {
+        await cursor.close();
+    }
+}
+
+async function* bucketExportRows(position) {
+    let sweep = position;
+    for (;;) {
+        yield* bucketSweep(sweep);
+        // 這一輪走完了，接著匯出這輪開始之後寫進來的；還沒有新的可以匯就停
+        const high = Date.now() - EXPORT_SETTLE_MS;
+        if (high <= sweep.high) return;
+        sweep = { low: sweep.high, high };
+    }
+}
+
+app.get("/export_messages", async (req, res) => {
+    if (process.env.EXPORT_TOKEN && req.get("X-Export-Token") !== process.env.EXPORT_TOKEN) {
+        return res.status(403).json({ error: "Forbidden" });
+    }
+    const bucketed = STORAGE_LAYOUT === "bucket";
+    const position = parseExportCursor(req.query.after, bucketed);
+    if (!position) {
+        return res.status(400).json({ error: "after 格式錯誤" });
+    }
+    const limit = Math.min(parseInt(req.query.limit, 10) || EXPORT_DEFAULT_LIMIT, EXPORT_MAX_LIMIT);
+
+    res.set("Content-Type", "application/x-ndjson; charset=utf-8");
+    const rows = bucketed
+        ? bucketExportRows(position)
+        : Message.find(position.id ? { _id: { $gt: new mongoose.Types.ObjectId(position.id) } } : {}, EXPORT_FIELDS)
+            .sort({ _id: 1 }).limit(limit).lean().cursor();
+    try {
+        let written = 0;
+        for await (const row of rows) {
+            // 對方讀得慢就等 drain，不在記憶體裡堆資料
+            if (!res.write(JSON.stringify(row) + "\n")) {
+                await once(res, "drain");
+            }
+            if (++written >= limit) break;
+        }
+        res.end();
+    } catch (err) {
+        console.error("❌ 匯出訊息錯誤:", err);
+        // 已經開始送資料了，只能中斷連線讓客戶端重試這一頁
+        res.destroy(err);
+    } finally {
+        await (bucketed ? rows.return() : rows.close());
+    }
+});
+
+
 
+// ✅ 每日挑戰 API（整批交給 Python 端：同等級同天數只出一題，用 multicast 群發）
+const PYTHON_SERVER_URL = process.env.PYTHON_SERVER_URL || "https://你的-python-server.onrender.com";
 
-// ✅ 每日挑戰 API
 app.post("/daily_challenge", async (req, res) => {
-    for (const user of users) {
-        try {
-            await axios.post("https://你的-python-server.onrender.com/send_daily_challenge", {
+    try {
+        const { data } = await axios.post(`${PYTHON_SERVER_URL}/send_daily_challenges`, {
+            users: users.map(user => ({
                 user_id: user.user_id,
                 user_level: user.level,
                 day_count: user.day
-            });
-            console.log(`✅ 傳送給 ${user.user_id} 成功`);
-        } catch (err) {
-            console.error(`❌ 傳送給 ${user.user_id} 失敗:`, err.message);
+            }))
+        }, { timeout: 120000 });
+        for (const group of data.groups || []) {
+            console.log(`✅ ${group.user_level} Day${group.day_count}：送出 ${group.sent} 人，失敗 ${group.failed} 人`);
         }
+        res.json({ status: "success", sent: data.sent, failed: data.failed, groups: data.groups });
+    } catch (err) {
+        console.error("❌ 每日挑戰批次傳送失敗:", err.message);
+        res.status(502).json({ error: "每日挑戰傳送失敗" });
     }
-
-    res.send("✅ 所有挑戰題已傳送");
 });
 
 // ✅ 啟動伺服器（等 MongoDB 成功才開始接請求）
@@ -151,6 +451,18 @@ const startServer = async () => {
                 console.error("❌ MongoDB ping 失敗:", err);
             }
         }, 300000);
+
+        if (STORAGE_LAYOUT !== "flat") {
+            // 定時把 dual 模式寫失敗的分桶訊息補進去
+            setInterval(async () => {
+                try {
+                    const drained = await drainBucketRetries();
+                    if (drained) console.log(`✅ 分桶重送 ${drained} 批`);
+                } catch (err) {
+                    console.error("❌ 分桶重送失敗:", err);
+                }
+            }, BUCKET_RETRY_INTERVAL);
+        }
     } catch (err) {
         console.error("❌ MongoDB 連線失敗，無法啟動伺服器:", err);
         process.exit(1);
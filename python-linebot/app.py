@@ -1,6 +1,6 @@
 # =============== 基本套件與初始化 ===============
-from flask import Flask, request, abort, jsonify
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, Response, request, abort, jsonify
+from linebot import LineBotApi, WebhookParser
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import *
 
@@ -8,24 +8,59 @@ from handlers.active import handle_active_mode
 from handlers.interactive import handle_interactive_mode
 from handlers.constructive import handle_constructive_mode
 from handlers.passive import handle_passive_mode
+from handlers.grading import handle_code_submission
 
+import atexit
 import os
 import openai
 import re
-import requests
 import time
-import threading
+import llm_gateway
+import persistence
+import history_cache
+import question_pool
+import state_store
+import user_stats
+import context_builder
+import event_dedup
+import grader
+import keyed_executor
+import metrics
+import model_router
+import node_health
+import outbox
+import reply_deadline
+import response_cache
+import worker_pool
+from persistence import save_message
+from modes import MODE_MAP, MODE_DESCRIPTIONS, switch_reply_text, first_question_state
+from daily_challenge import format_daily_challenge, group_recipients, chunks
 
 # =============== 系統初始化 ===============
 app = Flask(__name__)
-line_bot_api = LineBotApi(os.getenv('CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.getenv('CHANNEL_SECRET'))
+line_bot_api = LineBotApi(os.getenv('CHANNEL_ACCESS_TOKEN'), endpoint=os.getenv('LINE_API_ENDPOINT', 'https://api.line.me'))
+parser = WebhookParser(os.getenv('CHANNEL_SECRET'))
 openai.api_key = os.getenv('OPENAI_API_KEY')
-NODE_SERVER_URL = "https://node-mongo-b008.onrender.com"
+
+# LINE API 呼叫計時（背景工作裡的 push 也會標上當下的 mode）
+metrics.instrument(line_bot_api, ["reply_message", "push_message", "multicast"], prefix="line:")
+
+# push 一律走出件匣：同一位使用者短時間內的訊息合併成一次 push，並控制送出速度
+push_outbox = outbox.Outbox(line_bot_api)
+line_bot_api = outbox.OutboxLineBotApi(line_bot_api, push_outbox)
+atexit.register(push_outbox.flush)
+
+# Node 健康探測：開機先把連線暖好（順便叫醒睡著的 Render），之後定時探測、恢復時補送落地檔
+node_health.monitor.start()
+
+# 題庫預熱：開機後在背景把各難度的題目準備好（多個 worker 只有一個會做）
+if question_pool.QUESTION_POOL_WARMUP:
+    question_pool.pool.warm_up_later()
 
 # =============== 使用者狀態管理 ===============
-user_mode = {}
-user_state = {}  # user_id: { "mode": "active", "last_question": "...", "awaiting_answer": True }
+# 依 STATE_STORE_URL 決定放在記憶體或 SQLite（多個 gunicorn worker 共用）
+user_mode = state_store.make_store("mode")
+user_state = state_store.make_store("state")  # user_id: { "mode": "active", "last_question": "...", "awaiting_answer": True }
 
 # =============== GPT回覆推送（背景處理用） ===============
 def gpt_push_response(context, user_id, user_text, system_prompt, history_messages=None):
@@ -34,23 +69,10 @@ def gpt_push_response(context, user_id, user_text, system_prompt, history_messag
         user_prompt = "\n".join([msg["content"] for msg in history_messages] + [user_text])
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-        )
-        reply_text = response["choices"][0]["message"]["content"].strip()
+        reply_text = llm_gateway.ask(system_prompt, user_prompt, context=context)
         line_bot_api.push_message(user_id, TextSendMessage(text=reply_text))
 
-        requests.post(f"{NODE_SERVER_URL}/save_message", json={
-            "user_id": user_id,
-            "message_text": "",
-            "bot_response": reply_text,
-            "message_type": "bot",
-            #"interaction_rounds": interaction_rounds  # ✅ 新增這個
-        }, timeout=10)
+        save_message(user_id, bot_response=reply_text, message_type="bot")
 
     except Exception as e:
         print(f"❌ GPT 回覆失敗：{e}")
@@ -72,33 +94,28 @@ def gpt_with_typing(context, user_id, reply_token, system_prompt, user_prompt):
     wait_msg = get_waiting_message(context)
     line_bot_api.reply_message(reply_token, TextSendMessage(text=wait_msg))
 
-    response = openai.ChatCompletion.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    reply_text = response["choices"][0]["message"]["content"].strip()
+    reply_text = llm_gateway.ask(system_prompt, user_prompt, context=context)
     line_bot_api.push_message(user_id, TextSendMessage(text=reply_text))
     return reply_text
 
 # =============== 歷史紀錄讀取（從 MongoDB） ===============
-def load_history(user_id, retries=3, delay=3):
-    url = f"{NODE_SERVER_URL}/get_history"
-    for attempt in range(retries):
-        try:
-            response = requests.get(url, params={"user_id": user_id, "limit": 10}, timeout=30)
-            response.raise_for_status()
-            data = response.json()
-            print(f"✅ 第 {attempt+1} 次嘗試成功取得歷史訊息")
-            return data if "messages" in data else {"messages": []}
-        except requests.exceptions.RequestException as e:
-            print(f"❌ API 讀取失敗 ({attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                time.sleep(delay)
-    print("⚠️ 多次重試後仍失敗，返回空歷史訊息")
-    return {"messages": []}
+def load_history(user_id):
+    """對沖讀取最近 10 則；Node 掛掉或斷路器開著時丟 NodeUnavailable，不再重試卡住回覆"""
+    data = node_health.monitor.get_json("/get_history", {"user_id": user_id, "limit": 10})
+    return data if "messages" in data else {"messages": []}
+
+# 需要對話上下文的模式（其他模式完全不讀歷史）
+MODES_WITH_HISTORY = {"interactive"}
+
+def load_cached_history(user_id):
+    """先查本地對話快取，沒命中才呼叫 load_history 從 Node 補；Node 不能用就拿快取裡現有的（降級模式）"""
+    try:
+        messages = history_cache.cache.get(user_id, lambda uid: load_history(uid).get("messages", []))
+    except node_health.NodeUnavailable as e:
+        print(f"⚠️ {e}，改用本地快取的對話")
+        metrics.errors_total.inc(mode=metrics.current_mode(), stage="load_history", type="NodeUnavailable")
+        messages = history_cache.cache.stale(user_id)
+    return {"messages": messages}
 
 # =============== LINE Webhook Endpoint ===============
 @app.route("/callback", methods=['POST'])
@@ -108,28 +125,45 @@ def callback():
         abort(403)
 
     body = request.get_data(as_text=True)
-    print("📥 收到 LINE Webhook:", body)
 
+    # 驗簽 + 解析只做一次，後面都用這份事件物件
     try:
-        handler.handle(body, signature)
+        with metrics.stage("verify_parse", mode="webhook"):
+            events = parser.parse(body, signature)
     except InvalidSignatureError:
         print("❌ LINE 簽名驗證失敗")
         abort(400)
-
-    data = request.get_json(silent=True)
-    if not data or "events" not in data:
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"❌ Webhook 內容格式錯誤: {e}")
         return jsonify({"error": "Invalid data"}), 400
 
-    for event in data["events"]:
-        if event["type"] == "message":
-            message_data = {
-                "user_id": event["source"].get("userId", "Unknown"),
-                "message_text": event["message"].get("text", ""),
-                "message_type": event["message"].get("type", "unknown")
-            }
-            print("📩 LINE 訊息:", message_data)
+    for event in events:
+        # 每個事件重新開始標 mode，避免沿用同一條執行緒上一個請求的
+        with metrics.mode_context(None):
+            dispatch_event(event)
     return 'OK'
 
+
+def dispatch_event(event):
+    """依 (事件類型, 訊息類型) 找處理函式；LINE 重送的同一個事件直接跳過（處理失敗的不算，重送會再處理）"""
+    event_id = getattr(event, "webhook_event_id", None)
+    with event_dedup.handling(event) as fresh:
+        if not fresh:
+            print(f"♻️ 重複的 webhook 事件 {event_id}，略過")
+            metrics.webhook_events_total.inc(type=event.type, result="duplicate")
+            return
+
+        message = getattr(event, "message", None)
+        func = EVENT_HANDLERS.get((type(event), type(message))) or EVENT_HANDLERS.get((type(event), None))
+        user_id = getattr(event.source, "user_id", "Unknown")
+        print(f"📩 LINE 事件: {event.type}/{getattr(message, 'type', '-')} 來自 {user_id}（{event_id}）")
+        if func is None:
+            metrics.webhook_events_total.inc(type=event.type, result="unhandled")
+            return
+        metrics.webhook_events_total.inc(type=event.type, result="handled")
+        with metrics.stage("handle_event"):
+            func(event)
+
 @app.route("/send_daily_challenge", methods=["POST"])
 def send_daily_challenge():
     data = request.get_json()
@@ -140,45 +174,85 @@ def send_daily_challenge():
     if not user_id:
         return jsonify({"error": "缺少 user_id"}), 400
 
-    # ✅ 產生 GPT 題目
+    # ✅ 從題庫取題（題庫空了才會直接呼叫 GPT）
     try:
-        system_prompt = (
-            "你是一位親切、有耐心的 C 語言教練，擅長根據學生程度出一題小挑戰。\n"
-            f"目前學生等級是：{user_level.upper()}。\n"
-            "請出一題不超過 100 字的 C 語言練習題（可以是 if 判斷、迴圈、字串、指標…），用自然中文描述，盡量生活化。\n"
-            "最後加一句鼓勵，例如「你會怎麼做？」或「寫完可以傳給我看看哦 👀」\n"
-            "不需要提供答案。"
-        )
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": "請給我一題每日挑戰題"}
-            ]
-        )
-        challenge_text = response["choices"][0]["message"]["content"].strip()
+        challenge_text = question_pool.next_question("daily", user_level, user_id)
     except Exception as e:
         print(f"❌ GPT 題目生成失敗: {e}")
         return jsonify({"error": "GPT 失敗"}), 500
 
     # ✅ 組合訊息
-    message = (
-        f"【每日挑戰 - {user_level.upper()}】\n"
-        f"#Day{day_count}\n\n"
-        f"{challenge_text}\n\n"
-        "完成後回傳給我，我幫你看看是否正確"
-    )
+    message = format_daily_challenge(user_level, day_count, challenge_text)
 
-    # ✅ 發送到 LINE
+    # ✅ 發送到 LINE（直接送，不走出件匣，才知道有沒有成功）
     try:
-        line_bot_api.push_message(user_id, TextSendMessage(text=message))
+        line_bot_api.api.push_message(user_id, TextSendMessage(text=message))
         save_to_mongo(user_id, bot_msg=message)
+        grader.assign([user_id], challenge_text)
     except Exception as e:
         print(f"❌ LINE 推送失敗: {e}")
         return jsonify({"error": "LINE 發送失敗"}), 500
 
     return jsonify({"status": "success", "sent_to": user_id})
 
+@app.route("/send_daily_challenges", methods=["POST"])
+def send_daily_challenges():
+    """批次版每日挑戰：同一個 (等級, 天數) 只出一題，用 multicast 群發，再一次批次儲存"""
+    data = request.get_json(silent=True) or {}
+    users = data.get("users")
+    if not isinstance(users, list) or not users:
+        return jsonify({"error": "缺少 users"}), 400
+
+    # ✅ 依 (等級, 天數) 分組
+    groups = group_recipients(users)
+
+    results = []
+    total_start = time.monotonic()
+    for (user_level, day_count), user_ids in groups.items():
+        group = {"user_level": user_level, "day_count": day_count, "recipients": len(user_ids),
+                 "sent": 0, "failed": 0}
+        start = time.monotonic()
+        try:
+            challenge_text = question_pool.next_question("daily", user_level)
+        except Exception as e:
+            print(f"❌ GPT 題目生成失敗 ({user_level}, Day{day_count}): {e}")
+            group.update({"error": "GPT 失敗", "failed": len(user_ids)})
+            results.append(group)
+            continue
+        group["generate_seconds"] = round(time.monotonic() - start, 3)
+
+        # ✅ multicast 分批發送
+        message = format_daily_challenge(user_level, day_count, challenge_text)
+        start = time.monotonic()
+        delivered = []
+        for chunk in chunks(user_ids):
+            try:
+                line_bot_api.multicast(chunk, TextSendMessage(text=message))
+                delivered.extend(chunk)
+            except Exception as e:
+                print(f"❌ LINE multicast 失敗（{len(chunk)} 人）: {e}")
+                group["failed"] += len(chunk)
+        group["sent"] = len(delivered)
+        group["multicast_seconds"] = round(time.monotonic() - start, 3)
+
+        # ✅ 一次批次儲存
+        start = time.monotonic()
+        persistence.save_messages([
+            persistence.client.make_record(uid, bot_response=message, message_type="bot") for uid in delivered
+        ])
+        group["persist_seconds"] = round(time.monotonic() - start, 3)
+        grader.assign(delivered, challenge_text)
+        print(f"✅ 每日挑戰 {user_level} Day{day_count}：送出 {group['sent']} 人，失敗 {group['failed']} 人")
+        results.append(group)
+
+    return jsonify({
+        "status": "success",
+        "groups": results,
+        "sent": sum(g["sent"] for g in results),
+        "failed": sum(g["failed"] for g in results),
+        "seconds": round(time.monotonic() - total_start, 3)
+    })
+
 def send_mode_selection(user_id):
     flex_message = FlexSendMessage(
         alt_text="請選擇學習模式",
@@ -204,94 +278,51 @@ def send_mode_selection(user_id):
     line_bot_api.push_message(user_id, flex_message)
 
 def generate_active_question(level=1):
-    system_message = (
-        "你是一位 C 語言教學助手，會根據題目難度產生挑戰性問題。\n"
-        "Level 1：選擇題（簡單）\n"
-        "Level 2：填空題（中等）\n"
-        "Level 3：簡答題（進階）\n"
-        "這些難度資訊只用於內部控制，請勿顯示給使用者。\n"
-        "出題範圍從 C 語言基本語法、變數、流程控制，到進階如指標與迴圈。"
-    )
-
-    user_prompt = (
-        f"請產生一題 C 語言的問題，難度為 Level {level}。\n"
-        "請從選擇題、填空題、簡答題中擇一產生，幫助學習者思考。\n"
-        "不要提供答案。"
-    )
-
-    response = openai.ChatCompletion.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-
-    return response["choices"][0]["message"]["content"].strip()
+    return question_pool.generate_active_question(level)
 
 def save_to_mongo(user_id, user_msg=None, bot_msg=None):
-    """儲存對話資料到 MongoDB，可選擇儲存 user 或 bot"""
-    try:
-        if user_msg:
-            requests.post(f"{NODE_SERVER_URL}/save_message", json={
-                "user_id": user_id,
-                "message_text": user_msg,
-                "bot_response": "",
-                "message_type": "text"
-            }, timeout=10)
-            print(f"✅ 儲存使用者訊息: {user_msg}")
-        if bot_msg:
-            requests.post(f"{NODE_SERVER_URL}/save_message", json={
-                "user_id": user_id,
-                "message_text": "",
-                "bot_response": bot_msg,
-                "message_type": "bot"
-            }, timeout=10)
-            print(f"✅ 儲存 AI 回覆: {bot_msg}")
-    except requests.exceptions.RequestException as e:
-        print(f"❌ 儲存訊息失敗: {e}")
+    """儲存對話資料到 MongoDB，可選擇儲存 user 或 bot（背景批次送出，不會卡住 webhook）"""
+    if user_msg:
+        save_message(user_id, message_text=user_msg, message_type="text")
+        print(f"✅ 儲存使用者訊息: {user_msg}")
+    if bot_msg:
+        save_message(user_id, bot_response=bot_msg, message_type="bot")
+        print(f"✅ 儲存 AI 回覆: {bot_msg}")
 
 # =============== 接收使用者訊息 ===============
-@handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     user_text = event.message.text.strip()
     print(f"💬 收到來自 {user_id} 的訊息: {user_text}")
 
     # 儲存使用者輸入（不管是哪一種模式）
-    save_to_mongo(user_id, user_msg=user_text)
+    with metrics.stage("save_to_mongo"):
+        save_to_mongo(user_id, user_msg=user_text)
 
-    mode_map = {
-        "mode_passive": "passive",
-        "mode_active": "active",
-        "mode_constructive": "constructive",
-        "mode_interactive": "interactive"
-    }
+    # 同一位使用者的訊息依序處理；短時間內連發的會合併成一則，只問一次 GPT
+    user_executor.submit(user_id, (event, user_text))
 
-    if user_text in mode_map:
-        user_mode[user_id] = mode_map[user_text]
 
-        descriptions = {
-            "passive": "你會以閱讀為主，我會盡量簡潔地回答你，不主動提問。",
-            "active": "我會給你一些挑戰性的問題，讓你主動思考和作答。",
-            "constructive": "我會根據你的回答，進一步追問，幫助你深化想法。",
-            "interactive": "我們會像朋友一樣對話，一起討論主題和觀點。"
-        }
+def process_messages(user_id, batch):
+    """keyed_executor 交來的一批：切換模式自己一批，其餘連發的訊息用換行接起來，回覆用最後一則的 reply token"""
+    event = batch[-1][0]
+    user_text = "\n".join(text for _, text in batch)
+    if len(batch) > 1:
+        print(f"🧺 合併 {user_id} 連發的 {len(batch)} 則訊息")
+    process_message(event, user_id, user_text)
+
 
-        mode_key = mode_map[user_text]
-        mode_name = user_text.replace("mode_", "").capitalize()
-        description = descriptions[mode_key]
+def process_message(event, user_id, user_text):
+    if user_text in MODE_MAP:
+        mode_key = MODE_MAP[user_text]
+        user_mode.set(user_id, mode_key)
 
         if mode_key == "active":
-            question = generate_active_question()
-            user_state[user_id] = {
-                "mode": "active",
-                "last_question": question,
-                "awaiting_answer": True
-            }
-            reply_text = f"已切換至『{mode_name}』模式\n\n{description}\n\n第一題：{question}\n\n你覺得答案是什麼？"
+            question = question_pool.next_question("active", 1, user_id)
+            user_state.set(user_id, first_question_state(question))
+            reply_text = switch_reply_text(user_text, question)
         else:
-            reply_text = f"已切換至『{mode_name}』模式\n\n{description}"
+            reply_text = switch_reply_text(user_text)
 
         line_bot_api.reply_message(event.reply_token, TextSendMessage(reply_text))
         save_to_mongo(user_id, bot_msg=reply_text)
@@ -300,17 +331,29 @@ def handle_message(event):
     # 取得使用者目前模式
     mode = user_mode.get(user_id, "passive")
     print(f"用戶 {user_id} 的目前模式：{mode}")
-
-    # 載入歷史訊息（用於有上下文的模式）
-    history = load_history(user_id)
-    messages = [{"role": "system", "content": "你是一位專業的 C 語言學習助教，擅長根據上下文進行回答，避免重複主題。"}]
-    for msg in sorted(history.get("messages", []), key=lambda x: x.get("timestamp", "")):
-        if msg.get("message_text"):
-            messages.append({"role": "user", "content": msg["message_text"]})
-        elif msg.get("bot_response"):
-            messages.append({"role": "assistant", "content": msg["bot_response"]})
+    metrics.set_mode(mode)
+    if mode in MODE_DESCRIPTIONS:
+        user_stats.record_mode(user_id, mode)  # 記憶體累加，定時批次送 Node
+
+    # 回傳程式碼：題目有測資就在本機編譯評分，不用等 GPT
+    active_question = user_state.get(user_id, {}).get("last_question") if mode == "active" else None
+    with metrics.stage("grade"):
+        if handle_code_submission(event, user_id, user_text, line_bot_api, active_question):
+            return
+
+    # 載入歷史訊息（只有需要上下文的模式才讀，優先走本地快取）
+    turns = []
+    if mode in MODES_WITH_HISTORY:
+        with metrics.stage("load_history"):
+            history = load_cached_history(user_id)
+            turns = context_builder.turns_from_records(history.get("messages", []))
 
     # 模式處理
+    with metrics.stage("handler"):
+        _dispatch_mode(event, user_id, user_text, mode, turns)
+
+
+def _dispatch_mode(event, user_id, user_text, mode, turns):
     if mode == "passive":
         handle_passive_mode(event, user_id, user_text, line_bot_api)
         return
@@ -321,7 +364,7 @@ def handle_message(event):
 
     
     elif mode == "interactive":
-        handle_interactive_mode(event, user_id, user_text, line_bot_api, messages)
+        handle_interactive_mode(event, user_id, user_text, line_bot_api, turns)
         return
 
     elif mode == "active":
@@ -333,6 +376,39 @@ def handle_message(event):
             TextSendMessage(text="未知模式，請重新選擇 \n請輸入「模式」或點選選單選擇學習模式。")
         )
         return
+
+user_executor = keyed_executor.KeyedExecutor(process_messages, is_barrier=lambda item: item[1] in MODE_MAP,
+                                             name="user-events")
+atexit.register(user_executor.join, 30)  # 比出件匣的 flush 晚註冊 → 先跑：排著的訊息處理完再把 push 送出去
+
+# (事件類型, 訊息類型 or None) → 處理函式
+EVENT_HANDLERS = {
+    (MessageEvent, TextMessage): handle_message,
+}
+
+# =============== 監控指標 ===============
+metrics.registry.add_collector("linebot_worker_pool", worker_pool.pool.stats)
+metrics.registry.add_collector("linebot_persistence", persistence.client.stats)
+metrics.registry.add_collector("linebot_history_cache", history_cache.cache.stats)
+metrics.registry.add_collector("linebot_response_cache", response_cache.cache.stats)
+metrics.registry.add_collector("linebot_question_pool", question_pool.pool.stats)
+metrics.registry.add_collector("linebot_webhook_dedup", event_dedup.seen_events.stats)
+metrics.registry.add_collector("linebot_outbox", push_outbox.stats)
+metrics.registry.add_collector("linebot_reply_path", reply_deadline.stats)
+metrics.registry.add_collector("linebot_user_stats", user_stats.aggregator.stats)
+metrics.registry.add_collector("linebot_model_router", model_router.stats)
+metrics.registry.add_collector("linebot_grader", grader.stats)
+metrics.registry.add_collector("linebot_keyed_executor", user_executor.stats)
+metrics.registry.add_collector("linebot_node_health", node_health.monitor.stats)
+metrics.registry.add_collector("linebot_llm", lambda: {
+    "usage": llm_gateway.usage_summary(),
+    "breaker_open": llm_gateway.breaker.state != "closed",
+})
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/", methods=["GET"])
 def home():
     return "服務運作中～", 200
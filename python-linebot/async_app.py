@@ -0,0 +1,343 @@
+"""asyncio 版的 LINE Bot 入口（aiohttp），路由與 app.py 相同
+
+    python async_app.py
+    gunicorn async_app:create_app --worker-class aiohttp.GunicornWebWorker
+
+LINE、OpenAI、Node 都走同一個 aiohttp ClientSession 的連線池；webhook 驗簽後立刻回 200，
+每個事件各自是一個 task，等 GPT 的時候不佔執行緒，一個 process 可以同時掛著上千段對話。
+"""
+import asyncio
+import os
+import time
+
+import aiohttp
+import openai
+from aiohttp import web
+from linebot import AsyncLineBotApi, LineBotApi, WebhookParser
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, TextSendMessage
+
+import context_builder
+import event_dedup
+import grader
+import history_cache
+import keyed_executor
+import metrics
+import model_router
+import node_health
+import outbox
+import persistence
+import question_pool
+import reply_deadline
+import state_store
+import user_stats
+from daily_challenge import format_daily_challenge, group_recipients, chunks
+from handlers import async_modes
+from modes import MODE_MAP, MODE_DESCRIPTIONS, switch_reply_text, first_question_state
+from persistence import save_message
+
+# =============== 設定 ===============
+ASYNC_HTTP_POOL = int(os.getenv("ASYNC_HTTP_POOL", "1000"))        # 共用連線池上限
+ASYNC_SHUTDOWN_GRACE = float(os.getenv("ASYNC_SHUTDOWN_GRACE", "30"))  # 關機時等進行中的對話多久
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me")
+
+parser = WebhookParser(os.getenv("CHANNEL_SECRET"))
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+user_mode = state_store.make_store("mode")
+user_state = state_store.make_store("state")
+
+def _spawn(app, coro):
+    """背景跑一個 task，留參考避免被 GC，關機時才等得到"""
+    task = asyncio.create_task(coro)
+    app["tasks"].add(task)
+    task.add_done_callback(app["tasks"].discard)
+    return task
+
+
+# =============== 歷史紀錄讀取 ===============
+async def load_history(ctx, user_id):
+    """對沖讀取；Node 不能用時丟 NodeUnavailable"""
+    data = await node_health.monitor.aget_json(ctx.session, "/get_history", {"user_id": user_id, "limit": 10})
+    return data.get("messages", [])
+
+
+async def load_cached_history(ctx, user_id):
+    turns = history_cache.cache.peek(user_id)
+    if turns is None:
+        try:
+            turns = history_cache.cache.fill(user_id, await load_history(ctx, user_id))
+        except node_health.NodeUnavailable as e:
+            # 降級模式：用快取裡現有的對話（可能是空的）照樣回覆
+            print(f"⚠️ {e}，改用本地快取的對話")
+            metrics.errors_total.inc(mode=metrics.current_mode(), stage="load_history", type="NodeUnavailable")
+            turns = history_cache.cache.stale(user_id)
+    return turns
+
+
+# =============== 接收使用者訊息 ===============
+async def handle_message(ctx, event):
+    user_id = event.source.user_id
+    user_text = event.message.text.strip()
+    print(f"💬 收到來自 {user_id} 的訊息: {user_text}")
+
+    with metrics.stage("save_to_mongo"):
+        save_message(user_id, message_text=user_text, message_type="text")
+
+    # 同一位使用者依序處理；短時間內連發的合併成一則（取代原本的 per-user 鎖）
+    user_executor.submit(user_id, (ctx, event, user_text))
+
+
+async def process_messages(user_id, batch):
+    ctx, event = batch[-1][0], batch[-1][1]
+    user_text = "\n".join(text for _, _, text in batch)
+    if len(batch) > 1:
+        print(f"🧺 合併 {user_id} 連發的 {len(batch)} 則訊息")
+    await process_message(ctx, event, user_id, user_text)
+
+
+user_executor = keyed_executor.AsyncKeyedExecutor(process_messages, is_barrier=lambda item: item[2] in MODE_MAP)
+
+
+async def process_message(ctx, event, user_id, user_text):
+    if user_text in MODE_MAP:
+        mode_key = MODE_MAP[user_text]
+        user_mode.set(user_id, mode_key)
+        if mode_key == "active":
+            question = await asyncio.to_thread(question_pool.next_question, "active", 1, user_id)
+            user_state.set(user_id, first_question_state(question))
+            reply_text = switch_reply_text(user_text, question)
+        else:
+            reply_text = switch_reply_text(user_text)
+        await ctx.line_bot_api.reply_message(event.reply_token, TextSendMessage(reply_text))
+        save_message(user_id, bot_response=reply_text, message_type="bot")
+        return
+
+    mode = user_mode.get(user_id, "passive")
+    metrics.set_mode(mode)
+    if mode in MODE_DESCRIPTIONS:
+        user_stats.record_mode(user_id, mode)
+
+    active_question = ctx.user_state.get(user_id, {}).get("last_question") if mode == "active" else None
+    with metrics.stage("grade"):
+        if await async_modes.handle_code_submission(ctx, event, user_id, user_text, active_question):
+            return
+
+    with metrics.stage("handler"):
+        if mode == "passive":
+            await async_modes.handle_passive_mode(ctx, event, user_id, user_text)
+        elif mode == "constructive":
+            await async_modes.handle_constructive_mode(ctx, event, user_id, user_text)
+        elif mode == "interactive":
+            with metrics.stage("load_history"):
+                records = await load_cached_history(ctx, user_id)
+            turns = context_builder.turns_from_records(records)
+            await async_modes.handle_interactive_mode(ctx, event, user_id, user_text, turns)
+        elif mode == "active":
+            await async_modes.handle_active_mode(ctx, event, user_id, user_text)
+        else:
+            await ctx.line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="未知模式，請重新選擇 \n請輸入「模式」或點選選單選擇學習模式。")
+            )
+
+
+# (事件類型, 訊息類型 or None) → 處理 coroutine
+EVENT_HANDLERS = {
+    (MessageEvent, TextMessage): handle_message,
+}
+
+
+async def dispatch_event(ctx, event):
+    event_id = getattr(event, "webhook_event_id", None)
+    try:
+        # 處理失敗時 handling() 會拿掉去重標記，LINE 重送的同一個事件可以再處理
+        with event_dedup.handling(event) as fresh:
+            if not fresh:
+                print(f"♻️ 重複的 webhook 事件 {event_id}，略過")
+                metrics.webhook_events_total.inc(type=event.type, result="duplicate")
+                return
+
+            message = getattr(event, "message", None)
+            func = EVENT_HANDLERS.get((type(event), type(message))) or EVENT_HANDLERS.get((type(event), None))
+            if func is None:
+                metrics.webhook_events_total.inc(type=event.type, result="unhandled")
+                return
+            metrics.webhook_events_total.inc(type=event.type, result="handled")
+            with metrics.mode_context(None), metrics.stage("handle_event"):
+                await func(ctx, event)
+    except Exception as e:
+        print(f"❌ 事件處理失敗 ({type(e).__name__}): {e}")
+
+
+# =============== 路由 ===============
+async def callback(request):
+    signature = request.headers.get("X-Line-Signature")
+    if not signature:
+        raise web.HTTPForbidden()
+
+    body = await request.text()
+    try:
+        with metrics.stage("verify_parse", mode="webhook"):
+            events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        print("❌ LINE 簽名驗證失敗")
+        raise web.HTTPBadRequest()
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"❌ Webhook 內容格式錯誤: {e}")
+        return web.json_response({"error": "Invalid data"}, status=400)
+
+    # 驗簽完就回 200，事件在背景 task 裡處理（reply token 有一分鐘可用）
+    for event in events:
+        _spawn(request.app, dispatch_event(request.app["ctx"], event))
+    return web.Response(text="OK")
+
+
+async def send_daily_challenge(request):
+    ctx = request.app["ctx"]
+    data = await request.json()
+    user_id = data.get("user_id")
+    user_level = data.get("user_level", "beginner")
+    day_count = data.get("day_count", 1)
+
+    if not user_id:
+        return web.json_response({"error": "缺少 user_id"}, status=400)
+
+    try:
+        challenge_text = await asyncio.to_thread(question_pool.next_question, "daily", user_level, user_id)
+    except Exception as e:
+        print(f"❌ GPT 題目生成失敗: {e}")
+        return web.json_response({"error": "GPT 失敗"}, status=500)
+
+    message = format_daily_challenge(user_level, day_count, challenge_text)
+    try:
+        await ctx.line_bot_api.api.push_message(user_id, TextSendMessage(text=message))
+        save_message(user_id, bot_response=message, message_type="bot")
+        grader.assign([user_id], challenge_text)
+    except Exception as e:
+        print(f"❌ LINE 推送失敗: {e}")
+        return web.json_response({"error": "LINE 發送失敗"}, status=500)
+
+    return web.json_response({"status": "success", "sent_to": user_id})
+
+
+async def _send_group(ctx, user_level, day_count, user_ids):
+    group = {"user_level": user_level, "day_count": day_count, "recipients": len(user_ids), "sent": 0, "failed": 0}
+    try:
+        challenge_text = await asyncio.to_thread(question_pool.next_question, "daily", user_level)
+    except Exception as e:
+        print(f"❌ GPT 題目生成失敗 ({user_level}, Day{day_count}): {e}")
+        group.update({"error": "GPT 失敗", "failed": len(user_ids)})
+        return group
+
+    message = format_daily_challenge(user_level, day_count, challenge_text)
+    batches = list(chunks(user_ids))
+    results = await asyncio.gather(
+        *(ctx.line_bot_api.multicast(batch, TextSendMessage(text=message)) for batch in batches),
+        return_exceptions=True
+    )
+    delivered = []
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            print(f"❌ LINE multicast 失敗（{len(batch)} 人）: {result}")
+            group["failed"] += len(batch)
+        else:
+            delivered.extend(batch)
+    group["sent"] = len(delivered)
+    await asyncio.to_thread(persistence.save_messages, [
+        persistence.client.make_record(uid, bot_response=message, message_type="bot") for uid in delivered
+    ])
+    grader.assign(delivered, challenge_text)
+    return group
+
+
+async def send_daily_challenges(request):
+    """批次版每日挑戰：各組同時出題、同時 multicast"""
+    data = await request.json()
+    users = data.get("users") if isinstance(data, dict) else None
+    if not isinstance(users, list) or not users:
+        return web.json_response({"error": "缺少 users"}, status=400)
+
+    start = time.monotonic()
+    ctx = request.app["ctx"]
+    groups = await asyncio.gather(*(
+        _send_group(ctx, level, day, user_ids) for (level, day), user_ids in group_recipients(users).items()
+    ))
+    return web.json_response({
+        "status": "success",
+        "groups": groups,
+        "sent": sum(g["sent"] for g in groups),
+        "failed": sum(g["failed"] for g in groups),
+        "seconds": round(time.monotonic() - start, 3)
+    })
+
+
+async def home(request):
+    return web.Response(text="服務運作中～")
+
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+# =============== 啟動 / 關閉 ===============
+@web.middleware
+async def openai_session_middleware(request, handler):
+    # openai 0.28 的 acreate 從這個 ContextVar 拿 session；背景 task 會繼承
+    openai.aiosession.set(request.app["http"])
+    return await handler(request)
+
+
+async def on_startup(app):
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_POOL))
+    line_bot_api = AsyncLineBotApi(os.getenv("CHANNEL_ACCESS_TOKEN"), AiohttpAsyncHttpClient(session),
+                                   endpoint=LINE_API_ENDPOINT)
+    metrics.instrument(line_bot_api, ["reply_message", "push_message", "multicast"], prefix="line:")
+    # push 走出件匣：合併、限速由少數幾條送件執行緒負責（跟 app.py 同一套）
+    push_api = LineBotApi(os.getenv("CHANNEL_ACCESS_TOKEN"), endpoint=LINE_API_ENDPOINT)
+    metrics.instrument(push_api, ["push_message"], prefix="line:")
+    app["outbox"] = outbox.Outbox(push_api)
+    metrics.registry.add_collector("linebot_outbox", app["outbox"].stats)
+    metrics.registry.add_collector("linebot_reply_path", reply_deadline.stats)
+    metrics.registry.add_collector("linebot_user_stats", user_stats.aggregator.stats)
+    metrics.registry.add_collector("linebot_model_router", model_router.stats)
+    metrics.registry.add_collector("linebot_grader", grader.stats)
+    metrics.registry.add_collector("linebot_keyed_executor", user_executor.stats)
+    metrics.registry.add_collector("linebot_node_health", node_health.monitor.stats)
+    node_health.monitor.start()
+    line_bot_api = outbox.AsyncOutboxLineBotApi(line_bot_api, app["outbox"])
+    app["http"] = session
+    app["ctx"] = async_modes.AsyncContext(line_bot_api, session, user_state)
+    app["tasks"] = set()
+    if question_pool.QUESTION_POOL_WARMUP:
+        question_pool.pool.warm_up_later()
+
+
+async def on_cleanup(app):
+    if app["tasks"]:
+        await asyncio.wait(app["tasks"], timeout=ASYNC_SHUTDOWN_GRACE)
+    pending = user_executor.tasks()
+    if pending:
+        print(f"⏳ 等待 {len(pending)} 位使用者進行中的對話結束")
+        await asyncio.wait(pending, timeout=ASYNC_SHUTDOWN_GRACE)
+    await asyncio.to_thread(app["outbox"].flush)
+    await app["http"].close()
+    await asyncio.to_thread(user_stats.aggregator.flush)
+    persistence.client.flush_all()
+
+
+async def create_app():
+    app = web.Application(middlewares=[openai_session_middleware])
+    app.router.add_post("/callback", callback)
+    app.router.add_post("/send_daily_challenge", send_daily_challenge)
+    app.router.add_post("/send_daily_challenges", send_daily_challenges)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_get("/", home)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
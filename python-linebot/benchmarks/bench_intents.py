@@ -0,0 +1,99 @@
+"""意圖分類的準確率 / 吞吐量基準測試
+
+用法（在 python-linebot/ 底下）：
+    python benchmarks/bench_intents.py [--rounds 200]
+
+會同時跑舊版 handle_active_mode 裡的關鍵字 if/elif 當作對照。
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import intents  # noqa: E402
+from handlers.active import ACTIVE_INTENTS  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_corpus.tsv")
+
+
+def load_corpus(path=CORPUS):
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            label, text = line.split("\t", 1)
+            rows.append((label, text))
+    return rows
+
+
+# === 舊版：每則訊息依序跑四個關鍵字判斷，先命中的贏 ===
+def legacy_classify(user_input):
+    lowered = user_input.lower()
+    if any(kw in lowered for kw in ["答案", "正確", "解答", "告訴我"]):
+        return "ask_answer"
+    if any(kw in lowered for kw in ["下一題", "下一個", "再一題", "請再給一題", "再來", "下一"]):
+        return "next_question"
+    stripped = lowered.strip()
+    if stripped in {"a", "b", "c", "d"} or re.search(r"(選|答案是|應該是)[\s]*[a-d]", stripped):
+        return "answer_choice"
+    if any(kw in stripped for kw in ["printf", "int", "指標", "陣列", "return", "變數"]):
+        return "answer_attempt"
+    if any(kw in lowered for kw in ["為什麼", "是什麼", "代表", "差別", "怎麼", "如何", "什麼意思", "跟", "有什麼關係"]):
+        return "followup"
+    return "none"
+
+
+def engine_classify(user_input):
+    return intents.classify(user_input).best(ACTIVE_INTENTS) or "none"
+
+
+def _handler_route(label):
+    # answer_choice 與 answer_attempt 在 handler 裡走同一條路（回饋作答）
+    return "answer" if label in ("answer_choice", "answer_attempt") else label
+
+
+def evaluate(name, classify, corpus, rounds):
+    correct, errors = 0, Counter()
+    for label, text in corpus:
+        predicted = classify(text)
+        if _handler_route(predicted) == _handler_route(label):
+            correct += 1
+        else:
+            errors[(label, predicted)] += 1
+
+    texts = [text for _, text in corpus]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            classify(text)
+    elapsed = time.perf_counter() - start
+    total = rounds * len(texts)
+
+    print(f"\n== {name} ==")
+    print(f"準確率：{correct}/{len(corpus)} = {correct / len(corpus):.1%}")
+    print(f"吞吐量：{total / elapsed:,.0f} 則/秒（平均 {elapsed / total * 1e6:.1f} µs/則）")
+    for (label, predicted), count in errors.most_common():
+        print(f"  {label:>15} → {predicted:<15} ×{count}")
+    return correct / len(corpus)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200, help="吞吐量測試時整份語料跑幾輪")
+    parser.add_argument("--corpus", default=CORPUS)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    print(f"語料：{len(corpus)} 則，{dict(Counter(label for label, _ in corpus))}")
+    evaluate("legacy if/elif", legacy_classify, corpus, args.rounds)
+    evaluate("intents.classify", engine_classify, corpus, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
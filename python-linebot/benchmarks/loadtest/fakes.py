@@ -0,0 +1,254 @@
+"""壓測用的假 OpenAI / LINE / Node 伺服器（只用標準函式庫）
+
+每個假伺服器都可以設定延遲分佈與錯誤率：
+    latency  中位數（秒），實際延遲取 lognormal(median, sigma)
+    sigma    延遲分佈的離散程度，0 代表固定延遲
+    errors   回傳錯誤的機率（OpenAI 一半給 429、一半給 500；LINE / Node 給 500）
+
+單獨啟動（給手動測試用）：
+    python benchmarks/loadtest/fakes.py --openai-latency 1.5 --openai-errors 0.02
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LatencyProfile:
+    def __init__(self, latency=0.0, sigma=0.0, errors=0.0, seed=None):
+        self.latency = latency
+        self.sigma = sigma
+        self.errors = errors
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            if self.latency <= 0:
+                delay = 0.0
+            elif self.sigma <= 0:
+                delay = self.latency
+            else:
+                delay = self._rng.lognormvariate(math.log(self.latency), self.sigma)
+            failed = self._rng.random() < self.errors
+            coin = self._rng.random()
+        return delay, failed, coin
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeServer/1.0"
+
+    def log_message(self, fmt, *args):  # 壓測時不要洗版
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw) if raw else {}
+        except ValueError:
+            return {}
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, key):
+        stats = self.server.stats
+        with self.server.stats_lock:
+            stats[key] = stats.get(key, 0) + 1
+
+    def _delay(self):
+        delay, failed, coin = self.server.profile.sample()
+        if delay:
+            time.sleep(delay)
+        return failed, coin
+
+
+# === 🤖 OpenAI ===
+class OpenAIHandler(_Handler):
+    def do_POST(self):
+        body = self._read_json()
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self._send_json(404, {"error": {"message": "not found"}})
+        failed, coin = self._delay()
+        if failed:
+            if coin < 0.5:
+                self._count("429")
+                return self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                                       {"Retry-After": "0.2"})
+            self._count("500")
+            return self._send_json(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+
+        self._count("ok")
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 2
+        text = self.server.reply_text
+        if body.get("stream"):
+            return self._stream(body, text)
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(text) // 2,
+                      "total_tokens": prompt_tokens + len(text) // 2},
+        })
+
+    def _stream(self, body, text):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        pieces = [text[i:i + 20] for i in range(0, len(text), 20)]
+        for piece in pieces:
+            chunk = {"object": "chat.completion.chunk", "model": body.get("model", "gpt-4o"),
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.server.stream_gap)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+# === 💬 LINE Messaging API ===
+class LineHandler(_Handler):
+    def do_POST(self):
+        body = self._read_json()
+        failed, _ = self._delay()
+        if failed:
+            self._count("500")
+            return self._send_json(500, {"message": "fake LINE error"})
+        kind = self.path.rstrip("/").rsplit("/", 1)[-1]  # reply / push / multicast
+        self._count(kind)
+        now = time.monotonic()
+        if kind == "reply":
+            user_id = self.server.reply_tokens.pop(body.get("replyToken"), None)
+            recipients = [user_id] if user_id else []
+        elif kind == "push":
+            recipients = [body.get("to")]
+        else:
+            recipients = list(body.get("to") or [])
+        for user_id in recipients:
+            self.server.record_delivery(user_id, kind, now, len(body.get("messages", [])))
+        self._send_json(200, {"sentMessages": []})
+
+
+# === 🗄️ node-mongodb ===
+class NodeHandler(_Handler):
+    def do_GET(self):
+        failed, _ = self._delay()
+        if failed:
+            self._count("500")
+            return self._send_json(500, {"error": "fake node error"})
+        self._count("get:" + self.path.split("?")[0])
+        if self.path.startswith("/get_history"):
+            return self._send_json(200, {"messages": []})
+        self._send_json(200, {"status": "ok"})
+
+    def do_POST(self):
+        body = self._read_json()
+        failed, _ = self._delay()
+        if failed:
+            self._count("500")
+            return self._send_json(500, {"error": "fake node error"})
+        path = self.path.split("?")[0]
+        self._count("post:" + path)
+        if isinstance(body.get("messages"), list):
+            with self.server.stats_lock:
+                self.server.stats["saved_records"] = self.server.stats.get("saved_records", 0) + len(body["messages"])
+        self._send_json(200, {"status": "ok"})
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, handler, profile, port=0):
+        super().__init__(("127.0.0.1", port), handler)
+        self.profile = profile
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        # 給 LINE 假伺服器用：reply token → user，以及每位使用者收到訊息的時間
+        self.reply_tokens = {}
+        self.deliveries = {}
+        self.delivery_cond = threading.Condition()
+        # 給 OpenAI 假伺服器用
+        self.reply_text = "這是一段假的 GPT 回覆。" * 10
+        self.stream_gap = 0.02
+
+    def handle_error(self, request, client_address):
+        # 客戶端斷線（連線池關閉、逾時放棄）是壓測中的正常狀況
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def record_delivery(self, user_id, kind, at, count):
+        with self.delivery_cond:
+            self.deliveries.setdefault(user_id, []).append((at, kind, count))
+            self.delivery_cond.notify_all()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def start_fakes(openai_profile, line_profile, node_profile, ports=(0, 0, 0)):
+    return (
+        FakeServer(OpenAIHandler, openai_profile, ports[0]).start(),
+        FakeServer(LineHandler, line_profile, ports[1]).start(),
+        FakeServer(NodeHandler, node_profile, ports[2]).start(),
+    )
+
+
+def add_profile_args(parser):
+    for name, latency in (("openai", 1.0), ("line", 0.05), ("node", 0.03)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency, help=f"{name} 延遲中位數（秒）")
+        parser.add_argument(f"--{name}-sigma", type=float, default=0.4, help=f"{name} 延遲 lognormal sigma")
+        parser.add_argument(f"--{name}-errors", type=float, default=0.0, help=f"{name} 錯誤率 0~1")
+
+
+def profiles_from_args(args, seed=None):
+    return tuple(
+        LatencyProfile(getattr(args, f"{name}_latency"), getattr(args, f"{name}_sigma"),
+                       getattr(args, f"{name}_errors"), seed=None if seed is None else seed + i)
+        for i, name in enumerate(("openai", "line", "node"))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_profile_args(parser)
+    parser.add_argument("--ports", default="8101,8102,8103", help="openai,line,node 的埠號")
+    args = parser.parse_args()
+    ports = tuple(int(p) for p in args.ports.split(","))
+    openai_server, line_server, node_server = start_fakes(*profiles_from_args(args), ports=ports)
+    print(f"OPENAI_API_BASE={openai_server.url}/v1")
+    print(f"LINE_API_ENDPOINT={line_server.url}")
+    print(f"NODE_SERVER_URL={node_server.url}")
+    try:
+        while True:
+            time.sleep(5)
+            print({"openai": openai_server.stats, "line": line_server.stats, "node": node_server.stats})
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
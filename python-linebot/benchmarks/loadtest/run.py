@@ -0,0 +1,287 @@
+"""離線壓測：假的 OpenAI / LINE / Node + 簽好名的 webhook，量 /callback 的端到端延遲
+
+用法（在 python-linebot/ 底下）：
+    python benchmarks/loadtest/run.py --users 40 --messages 6 --openai-latency 1.5
+    python benchmarks/loadtest/run.py --app-cmd "gunicorn -w 2 -b 127.0.0.1:{port} app:app"
+
+每位模擬使用者固定一個模式：先送 mode_xxx 切換，再依劇本一句一句問。
+每一句記三個時間（都從送出 webhook 開始算）：
+    ack    /callback 回 200 的時間（LINE 平台看到的延遲）
+    first  使用者收到第一則訊息（通常是 reply 的等待語）
+    last   使用者收到最後一則訊息（通常是 push 的 GPT 答案）
+
+app 會繼承目前的環境變數，例如 RESPONSE_CACHE_MODES= 可以關掉回覆快取、
+QUESTION_POOL_WARMUP=0 可以量題庫還沒暖好時的情況。執行緒 / RSS 只取 --app-cmd 啟動的那個 process。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import shlex
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import add_profile_args, profiles_from_args, start_fakes  # noqa: E402
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+CHANNEL_SECRET = "loadtest-secret"
+
+# === 📜 各模式的劇本 ===
+SCRIPTS = {
+    "passive": ["指標是什麼？", "陣列跟指標差在哪", "printf 的 %d 是什麼意思", "什麼是遞迴", "malloc 要怎麼用"],
+    "active": ["b", "為什麼是這樣？", "答案是什麼", "下一題", "我選 c", "下一題"],
+    "interactive": ["我想學迴圈", "for 跟 while 哪個好", "可以舉個例子嗎", "那 do while 呢", "我懂了，謝謝"],
+    "constructive": ["變數就是存資料的地方", "指標存的是位址", "函式可以重複使用程式碼", "陣列的大小要先決定"],
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def sign(body):
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+def make_event(user_id, text, reply_token):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "source": {"type": "user", "userId": user_id},
+        "replyToken": reply_token,
+        "message": {"type": "text", "id": uuid.uuid4().hex[:12], "text": text},
+    }
+
+
+# === 🧍 模擬使用者 ===
+class SimulatedUser(threading.Thread):
+    def __init__(self, index, mode, args, line_server, callback_url, results, rng):
+        super().__init__(name=f"user-{index}", daemon=True)
+        self.user_id = f"Uloadtest{index:05d}"
+        self.mode = mode
+        self.args = args
+        self.line_server = line_server
+        self.callback_url = callback_url
+        self.results = results
+        self.rng = rng
+        self.session = requests.Session()
+
+    def _wait_for_deliveries(self, since):
+        """等到這位使用者在 since 之後收到訊息並安靜下來
+
+        收到 push（GPT 的答案）後安靜 --quiet 秒就算結束；只收到 reply 的話可能是等待語，
+        要安靜 --reply-quiet 秒（比 GPT 延遲長）確定後面沒有 push 才算結束。
+        """
+        server, timeout = self.line_server, self.args.timeout
+        give_up_at = since + timeout
+        with server.delivery_cond:
+            while True:
+                now = time.monotonic()
+                recent = [d for d in server.deliveries.get(self.user_id, []) if d[0] >= since]
+                if recent:
+                    pushed = any(kind != "reply" for _, kind, _ in recent)
+                    quiet = self.args.quiet if pushed else self.args.reply_quiet
+                    if now - recent[-1][0] >= quiet:
+                        return recent
+                if now >= give_up_at:
+                    return recent or None
+                wait = quiet - (now - recent[-1][0]) if recent else give_up_at - now
+                server.delivery_cond.wait(max(0.01, min(wait, give_up_at - now)))
+
+    def send(self, text, step):
+        reply_token = uuid.uuid4().hex
+        self.line_server.reply_tokens[reply_token] = self.user_id
+        body = json.dumps({"destination": "Uloadtest", "events": [make_event(self.user_id, text, reply_token)]},
+                          ensure_ascii=False)
+        start = time.monotonic()
+        try:
+            response = self.session.post(self.callback_url, data=body.encode("utf-8"), timeout=self.args.timeout,
+                                         headers={"X-Line-Signature": sign(body), "Content-Type": "application/json"})
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        ack = time.monotonic() - start
+        deliveries = self._wait_for_deliveries(start)
+        result = {"mode": self.mode, "step": step, "status": status, "ack": ack, "timeout": deliveries is None}
+        if deliveries:
+            result["first"] = deliveries[0][0] - start
+            result["last"] = deliveries[-1][0] - start
+            result["deliveries"] = len(deliveries)
+        self.results.append(result)
+
+    def run(self):
+        time.sleep(self.rng.uniform(0, self.args.ramp))
+        self.send(f"mode_{self.mode}", "switch")
+        script = SCRIPTS[self.mode]
+        for i in range(self.args.messages):
+            time.sleep(self.rng.expovariate(1 / self.args.think) if self.args.think > 0 else 0)
+            self.send(script[i % len(script)], i)
+
+
+# === 📈 app 的執行緒數 / 記憶體 ===
+class ProcessSampler(threading.Thread):
+    def __init__(self, pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []  # (threads, rss_kb)
+        self._halt = threading.Event()
+
+    def _read(self):
+        values = {}
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Threads", "VmRSS"):
+                    values[key] = int(value.split()[0])
+        return values.get("Threads", 0), values.get("VmRSS", 0)
+
+    def run(self):
+        while not self._halt.is_set():
+            try:
+                self.samples.append(self._read())
+            except (OSError, ValueError):
+                return  # 不是 Linux 或 process 已結束
+            self._halt.wait(self.interval)
+
+    def stop(self):
+        self._halt.set()
+
+
+def start_app(args, openai_server, line_server, node_server):
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(args.port),
+        "CHANNEL_SECRET": CHANNEL_SECRET,
+        "CHANNEL_ACCESS_TOKEN": "loadtest-token",
+        "OPENAI_API_KEY": "sk-loadtest",
+        "OPENAI_API_BASE": f"{openai_server.url}/v1",
+        "LINE_API_ENDPOINT": line_server.url,
+        "NODE_SERVER_URL": node_server.url,
+        "PYTHONUNBUFFERED": "1",
+    })
+    cmd = shlex.split(args.app_cmd.format(port=args.port, python=sys.executable))
+    log = open(args.app_log, "w") if args.app_log else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, cwd=os.path.abspath(APP_DIR), env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{args.port}"
+    for _ in range(200):
+        if proc.poll() is not None:
+            raise SystemExit(f"app 啟動失敗（exit {proc.returncode}），加 --app-log 看輸出")
+        try:
+            if requests.get(base + "/", timeout=1).status_code == 200:
+                return proc, base
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit("app 20 秒內沒有起來")
+
+
+def summarize(name, values):
+    if not values:
+        return f"{name:>6}: （無資料）"
+    return (f"{name:>6}: p50 {percentile(values, 50) * 1000:8.1f} ms  p95 {percentile(values, 95) * 1000:8.1f} ms  "
+            f"p99 {percentile(values, 99) * 1000:8.1f} ms  max {max(values) * 1000:8.1f} ms")
+
+
+def report(results, wall, sampler, fakes, metrics_text, args):
+    answered = [r for r in results if not r["timeout"]]
+    print(f"\n=== 壓測結果：{args.users} 位使用者 × {args.messages + 1} 則，耗時 {wall:.1f}s ===")
+    print(f"送出 {len(results)} 則，吞吐量 {len(results) / wall:.1f} 則/秒，"
+          f"逾時 {sum(r['timeout'] for r in results)} 則，非 200 回應 {sum(r['status'] != 200 for r in results)} 則")
+    print(summarize("ack", [r["ack"] for r in results]))
+    print(summarize("first", [r["first"] for r in answered]))
+    print(summarize("last", [r["last"] for r in answered]))
+    print("\n各模式（last）：")
+    for mode in sorted({r["mode"] for r in results}):
+        values = [r["last"] for r in answered if r["mode"] == mode and r["step"] != "switch"]
+        print("  " + summarize(mode[:6], values))
+    if sampler.samples:
+        threads = [t for t, _ in sampler.samples]
+        rss = [kb / 1024 for _, kb in sampler.samples]
+        print(f"\napp 執行緒：平均 {statistics.mean(threads):.0f}，最高 {max(threads)}")
+        print(f"app RSS：起始 {rss[0]:.1f} MB，最高 {max(rss):.1f} MB，結束 {rss[-1]:.1f} MB")
+    print("\n假伺服器請求數：")
+    for name, server in zip(("openai", "line", "node"), fakes):
+        print(f"  {name:>6}: {dict(sorted(server.stats.items()))}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "wall": wall, "results": results, "process_samples": sampler.samples,
+                       "fakes": {n: s.stats for n, s in zip(("openai", "line", "node"), fakes)},
+                       "metrics": metrics_text}, f, ensure_ascii=False, indent=2)
+        print(f"\n完整結果寫到 {args.out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5, help="每位使用者切換模式後再送幾則")
+    parser.add_argument("--modes", default="passive,active,interactive,constructive", help="依序輪流分配給使用者")
+    parser.add_argument("--think", type=float, default=0.5, help="兩則訊息之間的平均思考時間（秒，指數分佈）")
+    parser.add_argument("--ramp", type=float, default=2.0, help="使用者在這幾秒內陸續開始")
+    parser.add_argument("--quiet", type=float, default=0.5, help="收到 push 後要安靜多久才算這句結束")
+    parser.add_argument("--reply-quiet", type=float, help="只收到 reply 時要安靜多久（預設 OpenAI 延遲 ×4 + 1 秒）")
+    parser.add_argument("--timeout", type=float, default=90.0)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--app-cmd", default="{python} app.py", help="啟動 app 的指令，{port} {python} 會被代換")
+    parser.add_argument("--app-log", help="app 輸出寫到這個檔案")
+    parser.add_argument("--out", help="把完整結果寫成 JSON")
+    parser.add_argument("--seed", type=int, default=42)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    if args.reply_quiet is None:
+        args.reply_quiet = args.openai_latency * 4 + 1
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    fakes = start_fakes(*profiles_from_args(args, seed=args.seed))
+    openai_server, line_server, node_server = fakes
+    proc, base = start_app(args, openai_server, line_server, node_server)
+    sampler = ProcessSampler(proc.pid)
+    sampler.start()
+
+    results = []
+    rng = random.Random(args.seed)
+    users = [SimulatedUser(i, modes[i % len(modes)], args, line_server, base + "/callback", results,
+                           random.Random(rng.random())) for i in range(args.users)]
+    start = time.monotonic()
+    try:
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        wall = time.monotonic() - start
+        try:
+            metrics_text = requests.get(base + "/metrics", timeout=5).text
+        except requests.RequestException:
+            metrics_text = None
+    finally:
+        sampler.stop()
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    report(results, wall, sampler, fakes, metrics_text, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""模型路由的離線重播評估：比較各路由與「全部走預設模型」的延遲和 token 成本
+
+用法（在 python-linebot/ 底下）：
+    python benchmarks/replay_router.py [prompts.jsonl]           # 只重算路由與成本
+    python benchmarks/replay_router.py prompts.jsonl --live      # 每則 prompt 實際打路由模型與預設模型各一次
+
+prompt 檔是 JSONL，每行 {"mode", "context", "messages"}，可以再帶錄下來的
+"model" / "latency" / "prompt_tokens" / "completion_tokens"。
+線上流量用 LLM_PROMPT_LOG=prompts.jsonl 啟動 app.py 就會錄下來；
+預設的 benchmarks/router_prompts.jsonl 是手寫的樣本。
+
+沒有 token 數的紀錄會用 context_builder 估 prompt token，回答長度依預期長度估。
+--live 可以先配合 benchmarks/loadtest/fakes.py 的假 OpenAI（OPENAI_API_BASE）演練。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import context_builder  # noqa: E402
+import llm_gateway  # noqa: E402
+import model_router  # noqa: E402
+
+PROMPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "router_prompts.jsonl")
+# 沒有紀錄時，依預期回答長度估 completion token
+COMPLETION_ESTIMATE = {"short": 80, "medium": 200, "long": 450}
+
+
+def load_prompts(path):
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                rows.append(json.loads(line))
+    return rows
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def _fmt_ms(value):
+    return "     —" if value is None else f"{value * 1000:6.0f}"
+
+
+def estimate_tokens(row, model):
+    prompt_tokens = row.get("prompt_tokens") or sum(
+        context_builder.count_message_tokens(m, model) for m in row["messages"])
+    completion_tokens = row.get("completion_tokens")
+    if not completion_tokens:
+        text = model_router.last_user_text(row["messages"])
+        completion_tokens = COMPLETION_ESTIMATE[model_router.expected_length(row.get("context"), text)]
+    return prompt_tokens, completion_tokens
+
+
+def call(row, model):
+    """實際打一次 GPT，回傳 (延遲, prompt token, completion token, 錯誤)"""
+    start = time.monotonic()
+    try:
+        response = llm_gateway.chat_completion(row["messages"], model=model, context=row.get("context", "replay"),
+                                               max_retries=0)
+    except Exception as e:
+        return time.monotonic() - start, None, None, type(e).__name__
+    usage = response.get("usage") or {}
+    return time.monotonic() - start, usage.get("prompt_tokens"), usage.get("completion_tokens"), None
+
+
+def evaluate(rows, live=False):
+    default_model = model_router.MODEL_TIERS[model_router.DEFAULT_TIER]["model"]
+    groups = defaultdict(lambda: {"n": 0, "model": None, "tier": None, "prompt": 0, "completion": 0,
+                                  "cost": 0.0, "cost_default": 0.0, "lat": [], "lat_default": [], "errors": 0})
+    for row in rows:
+        route = model_router.route(row["messages"], row.get("context"), mode=row.get("mode", "none"))
+        g = groups[route.name]
+        g["n"] += 1
+        g["model"], g["tier"] = route.model, route.tier
+        prompt_tokens, completion_tokens = estimate_tokens(row, route.model)
+
+        if live:
+            latency, p, c, error = call(row, route.model)
+            g["errors"] += 1 if error else 0
+            if not error:
+                g["lat"].append(latency)
+                prompt_tokens, completion_tokens = p or prompt_tokens, c or completion_tokens
+            if route.model != default_model:
+                latency, _, _, error = call(row, default_model)
+                if not error:
+                    g["lat_default"].append(latency)
+            else:
+                g["lat_default"] = g["lat"]
+        elif row.get("latency") is not None:
+            # 錄下來的延遲只屬於當時用的那個模型
+            if row.get("model") == route.model:
+                g["lat"].append(row["latency"])
+            if row.get("model") == default_model:
+                g["lat_default"].append(row["latency"])
+
+        g["prompt"] += prompt_tokens
+        g["completion"] += completion_tokens
+        g["cost"] += model_router.estimate_cost(route.model, prompt_tokens, completion_tokens) or 0.0
+        g["cost_default"] += model_router.estimate_cost(default_model, prompt_tokens, completion_tokens) or 0.0
+    return dict(groups)
+
+
+def report(groups, live):
+    print(f"=== 模型路由重播（{'實際呼叫' if live else '離線估算'}）===")
+    print(f"{'路由':<16}{'等級':<10}{'則數':>5}{'平均輸入':>9}{'平均輸出':>9}"
+          f"{'成本 $':>11}{'全用預設 $':>12}{'省下':>7}{'p50 ms':>8}{'預設p50':>8}{'p95 ms':>8}{'預設p95':>8}")
+    total, total_default = 0.0, 0.0
+    for name, g in sorted(groups.items(), key=lambda kv: -kv[1]["n"]):
+        saved = 1 - g["cost"] / g["cost_default"] if g["cost_default"] else 0.0
+        total += g["cost"]
+        total_default += g["cost_default"]
+        print(f"{name:<16}{g['tier']:<10}{g['n']:>5}{g['prompt'] / g['n']:>9.0f}{g['completion'] / g['n']:>9.0f}"
+              f"{g['cost']:>11.5f}{g['cost_default']:>12.5f}{saved:>7.0%}"
+              f"{_fmt_ms(percentile(g['lat'], 50)):>8}{_fmt_ms(percentile(g['lat_default'], 50)):>8}"
+              f"{_fmt_ms(percentile(g['lat'], 95)):>8}{_fmt_ms(percentile(g['lat_default'], 95)):>8}"
+              + (f"  錯誤 {g['errors']}" if g["errors"] else ""))
+    if total_default:
+        print(f"\n合計：路由後 ${total:.5f}，全用預設模型 ${total_default:.5f}，省下 {1 - total / total_default:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("prompts", nargs="?", default=PROMPTS)
+    parser.add_argument("--live", action="store_true", help="實際呼叫 OpenAI（會花錢）")
+    parser.add_argument("--out", help="結果另存成 JSON")
+    args = parser.parse_args()
+
+    groups = evaluate(load_prompts(args.prompts), live=args.live)
+    report(groups, args.live)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(groups, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
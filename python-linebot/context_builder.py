@@ -0,0 +1,194 @@
+import hashlib
+import os
+import re
+import threading
+from datetime import datetime, timezone
+
+import llm_gateway
+import state_store
+from worker_pool import submit
+
+try:
+    import tiktoken
+except ImportError:  # 沒裝 tiktoken 就用估算
+    tiktoken = None
+
+
+# === ⚙️ 設定 ===
+# 每個模型給 prompt 用的 token 預算（不是模型上限，是我們願意花的量）
+CONTEXT_BUDGETS = {
+    "gpt-4o": 3000,
+    "gpt-4o-mini": 3000,
+}
+CONTEXT_DEFAULT_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# 最多放幾則最近對話；要比 history_cache 的環狀緩衝小，舊訊息才會在被擠掉前先進摘要
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "12"))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "300"))
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你負責維護一位學生與 C 語言助教的對話摘要。\n"
+    "請把「目前摘要」和「新增對話」整合成一份新的摘要，保留：學生的程度、學過/卡住的觀念、做過的練習、"
+    "助教答應過或建議的下一步。用條列、繁體中文，不超過 200 字。"
+)
+
+_CJK = re.compile(r"[　-鿿가-힯＀-￯]")
+_encoders = {}
+
+
+# === 🔢 token 計數 ===
+def count_tokens(text, model=llm_gateway.DEFAULT_MODEL):
+    if not text:
+        return 0
+    if tiktoken is not None:
+        encoder = _encoders.get(model)
+        if encoder is None:
+            try:
+                encoder = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoder = tiktoken.get_encoding("o200k_base")
+            _encoders[model] = encoder
+        return len(encoder.encode(text))
+    # 估算：中日韓字大約一字一 token，其他大約四個字元一 token
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(message, model=llm_gateway.DEFAULT_MODEL):
+    return count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS
+
+
+def budget_for(model):
+    return CONTEXT_BUDGETS.get(model, CONTEXT_DEFAULT_BUDGET)
+
+
+# === 🗂️ Mongo 紀錄 → 有 role 的對話 ===
+def normalize_timestamp(value):
+    """統一成 UTC、毫秒精度的字串：本地快取是 isoformat()（+00:00、微秒），Node 回來的是 Z 結尾、毫秒"""
+    if not value:
+        return ""
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return str(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    parsed = parsed.astimezone(timezone.utc)
+    return f"{parsed:%Y-%m-%dT%H:%M:%S}.{parsed.microsecond // 1000:03d}Z"
+
+
+def turns_from_records(records):
+    """把 /get_history 的紀錄轉成 [{"role", "content", "key"}]，依時間排序"""
+    turns = []
+    stamped = [(normalize_timestamp(msg.get("timestamp")), msg) for msg in records]
+    for timestamp, msg in sorted(stamped, key=lambda pair: pair[0]):
+        for role, field in (("user", "message_text"), ("assistant", "bot_response")):
+            content = msg.get(field)
+            if not content:
+                continue
+            # 舊資料可能同一句使用者訊息存了兩次
+            if turns and turns[-1]["role"] == role and turns[-1]["content"] == content:
+                continue
+            key = hashlib.sha1(f"{timestamp}\0{role}\0{content}".encode("utf-8")).hexdigest()[:16]
+            turns.append({"role": role, "content": content, "key": key})
+    return turns
+
+
+def without_current_turn(turns, user_text):
+    """這次的提問已經先寫進快取了，要從歷史拿掉避免重複；連發合併時是最後幾則 user 訊息用換行接起來"""
+    i = len(turns)
+    while i > 0 and turns[i - 1]["role"] == "user":
+        i -= 1
+        if "\n".join(turn["content"] for turn in turns[i:]) == user_text:
+            return turns[:i]
+    return turns
+
+
+# === 📝 滾動摘要 ===
+class RollingSummaries:
+    """每位使用者一份對話摘要；只把新被擠出 prompt 的對話折進去，不會整份重做"""
+
+    def __init__(self, store=None):
+        self.store = store or state_store.make_store("summary")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        return (self.store.get(user_id) or {}).get("summary", "")
+
+    def fold_async(self, user_id, older_turns):
+        """older_turns：已經放不進 prompt 的舊對話（依時間排序）"""
+        if not older_turns:
+            return
+        with self._lock:
+            if user_id in self._pending:
+                return
+            self._pending.add(user_id)
+        if not submit(self._fold, user_id, older_turns, background=True):
+            with self._lock:
+                self._pending.discard(user_id)
+
+    def _fold(self, user_id, older_turns):
+        try:
+            entry = self.store.get(user_id) or {}
+            last_key = entry.get("last_key")
+            keys = [t["key"] for t in older_turns]
+            new_turns = older_turns[keys.index(last_key) + 1:] if last_key in keys else older_turns
+            if not new_turns:
+                return
+
+            dialogue = "\n".join(f"{'學生' if t['role'] == 'user' else '助教'}：{t['content']}" for t in new_turns)
+            current = entry.get("summary", "")
+            summary = llm_gateway.ask(
+                SUMMARY_SYSTEM_PROMPT,
+                f"目前摘要：\n{current or '（尚無）'}\n\n新增對話：\n{dialogue}",
+                context="rolling_summary",
+                max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+            )
+            with self.store.edit(user_id) as entry:
+                entry.update({"summary": summary, "last_key": new_turns[-1]["key"]})
+            print(f"📝 更新 {user_id} 的對話摘要（新增 {len(new_turns)} 則）")
+        except Exception as e:
+            print(f"❌ 對話摘要更新失敗: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(user_id)
+
+
+summaries = RollingSummaries()
+
+
+# === 🧱 組出符合預算的上下文 ===
+def build_history(user_id, system_prompt, turns, user_text, context="general", model=None):
+    """回傳要放在 system prompt 與本次提問之間的訊息（摘要 + 放得下的最近對話）
+
+    預算照這次呼叫實際會用的模型算：路由挑的模型和退回用的預設模型取小的那個。
+    """
+    models = llm_gateway.models_for([{"role": "user", "content": user_text}], context, model)
+    model = models[0]
+    budget = min(budget_for(m) for m in models)
+    used = count_tokens(system_prompt, model) + count_tokens(user_text, model) + 2 * MESSAGE_OVERHEAD_TOKENS
+
+    summary = summaries.get(user_id)
+    summary_message = None
+    if summary:
+        summary_message = {"role": "system", "content": f"先前對話摘要：\n{summary}"}
+        used += count_message_tokens(summary_message, model)
+
+    recent = []
+    for turn in reversed(turns[-CONTEXT_MAX_TURNS:]):
+        cost = count_message_tokens(turn, model)
+        if used + cost > budget:
+            break
+        recent.append(turn)
+        used += cost
+    recent.reverse()
+
+    # 沒放進 prompt 的舊對話交給背景摘要
+    older = turns[:len(turns) - len(recent)]
+    summaries.fold_async(user_id, older)
+
+    history = [summary_message] if summary_message else []
+    history += [{"role": t["role"], "content": t["content"]} for t in recent]
+    print(f"🧱 上下文：{len(recent)} 則最近對話，摘要 {'有' if summary else '無'}，約 {used}/{budget} tokens")
+    return history
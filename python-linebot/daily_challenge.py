@@ -0,0 +1,29 @@
+# === 📅 每日挑戰（Flask 與 async 兩個入口共用） ===
+# LINE multicast 一次最多 500 位收件者
+MULTICAST_CHUNK_SIZE = 500
+
+
+def format_daily_challenge(user_level, day_count, challenge_text):
+    return (
+        f"【每日挑戰 - {user_level.upper()}】\n"
+        f"#Day{day_count}\n\n"
+        f"{challenge_text}\n\n"
+        "完成後回傳給我，我幫你看看是否正確"
+    )
+
+
+def group_recipients(users):
+    """依 (等級, 天數) 分組：同一組只出一題"""
+    groups = {}
+    for user in users:
+        user_id = user.get("user_id")
+        if not user_id:
+            continue
+        key = (user.get("user_level", "beginner"), user.get("day_count", 1))
+        groups.setdefault(key, []).append(user_id)
+    return groups
+
+
+def chunks(user_ids, size=MULTICAST_CHUNK_SIZE):
+    for i in range(0, len(user_ids), size):
+        yield user_ids[i:i + size]
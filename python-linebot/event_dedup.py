@@ -0,0 +1,86 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import state_store
+
+
+# === ⚙️ 設定 ===
+WEBHOOK_DEDUP_WINDOW = float(os.getenv("WEBHOOK_DEDUP_WINDOW", "3600"))  # 秒；LINE 重送通常在這段時間內
+WEBHOOK_DEDUP_MAX = int(os.getenv("WEBHOOK_DEDUP_MAX", "50000"))        # 只有 memory:// 會用到
+WEBHOOK_DEDUP_LEASE = float(os.getenv("WEBHOOK_DEDUP_LEASE", "300"))    # 處理中的標記多久沒收尾就當作失敗
+
+
+class SeenEvents:
+    """處理過的 webhookEventId，存在共用的 state_store 裡（多個 worker 看到的是同一份）
+
+    先用 claim 佔住「處理中」（有租期），處理完才標成「處理過」留 window 秒；
+    處理失敗就刪掉標記，LINE 重送時可以再處理一次
+    """
+
+    def __init__(self, store=None, window=WEBHOOK_DEDUP_WINDOW, lease=WEBHOOK_DEDUP_LEASE):
+        self.window = window
+        self.lease = lease
+        self.store = store or state_store.make_store("webhook_event", ttl=window, max_users=WEBHOOK_DEDUP_MAX)
+        self._lock = threading.Lock()
+        self._stats = {"accepted": 0, "duplicates": 0, "redelivered": 0, "missing_id": 0, "failed": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def claim(self, event_id, redelivery=False):
+        """沒人處理過也沒人在處理回傳 True（要處理），否則 False（跳過）"""
+        if redelivery:
+            self._count("redelivered")
+        if not event_id:
+            # 舊格式沒有 id 的事件沒辦法去重，照常處理
+            self._count("missing_id")
+            self._count("accepted")
+            return True
+        if not self.store.claim(event_id, "processing", ttl=self.lease):
+            self._count("duplicates")
+            return False
+        self._count("accepted")
+        return True
+
+    def done(self, event_id):
+        if event_id:
+            self.store.set(event_id, "done", ttl=self.window)
+
+    def release(self, event_id):
+        self._count("failed")
+        if event_id:
+            self.store.delete(event_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+# === 🌐 全域共用（狀態跟著 STATE_STORE_URL，sqlite:/// 時所有 worker 共用） ===
+seen_events = SeenEvents()
+
+
+@contextmanager
+def handling(event):
+    """依 LINE 事件的 webhook_event_id / delivery_context 判斷要不要處理：
+
+        with event_dedup.handling(event) as fresh:
+            if not fresh:
+                return  # 重複的事件
+            ...
+
+    區塊正常結束才算處理過；丟出例外就把標記拿掉，讓重送的事件可以再處理
+    """
+    event_id = getattr(event, "webhook_event_id", None)
+    delivery = getattr(event, "delivery_context", None)
+    if not seen_events.claim(event_id, bool(getattr(delivery, "is_redelivery", False))):
+        yield False
+        return
+    try:
+        yield True
+    except BaseException:
+        seen_events.release(event_id)
+        raise
+    seen_events.done(event_id)
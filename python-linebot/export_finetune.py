@@ -0,0 +1,269 @@
+"""把 node-mongodb 裡的真實對話匯出成微調用的 JSONL 分片
+
+    python export_finetune.py --out finetune_data/
+    python export_finetune.py --out finetune_data/ --shard-bytes 20000000 --context-turns 2
+
+- 從 /export_messages 依 _id 一頁一頁往後讀（NDJSON 串流），記憶體用量跟資料量無關
+- 同一位使用者的「使用者訊息 → 助教回覆」配成一筆 chat 格式的訓練資料
+- 模式切換指令、「已切換至」之類的系統訊息不會進訓練資料
+- 依內容雜湊去重；分片超過 --shard-bytes 就換下一個檔案
+- 進度（游標、目前分片與位移、去重雜湊、還沒配對到的使用者訊息）都存在 <out>/export_state.sqlite，
+  每頁一個交易；中斷後重跑會從上次的位置接著做，之後有新訊息也只會匯出新的部分
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import requests
+
+import intents
+from modes import MODE_MAP
+from persistence import NODE_SERVER_URL, make_session
+
+
+# === ⚙️ 設定 ===
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+EXPORT_SHARD_BYTES = int(os.getenv("EXPORT_SHARD_BYTES", str(50 * 1024 * 1024)))
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+EXPORT_SYSTEM_PROMPT = os.getenv(
+    "EXPORT_SYSTEM_PROMPT", "你是一位親切、有耐心的 C 語言助教，會用簡單的方式解釋並引導學生思考。")
+MIN_ASSISTANT_CHARS = 2
+
+
+def is_noise(text):
+    """模式切換指令與系統訊息（跟 handlers/interactive.py 判斷不列入互動次數的規則一樣）"""
+    text = (text or "").strip()
+    return not text or text in MODE_MAP or intents.classify(text).has("mode_switch")
+
+
+def content_hash(messages):
+    raw = json.dumps([[m["role"], " ".join(m["content"].split())] for m in messages], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# === 💾 進度（SQLite：游標、分片位置、去重雜湊、待配對訊息同一個交易提交） ===
+class ExportState:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS seen (hash TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS pending (user_id TEXT PRIMARY KEY, turns TEXT NOT NULL);
+        """)
+        self.db.commit()
+
+    def get(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def add_hash(self, digest):
+        """第一次看到回傳 True"""
+        return self.db.execute("INSERT OR IGNORE INTO seen (hash) VALUES (?)", (digest,)).rowcount == 1
+
+    def load_pending(self, user_id):
+        row = self.db.execute("SELECT turns FROM pending WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_pending(self, user_id, turns):
+        if turns:
+            self.db.execute("INSERT OR REPLACE INTO pending (user_id, turns) VALUES (?, ?)",
+                            (user_id, json.dumps(turns, ensure_ascii=False)))
+        else:
+            self.db.execute("DELETE FROM pending WHERE user_id = ?", (user_id,))
+
+    def commit(self):
+        self.db.commit()
+
+
+# === 📦 分片寫入 ===
+class ShardWriter:
+    """寫到 <out>/shard-00000.jsonl；超過上限就換下一片。位移跟著進度一起提交，重跑時截掉沒提交的尾巴"""
+
+    def __init__(self, out_dir, max_bytes, index=0, offset=0):
+        self.out_dir = out_dir
+        self.max_bytes = max_bytes
+        self.index = index
+        self.offset = offset
+        self._file = None
+        self._open()
+
+    def _path(self):
+        return os.path.join(self.out_dir, f"shard-{self.index:05d}.jsonl")
+
+    def _open(self):
+        path = self._path()
+        self._file = open(path, "ab")
+        if self._file.tell() != self.offset:
+            self._file.truncate(self.offset)
+            self._file.seek(self.offset)
+
+    def write(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        if self.offset and self.offset + len(line) > self.max_bytes:
+            self._file.close()
+            self.index += 1
+            self.offset = 0
+            self._open()
+        self._file.write(line)
+        self.offset += len(line)
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+# === 🔗 配對 ===
+class Pairer:
+    """依 _id 順序餵訊息，回傳配好的訓練資料；待配對的狀態只留目前這頁用到的使用者，其他放在 SQLite"""
+
+    def __init__(self, state, context_turns=0):
+        self.state = state
+        self.context_turns = context_turns
+        self._page = {}  # user_id → {"question": str | None, "history": [[q, a], ...]}
+
+    def _get(self, user_id):
+        entry = self._page.get(user_id)
+        if entry is None:
+            entry = self.state.load_pending(user_id) or {"question": None, "history": []}
+            self._page[user_id] = entry
+        return entry
+
+    def feed(self, doc):
+        user_id = doc.get("user_id")
+        if not user_id:
+            return None
+        entry = self._get(user_id)
+        if doc.get("message_text"):
+            text = doc["message_text"].strip()
+            # 模式切換會換掉整段情境，前面的問題跟上下文都不要了
+            if is_noise(text):
+                entry.update({"question": None, "history": []})
+            else:
+                entry["question"] = text
+            return None
+
+        answer = (doc.get("bot_response") or "").strip()
+        question = entry["question"]
+        if not question or len(answer) < MIN_ASSISTANT_CHARS or is_noise(answer):
+            return None  # 沒有對應提問的推播（每日挑戰、主動出題）或系統訊息
+        entry["question"] = None
+
+        messages = [{"role": "system", "content": EXPORT_SYSTEM_PROMPT}]
+        for q, a in entry["history"][-self.context_turns:] if self.context_turns else []:
+            messages += [{"role": "user", "content": q}, {"role": "assistant", "content": a}]
+        messages += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+        if self.context_turns:
+            entry["history"] = (entry["history"] + [[question, answer]])[-self.context_turns:]
+        return {"messages": messages}
+
+    def end_page(self):
+        for user_id, entry in self._page.items():
+            self.state.save_pending(user_id, entry if entry["question"] or entry["history"] else None)
+        self._page = {}
+
+
+# === 🌐 讀取 ===
+def fetch_page(session, base_url, after, limit):
+    """逐行 yield 一頁的訊息（NDJSON 串流，不會整頁讀進記憶體）"""
+    params = {"limit": limit}
+    if after:
+        params["after"] = after
+    headers = {"X-Export-Token": EXPORT_TOKEN} if EXPORT_TOKEN else {}
+    with session.get(f"{base_url}/export_messages", params=params, headers=headers,
+                     stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def export(out_dir, base_url=NODE_SERVER_URL, page_size=EXPORT_PAGE_SIZE, shard_bytes=EXPORT_SHARD_BYTES,
+           context_turns=0, max_pages=None, retries=3):
+    os.makedirs(out_dir, exist_ok=True)
+    state = ExportState(os.path.join(out_dir, "export_state.sqlite"))
+    writer = ShardWriter(out_dir, shard_bytes, state.get("shard", 0), state.get("offset", 0))
+    pairer = Pairer(state, context_turns)
+    session = make_session(1)
+    after = state.get("after")
+    totals = state.get("totals", {"messages": 0, "written": 0, "duplicates": 0})
+    pages = 0
+    start = time.monotonic()
+
+    try:
+        while max_pages is None or pages < max_pages:
+            for attempt in range(retries):
+                try:
+                    docs, written, duplicates, last_id = 0, 0, 0, after
+                    for doc in fetch_page(session, base_url, after, page_size):
+                        docs += 1
+                        last_id = doc["_id"]
+                        record = pairer.feed(doc)
+                        if record is None:
+                            continue
+                        if state.add_hash(content_hash(record["messages"])):
+                            writer.write(record)
+                            written += 1
+                        else:
+                            duplicates += 1
+                    break
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    # 這頁讀到一半斷線：丟掉這頁的所有變更，從同一個游標重讀
+                    print(f"❌ 讀取匯出頁面失敗 ({attempt + 1}/{retries}): {e}")
+                    state.db.rollback()
+                    pairer._page = {}
+                    writer.close()
+                    writer = ShardWriter(out_dir, shard_bytes, state.get("shard", 0), state.get("offset", 0))
+                    if attempt == retries - 1:
+                        raise
+                    time.sleep(2 ** attempt)
+            if docs == 0:
+                break
+
+            # 一頁一個交易：分片先寫到磁碟，再一起提交游標、位移、雜湊與待配對訊息
+            pairer.end_page()
+            writer.flush()
+            after = last_id
+            totals["messages"] += docs
+            totals["written"] += written
+            totals["duplicates"] += duplicates
+            state.set("after", after)
+            state.set("shard", writer.index)
+            state.set("offset", writer.offset)
+            state.set("totals", totals)
+            state.commit()
+            pages += 1
+            print(f"📦 第 {pages} 頁：{docs} 則訊息，寫出 {written} 筆，重複 {duplicates} 筆（游標 {after}）")
+            if docs < page_size:
+                break
+    finally:
+        writer.close()
+
+    print(f"✅ 匯出完成：本次 {pages} 頁，累計 {totals['messages']} 則訊息 → {totals['written']} 筆訓練資料"
+          f"（重複 {totals['duplicates']} 筆），最後分片 shard-{writer.index:05d}.jsonl，"
+          f"{time.monotonic() - start:.1f}s")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default="finetune_data", help="輸出資料夾（進度檔也放在這裡）")
+    parser.add_argument("--node-url", default=NODE_SERVER_URL)
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+    parser.add_argument("--shard-bytes", type=int, default=EXPORT_SHARD_BYTES)
+    parser.add_argument("--context-turns", type=int, default=0, help="每筆訓練資料前面帶幾輪之前的對話")
+    parser.add_argument("--max-pages", type=int, help="最多讀幾頁（分批跑用）")
+    args = parser.parse_args()
+    export(args.out, args.node_url, args.page_size, args.shard_bytes, args.context_turns, args.max_pages)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,51 +12,39 @@ import datetime
 import time
 import string
 
-import os
-
-# 升級 openai 庫
-os.system('pip install openai --upgrade')
-
-# 使用 curl 下載 clinic_qa.json 文件
-# os.system('curl -o clinic_qa.json -L https://github.com/Hsiang-Tang/gpt-3.5_fine_tune/raw/main/clinic_qa.json')
-
-import openai
-
-# 設置您的 OpenAI API 金鑰
-openai.api_key = os.getenv("OPENAI_API_KEY")
+import llm_gateway
+import model_router
 
-# 創建聊天完成
-completion = openai.ChatCompletion.create(
-  model="gpt-4o",
-  messages=[
-    {"role": "user", "content": "Write a C program binary"}, 
-    {"role": "assistant", "content": "#include \"search_algos.h\"\n\n/**\n * recursive_search - searches for a value in an array of\n * integers using the Binary search algorithm\n *\n *\n * @array: input array\n * @size: size of the array\n * @value: value to search in\n * Return: index of the number\n */\nint recursive_search(int *array, size_t size, int value)\n{\n\tsize_t half = size / 2;\n\tsize_t i;\n\n\tif (array == NULL || size == 0)\n\t\treturn (-1);\n\n\tprintf(\"Searching in array\");\n\n\tfor (i = 0; i < size; i++)\n\t\tprintf(\"%s %d\", (i == 0) ? \":\" : \",\", array[i]);\n\n\tprintf(\"\\n\");\n\n\tif (half && size % 2 == 0)\n\t\thalf--;\n\n\tif (value == array[half])\n\t\treturn ((int)half);\n\n\tif (value < array[half])\n\t\treturn (recursive_search(array, half, value));\n\n\thalf++;\n\n\treturn (recursive_search(array + half, size - half, value) + half);\n}\n\n/**\n * binary_search - calls to binary_search to return\n * the index of the number\n *\n * @array: input array\n * @size: size of the array\n * @value: value to search in\n * Return: index of the number\n */\nint binary_search(int *array, size_t size, int value)\n{\n\tint index;\n\n\tindex = recursive_search(array, size, value);\n\n\tif (index >= 0 && array[index] != value)\n\t\treturn (-1);\n\n\treturn (index);\n}"}
-  ]
-)
-
-print(completion.choices[0].message.content)
-
-# 創建帶有 fine-tuned 模型的聊天完成
-completion2 = openai.ChatCompletion.create(
-  model="ft:gpt-4o-2024-08-06:personal::B5sbnkYa",
-  messages=[
-    {"role": "user", "content": "Write a C program based binary"}, 
-    {"role": "assistant", "content": "```c\n#include \"search_algos.h\"\n\n/**\n * recursive_search - searches for a value in an array of\n * integers using the Binary search algorithm\n *\n * @array: input array\n * @size: size of the array\n * @value: value to search in\n * Return: index of the number\n */\nint recursive_search(int *array, size_t size, int value)\n{\n\tsize_t half = size / 2;\n\tsize_t i;\n\n\tif (array == NULL || size == 0)\n\t\treturn (-1);\n\n\tprintf(\"Searching in array\");\n\n\tfor (i = 0; i < size; i++)\n\t\tprintf(\"%s %d\", (i == 0) ? \":\" : \",\", array[i]);\n\n\tprintf(\"\\n\");\n\n\tif (half && size % 2 == 0)\n\t\thalf--;\n\n\tif (value == array[half])\n\t\treturn ((int)half);\n\n\tif (value < array[half])\n\t\treturn (recursive_search(array, half, value));\n\n\thalf++;\n\n\treturn (recursive_search(array + half, size - half, value) + half);\n}\n\n/**\n * binary_search - searches for a value in an array of\n * integers using the Binary search algorithm\n *\n * @array: input array\n * @size: size of the array\n * @value: value to search in\n * Return: index of the number\n */\nint binary_search(int *array, size_t size, int value)\n{\n\tint index;\n\n\tindex = recursive_search(array, size, value);\n\n\tif (index >= 0 && array[index] != value)\n\t\treturn (-1);\n\n\treturn (index);\n}\n```"}
-  ]
-)
-
-print(completion2.choices[0].message.content)
+# 微調過的模型（用 C 程式範例訓練）；模型路由的 "finetuned" 等級也是用這個
+FINETUNED_MODEL = model_router.MODEL_TIERS["finetuned"]["model"]
 
 
 def GPT_response(text):
-    response = openai.ChatCompletion.create(
-        model="ft:gpt-4o-2024-08-06:personal::B5sbnkYa",
-        messages=[
-            {"role": "user", "content": text}
-        ]
+    answer = llm_gateway.chat(
+        [{"role": "user", "content": text}],
+        model=FINETUNED_MODEL,
+        context="finetuned"
     )
-
-    answer = response.choices[0].message.content.strip()  # 移除首尾多餘空行
     answer = answer.replace("\n\n", "\n")  # 移除連續空行
 
     return answer
+
+
+# 手動測試：比較一般模型與微調模型（import 時不會執行，也不會再自動 pip install）
+#     python finetuning.py
+if __name__ == "__main__":
+    # 使用 curl 下載 clinic_qa.json 文件
+    # os.system('curl -o clinic_qa.json -L https://github.com/Hsiang-Tang/gpt-3.5_fine_tune/raw/main/clinic_qa.json')
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+
+    # 創建聊天完成
+    print(llm_gateway.chat([
+        {"role": "user", "content": "Write a C program binary"}, 
+        {"role": "assistant", "content": "#include \"search_algos.h\"\n\n/**\n * recursive_search - searches for a value in an array of\n * integers using the Binary search algorithm\n *\n *\n * @array: input array\n * @size: size of the array\n * @value: value to search in\n * Return: index of the number\n */\nint recursive_search(int *array, size_t size, int value)\n{\n\tsize_t half = size / 2;\n\tsize_t i;\n\n\tif (array == NULL || size == 0)\n\t\treturn (-1);\n\n\tprintf(\"Searching in array\");\n\n\tfor (i = 0; i < size; i++)\n\t\tprintf(\"%s %d\", (i == 0) ? \":\" : \",\", array[i]);\n\n\tprintf(\"\\n\");\n\n\tif (half && size % 2 == 0)\n\t\thalf--;\n\n\tif (value == array[half])\n\t\treturn ((int)half);\n\n\tif (value < array[half])\n\t\treturn (recursive_search(array, half, value));\n\n\thalf++;\n\n\treturn (recursive_search(array + half, size - half, value) + half);\n}\n\n/**\n * binary_search - calls to binary_search to return\n * the index of the number\n *\n * @array: input array\n * @size: size of the array\n * @value: value to search in\n * Return: index of the number\n */\nint binary_search(int *array, size_t size, int value)\n{\n\tint index;\n\n\tindex = recursive_search(array, size, value);\n\n\tif (index >= 0 && array[index] != value)\n\t\treturn (-1);\n\n\treturn (index);\n}"}
+    ], model=model_router.MODEL_TIERS["default"]["model"], context="finetune_demo"))
+
+    # 創建帶有 fine-tuned 模型的聊天完成
+    print(llm_gateway.chat([
+        {"role": "user", "content": "Write a C program based binary"}, 
+        {"role": "assistant", "content": "```c\n#include \"search_algos.h\"\n\n/**\n * recursive_search - searches for a value in an array of\n * integers using the Binary search algorithm\n *\n * @array: input array\n * @size: size of the array\n * @value: value to search in\n * Return: index of the number\n */\nint recursive_search(int *array, size_t size, int value)\n{\n\tsize_t half = size / 2;\n\tsize_t i;\n\n\tif (array == NULL || size == 0)\n\t\treturn (-1);\n\n\tprintf(\"Searching in array\");\n\n\tfor (i = 0; i < size; i++)\n\t\tprintf(\"%s %d\", (i == 0) ? \":\" : \",\", array[i]);\n\n\tprintf(\"\\n\");\n\n\tif (half && size % 2 == 0)\n\t\thalf--;\n\n\tif (value == array[half])\n\t\treturn ((int)half);\n\n\tif (value < array[half])\n\t\treturn (recursive_search(array, half, value));\n\n\thalf++;\n\n\treturn (recursive_search(array + half, size - half, value) + half);\n}\n\n/**\n * binary_search - searches for a value in an array of\n * integers using the Binary search algorithm\n *\n * @array: input array\n * @size: size of the array\n * @value: value to search in\n * Return: index of the number\n */\nint binary_search(int *array, size_t size, int value)\n{\n\tint index;\n\n\tindex = recursive_search(array, size, value);\n\n\tif (index >= 0 && array[index] != value)\n\t\treturn (-1);\n\n\treturn (index);\n}\n```"}
+    ], model=FINETUNED_MODEL, context="finetune_demo"))
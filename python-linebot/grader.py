@@ -0,0 +1,529 @@
+import json
+import os
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+import metrics
+import state_store
+from similarity import fingerprint
+
+
+# === ⚙️ 設定 ===
+GRADER_ENABLED = os.getenv("GRADER_ENABLED", "1") == "1"
+GRADER_CC = os.getenv("GRADER_CC", "gcc")
+GRADER_CFLAGS = os.getenv("GRADER_CFLAGS", "-std=c11 -O1 -Wall -Wextra -fdiagnostics-color=never").split()
+GRADER_CONCURRENCY = int(os.getenv("GRADER_CONCURRENCY", str(os.cpu_count() or 2)))  # 同時編譯 / 執行幾份
+GRADER_QUEUE_TIMEOUT = float(os.getenv("GRADER_QUEUE_TIMEOUT", "2"))    # 排不到就交回原本的 GPT 流程
+GRADER_COMPILE_TIMEOUT = float(os.getenv("GRADER_COMPILE_TIMEOUT", "5"))
+GRADER_COMPILE_MEMORY_MB = int(os.getenv("GRADER_COMPILE_MEMORY_MB", "512"))
+GRADER_RUN_TIMEOUT = float(os.getenv("GRADER_RUN_TIMEOUT", "1"))        # 每組測資的牆鐘時間
+GRADER_RUN_CPU_SECONDS = int(os.getenv("GRADER_RUN_CPU_SECONDS", "1"))
+GRADER_RUN_MEMORY_MB = int(os.getenv("GRADER_RUN_MEMORY_MB", "128"))
+GRADER_MAX_PROCS = int(os.getenv("GRADER_MAX_PROCS", "16"))            # 學生程式最多再開幾個行程（擋 fork bomb）
+GRADER_SANDBOX_UID = int(os.getenv("GRADER_SANDBOX_UID", "65534"))     # 以 root 啟動時，學生程式改用這個 uid / gid 跑
+GRADER_ALLOW_UNSANDBOXED = os.getenv("GRADER_ALLOW_UNSANDBOXED", "0") == "1"  # 開不了沙箱時是否照樣執行（只給本機開發用）
+GRADER_OUTPUT_LIMIT = int(os.getenv("GRADER_OUTPUT_LIMIT", str(64 * 1024)))  # stdout 超過就當執行錯誤
+GRADER_MAX_SOURCE = int(os.getenv("GRADER_MAX_SOURCE", "20000"))
+GRADER_MAX_TESTS = int(os.getenv("GRADER_MAX_TESTS", "8"))
+GRADER_ASSIGNMENT_TTL = float(os.getenv("GRADER_ASSIGNMENT_TTL", str(24 * 3600)))  # 每日挑戰多久內交都算
+GRADER_RESUBMIT_WINDOW = float(os.getenv("GRADER_RESUBMIT_WINDOW", "1800"))        # 沒過的話，這段時間內可以再交
+GRADER_DIAGNOSTICS_CHARS = 1200
+
+
+# === 🔍 辨識訊息裡的程式碼 ===
+_FENCE = re.compile(r"```[a-zA-Z+]*\n?(.*?)```", re.S)
+_STRONG_SIGNALS = re.compile(r"#\s*include\s*[<\"]|\bint\s+main\s*\(|\bvoid\s+main\s*\(")
+_WEAK_SIGNALS = (re.compile(r"\b(printf|scanf|puts|putchar|getchar|malloc)\s*\("),
+                 re.compile(r"\b(for|while|if)\s*\(.*\)"),
+                 re.compile(r"\breturn\b[^;]*;"),
+                 re.compile(r"\b(int|char|float|double|long)\s+\**\w+\s*[=;\[,)]"))
+
+
+def extract_code(text):
+    """看起來像 C 程式就回傳原始碼（去掉 ``` 圍欄），否則回傳 None"""
+    if not text or len(text) > GRADER_MAX_SOURCE:
+        return None
+    fenced = _FENCE.search(text)
+    code = fenced.group(1) if fenced else text
+    if "{" not in code or ";" not in code:
+        return None
+    if _STRONG_SIGNALS.search(code) or sum(1 for p in _WEAK_SIGNALS if p.search(code)) >= 3:
+        return code.strip() + "\n"
+    return None
+
+
+# === 🧪 題目的測資（跟題目一起存，依題目指紋查） ===
+# challenge:            題目指紋 → {"question", "tests": [{"input", "output"}]}
+# challenge_assignment: user_id → {"fingerprint", "expires_at"}：最近收到、還沒交過的每日挑戰
+challenges = state_store.make_store("challenge")
+assignments = state_store.make_store("challenge_assignment")
+
+
+def normalize_tests(tests):
+    cleaned = []
+    for test in tests or []:
+        if not isinstance(test, dict) or not isinstance(test.get("output"), str):
+            continue
+        stdin = test.get("input", "")
+        cleaned.append({"input": stdin if isinstance(stdin, str) else "", "output": test["output"]})
+    return cleaned[:GRADER_MAX_TESTS]
+
+
+def register(question, tests):
+    tests = normalize_tests(tests)
+    if tests:
+        challenges.set(fingerprint(question), {"question": question, "tests": tests})
+    return tests
+
+
+def tests_for(question):
+    entry = challenges.get(fingerprint(question)) if question else None
+    return entry["tests"] if entry else None
+
+
+def assign(user_ids, question):
+    """每日挑戰送出後記下每位收件者拿到哪一題；只有有測資的題目才需要記"""
+    if not tests_for(question):
+        return
+    assignment = {"fingerprint": fingerprint(question), "expires_at": time.time() + GRADER_ASSIGNMENT_TTL}
+    for user_id in user_ids:
+        assignments.set(user_id, assignment)
+
+
+def challenge_for(user_id, question=None):
+    """找這份程式要對哪一題的測資
+
+    主動模式有題目就只看那一題（沒有測資就不評分，不會拿不相干的每日挑戰來比）；
+    沒有的話才看最近收到、還沒過期的每日挑戰，回傳的 dict 會帶 assigned=True。
+    """
+    if question:
+        return challenges.get(fingerprint(question))
+    assignment = assignments.get(user_id)
+    if not isinstance(assignment, dict):
+        return None
+    if assignment["expires_at"] <= time.time():
+        assignments.delete(user_id)
+        return None
+    entry = challenges.get(assignment["fingerprint"])
+    return dict(entry, assigned=True) if entry else None
+
+
+def settle(user_id, challenge, result):
+    """每日挑戰評完分：過了就清掉；沒過只留一小段時間讓學生改完再交，之後一般訊息不再被當成作答"""
+    if not challenge.get("assigned"):
+        return
+    if result.passed:
+        assignments.delete(user_id)
+        return
+    with assignments.edit(user_id) as assignment:
+        if assignment.get("expires_at"):
+            assignment["expires_at"] = min(assignment["expires_at"], time.time() + GRADER_RESUBMIT_WINDOW)
+
+
+def match_submission(user_id, user_text, question=None):
+    """(程式碼, 題目) 或 None：不像程式、或找不到有測資的題目就不評分"""
+    if not GRADER_ENABLED:
+        return None
+    code = extract_code(user_text)
+    if code is None:
+        return None
+    challenge = challenge_for(user_id, question)
+    return (code, challenge) if challenge else None
+
+
+# === 📝 出題時順便產生測資 ===
+GENERATE_TESTS_INSTRUCTIONS = (
+    "請只輸出一個 JSON 物件，不要有其他文字：\n"
+    '{"question": "題目敘述（含輸入輸出格式）", "solution": "完整可編譯的 C 參考解答", '
+    '"tests": [{"input": "stdin 內容", "output": "預期 stdout"}]}\n'
+    "程式從標準輸入讀資料、把結果印到標準輸出，tests 給 3 到 5 組（含邊界情況）。"
+)
+_JSON_OBJECT = re.compile(r"\{.*\}", re.S)
+
+
+def parse_generated(raw):
+    """拆出 (題目, 參考解答, 測資)；GPT 沒照格式就整段當題目、沒有測資"""
+    match = _JSON_OBJECT.search(raw or "")
+    try:
+        data = json.loads(match.group(0)) if match else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("question"), str):
+        return (raw or "").strip(), None, []
+    solution = data.get("solution") if isinstance(data.get("solution"), str) else None
+    return data["question"].strip(), solution, normalize_tests(data.get("tests"))
+
+
+def verified_tests(solution, tests):
+    """只留參考解答自己也過得了的測資，GPT 算錯的預期輸出不拿來為難學生"""
+    if not solution or not tests:
+        return []
+    result = grader.grade(solution, tests)
+    if result is None or result.status == "compile_error":
+        return []
+    return [test for test, case in zip(tests, result.cases) if case["passed"]]
+
+
+# === 🏗️ 編譯 + 執行（gcc，每個行程都有 CPU / 記憶體 / 檔案大小上限） ===
+def _user_process_count(uid):
+    """這個 uid 目前有幾個行程 / 執行緒（RLIMIT_NPROC 算的是整個使用者，不是單一行程樹）"""
+    count = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                fields = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        if int(fields.get("Uid", "-1").split()[0]) == uid:
+            count += int(fields.get("Threads", "1"))
+    return count
+
+
+def _limits(cpu_seconds, memory_mb, file_bytes, max_procs=None, uid=None):
+    # NPROC 要在父行程先算好：上限 = 執行身分目前的用量 + 允許新開的數量（root 不受 NPROC 限制）
+    if max_procs is not None:
+        uid = os.getuid() if uid is None else uid
+        nproc = _user_process_count(uid) + max_procs
+    else:
+        nproc = None
+
+    def apply():
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+        resource.setrlimit(resource.RLIMIT_AS, (memory_mb << 20, memory_mb << 20))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (file_bytes, file_bytes))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        if nproc is not None:
+            resource.setrlimit(resource.RLIMIT_NPROC, (nproc, nproc))
+    return apply
+
+
+# 沙箱：新的 mount / network / PID / IPC / UTS namespace，裡面再搭一個最小的根目錄：
+# 唯讀的 /usr（/bin、/lib 這些是連結就照做連結）、只有 null / zero / urandom 的 /dev、
+# 這個 namespace 自己的 /proc、空的 /tmp 和 /work（都是 tmpfs），根目錄本身也是唯讀的。
+# 學生程式在 /work 裡以空的環境變數執行，所有 capability 都拿掉；以 root 啟動時再換成 GRADER_SANDBOX_UID。
+# 看不到主機的檔案、其他行程（包括 /proc/*/environ 裡的金鑰），也連不出去（只有一個沒啟用的 lo）。
+# PID namespace 的 init 就是學生程式，它一結束核心會把裡面剩下的行程全部殺掉，setsid / 兩次 fork 都逃不掉。
+_SANDBOX_NAMESPACES = ["unshare", "--mount", "--net", "--pid", "--ipc", "--uts", "--fork", "--kill-child",
+                       "--mount-proc"]
+_SANDBOX_SETUP = r"""
+set -e
+dir=$1; drop=$2; uid=$3; shift 3
+root=$dir/root
+mount -t tmpfs -o mode=755,nosuid,nodev,size=1m tmpfs "$root"
+for d in /usr /bin /sbin /lib /lib32 /lib64 /libx32; do
+    if [ -L "$d" ]; then
+        ln -s "$(readlink "$d")" "$root$d"
+    elif [ -d "$d" ]; then
+        mkdir "$root$d"
+        mount --rbind "$d" "$root$d"
+        mount -o remount,bind,ro,nosuid,nodev "$root$d"
+    fi
+done
+mkdir "$root/dev" "$root/proc" "$root/tmp" "$root/work"
+for f in null zero urandom; do
+    touch "$root/dev/$f"
+    mount --bind "/dev/$f" "$root/dev/$f"
+done
+mount -t proc -o nosuid,nodev,noexec proc "$root/proc"
+mount -t tmpfs -o mode=1777,nosuid,nodev,size=8m tmpfs "$root/tmp"
+mount -t tmpfs -o mode=1777,nosuid,nodev,size=8m tmpfs "$root/work"
+touch "$root/work/prog"
+mount --bind "$dir/prog" "$root/work/prog"
+mount -o remount,bind,ro,nosuid,nodev "$root/work/prog"
+mount -o remount,ro "$root"
+if [ "$drop" = 1 ]; then
+    set -- --reuid="$uid" --regid="$uid" --clear-groups -- "$@"
+else
+    set -- -- "$@"
+fi
+exec chroot "$root" /usr/bin/env -i -C /work /usr/bin/setpriv --no-new-privs --inh-caps=-all --bounding-set=-all "$@"
+"""
+
+
+def _detect_sandbox():
+    """回傳 (unshare 參數, 要不要換 uid)：root 直接開 namespace 並換成 GRADER_SANDBOX_UID；
+    不是 root 就包一層 user namespace（本來就不是 bot 以外的身分，不用再換）。都開不了回傳 None"""
+    candidates = [(_SANDBOX_NAMESPACES, True)] if os.getuid() == 0 else []
+    candidates.append((["unshare", "--user", "--map-root-user"] + _SANDBOX_NAMESPACES[1:], False))
+    true_path = shutil.which("true")
+    with tempfile.TemporaryDirectory(prefix="grader-probe-") as workdir:
+        shutil.copy(true_path, os.path.join(workdir, "prog"))
+        os.mkdir(os.path.join(workdir, "root"))
+        for sandbox in candidates:
+            try:
+                returncode = subprocess.run(_sandboxed(sandbox, workdir, ["./prog"]), capture_output=True,
+                                            env=_SANDBOX_ENV, timeout=5).returncode
+            except (OSError, subprocess.TimeoutExpired):
+                continue
+            if returncode == 0:
+                return sandbox
+    print("⚠️ 無法建立評分沙箱（unshare / mount / setpriv），學生程式不會在本機執行")
+    return None
+
+
+_SANDBOX_ENV = {"PATH": "/usr/sbin:/usr/bin:/sbin:/bin"}  # 只給沙箱的 setup 用，學生程式拿到的是空的
+
+
+def _sandboxed(sandbox, workdir, argv):
+    namespaces, drop = sandbox
+    return namespaces + ["sh", "-c", _SANDBOX_SETUP, "grader-sandbox", workdir,
+                         "1" if drop else "0", str(GRADER_SANDBOX_UID)] + argv
+
+
+def _kill_marked(marker):
+    """沒有沙箱時（GRADER_ALLOW_UNSANDBOXED）的收尾：環境變數裡帶著這次標記的行程（脫離 process group 的也算）全部殺掉"""
+    needle = marker.encode()
+    for _ in range(50):
+        # 掃的途中可能又 fork 出新的，掃到一輪都沒有才算收乾淨
+        killed = 0
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f"/proc/{pid}/environ", "rb") as f:
+                    if needle in f.read():
+                        os.kill(int(pid), signal.SIGKILL)
+                        killed += 1
+            except OSError:
+                continue
+        if not killed:
+            return
+
+
+def _run(argv, cwd, limits, timeout, stdin=b"", sandbox=None):
+    """在 cwd 裡執行，stdout / stderr 寫到檔案（檔案大小有上限）；回傳 (returncode, stdout, stderr, 是否逾時)
+
+    sandbox：_detect_sandbox() 的結果，argv 是 cwd 裡的 ./prog；空 list 代表不隔離（編譯用，環境變數只留 PATH），
+    None 代表沒有沙箱（GRADER_ALLOW_UNSANDBOXED）、結束後掃 /proc 收尾。
+    """
+    out_path, err_path = os.path.join(cwd, "stdout"), os.path.join(cwd, "stderr")
+    marker = None
+    if sandbox:
+        os.makedirs(os.path.join(cwd, "root"), exist_ok=True)
+        command, env = _sandboxed(sandbox, cwd, argv), _SANDBOX_ENV
+    elif sandbox is None:
+        # 不帶任何主機的環境變數（金鑰都在裡面），只留收尾用的標記
+        token = uuid.uuid4().hex
+        marker = f"GRADER_RUN={token}"
+        command, env = argv, {"GRADER_RUN": token}
+    else:
+        command, env = argv, {"PATH": os.environ.get("PATH", "/usr/bin:/bin"), "LC_ALL": "C"}
+    with open(out_path, "wb") as out, open(err_path, "wb") as err:
+        proc = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=out, stderr=err,
+                                env=env, preexec_fn=limits, start_new_session=True, close_fds=True)
+        timed_out = False
+        try:
+            proc.communicate(stdin, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        except BrokenPipeError:
+            pass  # 程式沒讀完 stdin 就結束了
+        finally:
+            # 整個 process group 一起收掉，fork 出去的子行程也不留
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+            if marker:
+                _kill_marked(marker)
+    with open(out_path, "rb") as f:
+        stdout = f.read(GRADER_OUTPUT_LIMIT + 1)
+    with open(err_path, "rb") as f:
+        stderr = f.read(GRADER_OUTPUT_LIMIT)
+    return proc.returncode, stdout, stderr, timed_out
+
+
+def _normalize_output(text):
+    return "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").strip().split("\n"))
+
+
+def _signal_name(returncode):
+    try:
+        return signal.Signals(-returncode).name
+    except ValueError:
+        return f"signal {-returncode}"
+
+
+class GradeResult:
+    __slots__ = ("status", "diagnostics", "cases", "total", "compile_seconds", "run_seconds")
+
+    def __init__(self, status, diagnostics="", cases=None, total=0, compile_seconds=0.0, run_seconds=0.0):
+        self.status = status  # passed / failed / compile_error
+        self.diagnostics = diagnostics
+        self.cases = cases or []  # 逾時之後的測資不再跑，所以可能比 total 少
+        self.total = total
+        self.compile_seconds = compile_seconds
+        self.run_seconds = run_seconds
+
+    @property
+    def passed(self):
+        return self.status == "passed"
+
+    @property
+    def passed_count(self):
+        return sum(1 for case in self.cases if case["passed"])
+
+    def first_failure(self):
+        return next((case for case in self.cases if not case["passed"]), None)
+
+
+class Grader:
+    """本機 gcc 評分：同時最多 concurrency 份，編譯與每組測資各自一個受限的子行程"""
+
+    def __init__(self, cc=GRADER_CC, cflags=GRADER_CFLAGS, concurrency=GRADER_CONCURRENCY,
+                 queue_timeout=GRADER_QUEUE_TIMEOUT):
+        self.cc = cc
+        self.cflags = cflags
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._sandbox = None
+        self._sandbox_checked = False
+        self._stats = {"graded": 0, "passed": 0, "failed": 0, "compile_error": 0, "busy": 0, "no_sandbox": 0,
+                       "timeouts": 0, "seconds_total": 0.0, "seconds_max": 0.0}
+
+    def _diagnostics(self, stderr, workdir):
+        text = stderr.decode("utf-8", "replace").replace(workdir + os.sep, "")
+        return text[:GRADER_DIAGNOSTICS_CHARS].strip()
+
+    def _sandbox_prefix(self):
+        """第一次評分時才偵測（import 時不多跑子行程）"""
+        with self._lock:
+            if not self._sandbox_checked:
+                self._sandbox = _detect_sandbox()
+                self._sandbox_checked = True
+            return self._sandbox
+
+    def _compile(self, workdir):
+        argv = [self.cc, *self.cflags, "-o", "prog", "main.c", "-lm"]
+        limits = _limits(int(GRADER_COMPILE_TIMEOUT) + 1, GRADER_COMPILE_MEMORY_MB, 64 << 20)
+        returncode, _, stderr, timed_out = _run(argv, workdir, limits, GRADER_COMPILE_TIMEOUT, sandbox=[])
+        if timed_out:
+            return False, "編譯逾時"
+        return returncode == 0, self._diagnostics(stderr, workdir)
+
+    def _run_case(self, workdir, test, sandbox):
+        uid = GRADER_SANDBOX_UID if sandbox and sandbox[1] else None
+        limits = _limits(GRADER_RUN_CPU_SECONDS, GRADER_RUN_MEMORY_MB, GRADER_OUTPUT_LIMIT, GRADER_MAX_PROCS, uid)
+        returncode, stdout, _, timed_out = _run(["./prog"], workdir, limits, GRADER_RUN_TIMEOUT,
+                                                stdin=test["input"].encode("utf-8"), sandbox=sandbox)
+        actual = stdout[:GRADER_OUTPUT_LIMIT].decode("utf-8", "replace")
+        case = {"input": test["input"], "expected": test["output"], "actual": actual, "error": None}
+        if timed_out:
+            case["error"] = "執行逾時"
+        elif len(stdout) > GRADER_OUTPUT_LIMIT or returncode == -signal.SIGXFSZ:
+            case["error"] = "輸出太多"
+        elif returncode is not None and returncode < 0:
+            case["error"] = f"執行錯誤（{_signal_name(returncode)}）"
+        case["passed"] = case["error"] is None and _normalize_output(actual) == _normalize_output(test["output"])
+        return case
+
+    def grade(self, code, tests):
+        """編譯並跑完所有測資；評分機滿載等不到、或開不了沙箱就回傳 None（交回 GPT 流程）"""
+        sandbox = self._sandbox_prefix()
+        if sandbox is None and not GRADER_ALLOW_UNSANDBOXED:
+            with self._lock:
+                self._stats["no_sandbox"] += 1
+            return None
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self._stats["busy"] += 1
+            return None
+        start = time.monotonic()
+        try:
+            with tempfile.TemporaryDirectory(prefix="grader-") as workdir:
+                with open(os.path.join(workdir, "main.c"), "w", encoding="utf-8") as f:
+                    f.write(code)
+                ok, diagnostics = self._compile(workdir)
+                compiled = time.monotonic()
+                if not ok:
+                    result = GradeResult("compile_error", diagnostics, total=len(tests),
+                                         compile_seconds=compiled - start)
+                else:
+                    cases = []
+                    for test in tests:
+                        cases.append(self._run_case(workdir, test, sandbox))
+                        if cases[-1]["error"] == "執行逾時":
+                            break  # 多半是無窮迴圈，剩下的測資也只會一組組等到逾時
+                    status = "passed" if len(cases) == len(tests) and all(c["passed"] for c in cases) else "failed"
+                    result = GradeResult(status, diagnostics, cases, len(tests),
+                                         compiled - start, time.monotonic() - compiled)
+        finally:
+            self._slots.release()
+
+        elapsed = time.monotonic() - start
+        metrics.grade_seconds.observe(elapsed, result=result.status)
+        with self._lock:
+            self._stats["graded"] += 1
+            self._stats[result.status] += 1
+            self._stats["timeouts"] += sum(1 for case in result.cases if case["error"] == "執行逾時")
+            self._stats["seconds_total"] += elapsed
+            self._stats["seconds_max"] = max(self._stats["seconds_max"], elapsed)
+        return result
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["seconds_avg"] = snapshot["seconds_total"] / snapshot["graded"] if snapshot["graded"] else 0.0
+        snapshot["sandbox"] = bool(self._sandbox)
+        return snapshot
+
+
+# === 🌐 全域共用評分機 ===
+grader = Grader()
+
+
+def grade(code, tests):
+    return grader.grade(code, tests)
+
+
+def stats():
+    return grader.stats()
+
+
+# === 💬 評分結果文字 & 失敗時請 GPT 給提示 ===
+def _clip(text, limit=200):
+    text = text.rstrip("\n")
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def format_result(result):
+    if result.status == "compile_error":
+        return f"❌ 編譯失敗，先看看編譯器怎麼說：\n\n{result.diagnostics}"
+    total = result.total
+    timing = f"（編譯 {result.compile_seconds:.2f}s，執行 {result.run_seconds:.2f}s）"
+    if result.passed:
+        text = f"✅ {total} 組測資全部通過！{timing}"
+        if result.diagnostics:
+            text += f"\n\n⚠️ 不過編譯器有些警告可以看看：\n{_clip(result.diagnostics, 600)}"
+        return text
+    case = result.first_failure()
+    lines = [f"❌ 通過 {result.passed_count}/{total} 組測資 {timing}", "", "沒過的那組：",
+             f"輸入：\n{_clip(case['input']) or '（無）'}", f"預期輸出：\n{_clip(case['expected'])}"]
+    lines.append(f"你的程式：{case['error']}" if case["error"] else f"你的輸出：\n{_clip(case['actual']) or '（沒有輸出）'}")
+    return "\n".join(lines)
+
+
+FEEDBACK_SYSTEM_PROMPT = "你是一位 C 語言助教。學生的程式沒通過測試，請根據評分結果給他一個方向性的提示，不要直接給出完整解答。"
+
+
+def feedback_prompt(question, code, result):
+    return f"""題目:「{question}」
+
+學生的程式:
+{code}
+
+評分結果:
+{format_result(result)}
+
+請用 3 句以內指出最可能的問題在哪裡，引導他自己修正。"""
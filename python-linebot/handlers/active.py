@@ -1,8 +1,52 @@
-import re
-import threading
-import openai
-import requests
+from persistence import save_message
 from linebot.models import TextSendMessage
+from worker_pool import submit, busy_notice
+import llm_gateway
+import question_pool
+import reply_deadline
+import response_cache
+import intents
+from streaming import streaming_enabled, stream_reply
+
+
+# 主動模式在等答案時會處理的意圖（其餘都算離題）
+ACTIVE_INTENTS = ("answer_choice", "ask_answer", "next_question", "followup", "answer_attempt")
+
+
+# === 📝 各情境的 prompt（sync / async 兩種 handler 共用） ===
+EXPLAIN_SYSTEM_PROMPT = "你是一位 C 語言教學助理，請用簡單方式提供明確解答。"
+FEEDBACK_SYSTEM_PROMPT = "你是一位 C 語言助教，請針對使用者的回答進行建設性回饋。"
+FOLLOWUP_SYSTEM_PROMPT = "你是一位 C 語言助教，請用鼓勵且清楚的方式解釋使用者延伸詢問的概念。"
+STAY_ON_QUESTION_TEXT = "我記得你還在這題喔～想聽答案可以問我「這題答案是什麼？」；想下一題可以說「下一題」！"
+
+
+def explain_prompt(last_q):
+    return f"請針對以下 C 語言問題給出簡單明確的解釋與答案:\n\n問題:「{last_q}」"
+
+
+def feedback_prompt(last_q, user_text):
+    return f"""以下是你先前問的 C 語言問題:
+「{last_q}」
+
+使用者回覆:「{user_text}」
+
+請針對他的回答給出回饋（不給答案），可鼓勵、修正錯誤、引導思考。"""
+
+
+def followup_prompt(last_q, user_text):
+    return f"""你是一位 C 語言教學助教。
+目前使用者正在延伸問與這題有關的概念:「{user_text}」
+問題本身是:「{last_q}」
+請用簡單清楚的方式回答他，不要提供原本問題的正確解答，也不要出新題。"""
+
+
+def new_question_state(question):
+    return {
+        "last_question": question,
+        "awaiting_answer": True,
+        "responded": False,
+        "irrelevant_count": 0
+    }
 
 
 # === 🧠 等待語提示 ===
@@ -16,56 +60,32 @@ def get_waiting_message(context):
     }
     return messages.get(context, "稍等一下，我想想看 🤔")
 
-# === 🎯 出題（依照難度） ===
-def generate_active_question(level=1):
-    system_message = (
-        "你是一位 C 語言教學助手，會根據題目難度產生挑戰性問題。\n"
-        "Level 1：選擇題（簡單）\n"
-        "Level 2：填空題（中等）\n"
-        "Level 3：簡答題（進階）\n"
-        "這些難度資訊只用於內部控制，請勿顯示給使用者。\n"
-        "出題範圍從 C 語言基本語法、變數、流程控制，到進階如指標與迴圈。"
-    )
-
-    user_prompt = (
-        f"請產生一題 C 語言的問題，難度為 Level {level}。\n"
-        "請從選擇題、填空題、簡答題中擇一產生，幫助學習者思考。\n"
-        "不要提供答案。"
-    )
-
-    response = openai.ChatCompletion.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    return response["choices"][0]["message"]["content"].strip()
+# === 🎯 出題（依照難度，從預先產生的題庫取） ===
+def generate_active_question(level=1, user_id=None):
+    return question_pool.next_question("active", level, user_id)
 
 # === 🚀 GPT 回覆並推送訊息（背景執行） ===
-def gpt_push_response(context, user_id, user_text, system_prompt, line_bot_api, history_messages=None):
+def gpt_push_response(context, user_id, user_text, system_prompt, line_bot_api, history_messages=None, cache_key=None):
     user_prompt = user_text
     if history_messages:
         user_prompt = "\n".join([msg["content"] for msg in history_messages] + [user_text])
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
+        if streaming_enabled("active"):
+            # 串流：第一段先送，不用等整篇解釋寫完
+            reply_text = stream_reply(line_bot_api, user_id, [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
-            ]
-        )
-        reply_text = response["choices"][0]["message"]["content"].strip()
-        line_bot_api.push_message(user_id, TextSendMessage(text=reply_text))
+            ], context=context)
+        else:
+            reply_text = llm_gateway.ask(system_prompt, user_prompt, context=context)
+            line_bot_api.push_message(user_id, TextSendMessage(text=reply_text))
 
         # 儲存訊息到 MongoDB
-        requests.post(f"{NODE_SERVER_URL}/save_message", json={
-            "user_id": user_id,
-            "message_text": "",
-            "bot_response": reply_text,
-            "message_type": "bot"
-        }, timeout=10)
+        save_message(user_id, bot_response=reply_text, message_type="bot")
+        if cache_key:
+            # cache_key = (模式, 命名空間, 比對用的文字)
+            response_cache.cache.store(*cache_key, reply_text)
 
     except Exception as e:
         print(f"❌ GPT 回覆失敗：{e}")
@@ -73,132 +93,92 @@ def gpt_push_response(context, user_id, user_text, system_prompt, line_bot_api,
 
 # === 🧠 主動學習模式處理主函式 ===
 def handle_active_mode(event, user_id, user_text, user_state, line_bot_api):
-    state = user_state.get(user_id, {})
+    # 出題（題庫空了要等 GPT）、reply 都在鎖外面做，不然會超過 SQLite 鎖的租期被別的 worker 搶走；
+    # 做完只鎖一下，把這則訊息造成的狀態變化套上去
+    apply = _handle_active_mode(event, user_id, user_text, user_state.get(user_id) or {}, line_bot_api)
+    with user_state.edit(user_id) as state:
+        apply(state)
+
+def _handle_active_mode(event, user_id, user_text, state, line_bot_api):
+    """state 是讀出來的快照；回傳一個在 edit() 裡修改狀態的函式"""
     last_q = state.get("last_question")
     awaiting = state.get("awaiting_answer", False)
     level = state.get("difficulty_level", 1)
     
     # 在這個檔案裡不需要儲存 user_text，統一由 app.py 處理
-
-
-    def is_asking_for_answer(user_input):
-        return any(kw in user_input.lower() for kw in ["答案", "正確", "解答", "告訴我"])
-
-    def wants_next_question(user_input):
-        return any(kw in user_input.lower() for kw in ["下一題", "下一個", "再一題", "請再給一題", "再來", "下一"])
-
-    def is_answer_related(user_input, question):
-        abcd_set = {"a", "b", "c", "d"}
-        user_input = user_input.lower().strip()
-        if user_input in abcd_set:
-            return True
-        if re.search(r"(選|答案是|應該是)[\s]*[a-d]", user_input):
-            return True
-        keywords = ["printf", "int", "指標", "陣列", "return", "變數"]
-        return any(kw in user_input for kw in keywords)
-
-    def is_followup_question(user_input):
-        keywords = ["為什麼", "是什麼", "代表", "差別", "怎麼", "如何", "什麼意思", "跟", "有什麼關係"]
-        return any(kw in user_input.lower() for kw in keywords)
+    intent = intents.classify(user_text).best(ACTIVE_INTENTS) if awaiting and last_q else None
 
     if awaiting and last_q:
-        if is_asking_for_answer(user_text):
-            wait_msg = get_waiting_message("explain_answer")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=wait_msg))
-            prompt = f"請針對以下 C 語言問題給出簡單明確的解釋與答案:\n\n問題:「{last_q}」"
-            threading.Thread(
-                target=gpt_push_response,
-                args=("explain_answer", user_id, prompt,
-                      "你是一位 C 語言教學助理，請用簡單方式提供明確解答。",
-                      line_bot_api)
-            ).start()
-            user_state[user_id].update({
+        if intent == "ask_answer":
+            prompt = explain_prompt(last_q)
+            system_prompt = EXPLAIN_SYSTEM_PROMPT
+            cache_key = ("active", system_prompt, last_q)  # 同一題的解答大家都一樣
+            if not response_cache.try_reply(event, user_id, *cache_key, line_bot_api):
+                race = reply_deadline.start(line_bot_api, event, user_id, "active", get_waiting_message("explain_answer"))
+                submit(
+                    gpt_push_response, "explain_answer", user_id, prompt, system_prompt, race,
+                    cache_key=cache_key,
+                    on_reject=busy_notice(race, user_id)
+                )
+            return lambda s: s.update({
                 "awaiting_answer": False,
                 "last_question": None,
                 "responded": False,
                 "irrelevant_count": 0
             })
-            return
-
-        elif wants_next_question(user_text):
-            question = generate_active_question(level=level)
-            wait_msg = get_waiting_message("next_question")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=wait_msg))
-            line_bot_api.push_message(user_id, TextSendMessage(text=f"Level {level} 新挑戰來囉！\n\n{question}\n\n你覺得答案是什麼？"))
-            user_state[user_id].update({
-                "last_question": question,
-                "awaiting_answer": True,
-                "responded": False,
-                "irrelevant_count": 0
-            })
-            return
 
-        elif is_answer_related(user_text, last_q):
-            wait_msg = get_waiting_message("answer_feedback")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=wait_msg))
-            prompt = f"""以下是你先前問的 C 語言問題:
-「{last_q}」
-
-使用者回覆:「{user_text}」
-
-請針對他的回答給出回饋（不給答案），可鼓勵、修正錯誤、引導思考。"""
-            threading.Thread(
-                target=gpt_push_response,
-                args=("answer_feedback", user_id, prompt,
-                      "你是一位 C 語言助教，請針對使用者的回答進行建設性回饋。",
-                      line_bot_api)
-            ).start()
-            user_state[user_id]["responded"] = True
-            user_state[user_id]["irrelevant_count"] = 0
-            return
-
-        elif is_followup_question(user_text):
-            wait_msg = get_waiting_message("followup_concept")
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=wait_msg))
-            followup_prompt = f"""你是一位 C 語言教學助教。
-目前使用者正在延伸問與這題有關的概念:「{user_text}」
-問題本身是:「{last_q}」
-請用簡單清楚的方式回答他，不要提供原本問題的正確解答，也不要出新題。"""
-            threading.Thread(
-                target=gpt_push_response,
-                args=("followup_concept", user_id, followup_prompt,
-                      "你是一位 C 語言助教，請用鼓勵且清楚的方式解釋使用者延伸詢問的概念。",
-                      line_bot_api)
-            ).start()
-            user_state[user_id]["irrelevant_count"] = 0
-            return
+        elif intent == "next_question":
+            question = generate_active_question(level=level, user_id=user_id)
+            # 題目已經在手上，直接用 reply 送出，不用等待語 + push
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"Level {level} 新挑戰來囉！\n\n{question}\n\n你覺得答案是什麼？"))
+            return lambda s: s.update(new_question_state(question))
+
+        elif intent in ("answer_choice", "answer_attempt"):
+            race = reply_deadline.start(line_bot_api, event, user_id, "active", get_waiting_message("answer_feedback"))
+            prompt = feedback_prompt(last_q, user_text)
+            submit(
+                gpt_push_response, "answer_feedback", user_id, prompt, FEEDBACK_SYSTEM_PROMPT,
+                race,
+                on_reject=busy_notice(race, user_id)
+            )
+            return lambda s: s.update({"responded": True, "irrelevant_count": 0})
+
+        elif intent == "followup":
+            prompt = followup_prompt(last_q, user_text)
+            system_prompt = FOLLOWUP_SYSTEM_PROMPT
+            cache_key = ("active", system_prompt + last_q, user_text)  # 只在同一題底下比對延伸問題
+            if not response_cache.try_reply(event, user_id, *cache_key, line_bot_api):
+                race = reply_deadline.start(line_bot_api, event, user_id, "active", get_waiting_message("followup_concept"))
+                submit(
+                    gpt_push_response, "followup_concept", user_id, prompt, system_prompt, race,
+                    cache_key=cache_key,
+                    on_reject=busy_notice(race, user_id)
+                )
+            return lambda s: s.update({"irrelevant_count": 0})
 
         else:
-            count = user_state[user_id].get("irrelevant_count", 0) + 1
-            user_state[user_id]["irrelevant_count"] = count
-
-            if user_state[user_id].get("responded") and count >= 2:
-                question = generate_active_question(level=level)
-                wait_msg = get_waiting_message("next_question")
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=wait_msg))
-                line_bot_api.push_message(user_id, TextSendMessage(text=f"看起來這題你差不多了，來一題新的吧：\n\n{question}\n\n你覺得答案是什麼？"))
-                user_state[user_id].update({
-                    "last_question": question,
-                    "awaiting_answer": True,
-                    "responded": False,
-                    "irrelevant_count": 0
-                })
-                return
+            count = state.get("irrelevant_count", 0) + 1
+
+            if state.get("responded") and count >= 2:
+                question = generate_active_question(level=level, user_id=user_id)
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"看起來這題你差不多了，來一題新的吧：\n\n{question}\n\n你覺得答案是什麼？"))
+                return lambda s: s.update(new_question_state(question))
             else:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="我記得你還在這題喔～想聽答案可以問我「這題答案是什麼？」；想下一題可以說「下一題」！"))
-                return
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=STAY_ON_QUESTION_TEXT))
+                return lambda s: s.update({"irrelevant_count": s.get("irrelevant_count", 0) + 1})
 
     else:
-        question = generate_active_question(level=level)
-        wait_msg = get_waiting_message("next_question")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=wait_msg))
-        line_bot_api.push_message(user_id, TextSendMessage(text=f"來挑戰看看這題吧（Level {level}）：\n\n{question}\n\n你覺得答案是什麼？"))
-        user_state[user_id] = {
-            "mode": "active",
-            "last_question": question,
-            "awaiting_answer": True,
-            "responded": False,
-            "irrelevant_count": 0,
-            "difficulty_level": level
-        }
-        return
+        question = generate_active_question(level=level, user_id=user_id)
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"來挑戰看看這題吧（Level {level}）：\n\n{question}\n\n你覺得答案是什麼？"))
+
+        def start_question(s):
+            s.clear()
+            s.update({
+                "mode": "active",
+                "last_question": question,
+                "awaiting_answer": True,
+                "responded": False,
+                "irrelevant_count": 0,
+                "difficulty_level": level
+            })
+        return start_question
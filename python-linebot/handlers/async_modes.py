@@ -0,0 +1,211 @@
+"""四種學習模式的 asyncio 版本（給 async_app.py 用）
+
+跟 sync handler 共用 prompt、意圖判斷、狀態存放、快取與題庫；差別是 LINE / GPT / Node 都用
+await，等待 GPT 時不佔執行緒，所以不用再丟到 worker pool。回覆一律整段送出（不串流）。
+"""
+import asyncio
+import traceback
+
+from linebot.models import TextSendMessage
+
+import context_builder
+import grader
+import intents
+import llm_gateway
+import question_pool
+import reply_deadline
+import response_cache
+import user_stats
+from persistence import save_message
+from handlers import active, constructive, interactive, passive
+
+
+class AsyncContext:
+    """一個 process 共用的 async 資源：LINE client、aiohttp session、使用者狀態"""
+
+    def __init__(self, line_bot_api, session, user_state):
+        self.line_bot_api = line_bot_api
+        self.session = session
+        self.user_state = user_state
+
+
+async def _reply(ctx, event, text):
+    await ctx.line_bot_api.reply_message(event.reply_token, TextSendMessage(text=text))
+
+
+async def _push(sender, user_id, text):
+    await sender.push_message(user_id, TextSendMessage(text=text))
+
+
+async def _race(ctx, event, user_id, mode, waiting_text):
+    """答案在期限內好了就直接 reply，來不及才先回等待語、答案改 push"""
+    return await reply_deadline.astart(ctx.line_bot_api, event, user_id, mode, waiting_text)
+
+
+async def _answer(sender, context, user_id, system_prompt, user_prompt, error_text, cache_key=None, save=True):
+    """GPT 回覆 → 送出（sender 通常是 _race 回傳的競賽）→ 存檔 / 寫快取；失敗就送一則道歉"""
+    try:
+        reply_text = await llm_gateway.aask(system_prompt, user_prompt, context=context)
+        await _push(sender, user_id, reply_text)
+        if save:
+            save_message(user_id, bot_response=reply_text, message_type="bot")
+        if cache_key:
+            response_cache.cache.store(*cache_key, reply_text)
+        return reply_text
+    except Exception as e:
+        traceback.print_exc()
+        print(f"❌ GPT 回覆失敗（{context}）：{type(e).__name__} → {e}")
+        await _push(sender, user_id, error_text)
+        return None
+
+
+async def _try_cached_reply(ctx, event, user_id, mode, system_prompt, prompt, save=True):
+    cached = response_cache.cache.lookup(mode, system_prompt, prompt)
+    if cached is None:
+        return False
+    print(f"⚡ 回覆快取命中（{mode}）")
+    await _reply(ctx, event, cached)
+    reply_deadline.record(mode, "cached")
+    if save:
+        save_message(user_id, bot_response=cached, message_type="bot")
+    return True
+
+
+async def _next_question(level, user_id):
+    # 題庫空了會同步呼叫 GPT，丟到執行緒池避免卡住 event loop
+    return await asyncio.to_thread(question_pool.next_question, "active", level, user_id)
+
+
+# === 💤 被動模式 ===
+async def handle_passive_mode(ctx, event, user_id, user_text):
+    system_prompt = passive.PASSIVE_SYSTEM_PROMPT
+    if await _try_cached_reply(ctx, event, user_id, "passive", system_prompt, user_text, save=False):
+        return
+    race = await _race(ctx, event, user_id, "passive", passive.get_waiting_message())
+    # 跟 sync 版一樣：被動模式不存 bot 回覆
+    await _answer(race, "general_chat", user_id, system_prompt, user_text, "哎呀我卡住了，再問一次看看 🥲",
+                  cache_key=("passive", system_prompt, user_text), save=False)
+
+
+# === 🧱 建構式模式 ===
+async def handle_constructive_mode(ctx, event, user_id, user_text):
+    race = await _race(ctx, event, user_id, "constructive", constructive.get_waiting_message())
+    await _answer(race, "answer_feedback", user_id, constructive.CONSTRUCTIVE_SYSTEM_PROMPT, user_text,
+                  "好像卡住了，再問我一次好嗎？🥲")
+
+
+# === 🗨️ 互動式模式 ===
+async def handle_interactive_mode(ctx, event, user_id, user_text, history):
+    history = context_builder.without_current_turn(history, user_text)
+    race = await _race(ctx, event, user_id, "interactive", interactive.get_waiting_message("general_chat"))
+
+    system_prompt = interactive.INTERACTIVE_SYSTEM_PROMPT
+    messages = [{"role": "system", "content": system_prompt}]
+    messages += context_builder.build_history(user_id, system_prompt, history, user_text,
+                                             context="interactive_learning")
+    messages.append({"role": "user", "content": user_text})
+    try:
+        reply_text = await llm_gateway.achat(messages, context="interactive_learning", timeout=30)
+        await _push(race, user_id, reply_text)
+    except Exception as e:
+        traceback.print_exc()
+        print(f"❌ 互動模式回覆失敗：{type(e).__name__} → {e}")
+        return
+    save_message(user_id, bot_response=reply_text, message_type="bot")
+
+    if intents.classify(user_text).has("mode_switch") or intents.classify(reply_text).has("mode_switch"):
+        print("⚡ 檢測到系統模式訊息，不列入互動次數")
+        return
+    user_stats.record_interaction(user_id, len(user_text.strip()) > 5)
+
+
+# === 🎯 主動學習模式 ===
+async def handle_active_mode(ctx, event, user_id, user_text):
+    """同一位使用者的訊息由 keyed_executor 依序送進來；狀態在最後一次寫回"""
+    state = ctx.user_state.get(user_id) or {}
+    original = dict(state)
+    await _handle_active_mode(ctx, event, user_id, user_text, state)
+    if state != original:
+        ctx.user_state.set(user_id, state)
+
+
+async def _handle_active_mode(ctx, event, user_id, user_text, state):
+    last_q = state.get("last_question")
+    awaiting = state.get("awaiting_answer", False)
+    level = state.get("difficulty_level", 1)
+    error_text = "哎呀我卡住了 🥲 再問我一次好嗎？"
+
+    if not (awaiting and last_q):
+        question = await _next_question(level, user_id)
+        await _reply(ctx, event, f"來挑戰看看這題吧（Level {level}）：\n\n{question}\n\n你覺得答案是什麼？")
+        state.clear()
+        state.update({"mode": "active", "difficulty_level": level, **active.new_question_state(question)})
+        return
+
+    intent = intents.classify(user_text).best(active.ACTIVE_INTENTS)
+
+    if intent == "ask_answer":
+        cache_key = ("active", active.EXPLAIN_SYSTEM_PROMPT, last_q)
+        state.update({"awaiting_answer": False, "last_question": None, "responded": False, "irrelevant_count": 0})
+        if not await _try_cached_reply(ctx, event, user_id, *cache_key):
+            race = await _race(ctx, event, user_id, "active", active.get_waiting_message("explain_answer"))
+            await _answer(race, "explain_answer", user_id, active.EXPLAIN_SYSTEM_PROMPT, active.explain_prompt(last_q),
+                          error_text, cache_key=cache_key)
+
+    elif intent == "next_question":
+        question = await _next_question(level, user_id)
+        await _reply(ctx, event, f"Level {level} 新挑戰來囉！\n\n{question}\n\n你覺得答案是什麼？")
+        state.update(active.new_question_state(question))
+
+    elif intent in ("answer_choice", "answer_attempt"):
+        state["responded"] = True
+        state["irrelevant_count"] = 0
+        race = await _race(ctx, event, user_id, "active", active.get_waiting_message("answer_feedback"))
+        await _answer(race, "answer_feedback", user_id, active.FEEDBACK_SYSTEM_PROMPT,
+                      active.feedback_prompt(last_q, user_text), error_text)
+
+    elif intent == "followup":
+        state["irrelevant_count"] = 0
+        cache_key = ("active", active.FOLLOWUP_SYSTEM_PROMPT + last_q, user_text)
+        if not await _try_cached_reply(ctx, event, user_id, *cache_key):
+            race = await _race(ctx, event, user_id, "active", active.get_waiting_message("followup_concept"))
+            await _answer(race, "followup_concept", user_id, active.FOLLOWUP_SYSTEM_PROMPT,
+                          active.followup_prompt(last_q, user_text), error_text, cache_key=cache_key)
+
+    else:
+        count = state.get("irrelevant_count", 0) + 1
+        state["irrelevant_count"] = count
+        if state.get("responded") and count >= 2:
+            question = await _next_question(level, user_id)
+            await _reply(ctx, event, f"看起來這題你差不多了，來一題新的吧：\n\n{question}\n\n你覺得答案是什麼？")
+            state.update(active.new_question_state(question))
+        else:
+            await _reply(ctx, event, active.STAY_ON_QUESTION_TEXT)
+
+
+# === 🧪 程式碼評分 ===
+async def handle_code_submission(ctx, event, user_id, user_text, question=None):
+    """跟 handlers/grading.py 一樣：本機評分的結果直接 reply，沒過才請 GPT 補一則提示"""
+    submission = grader.match_submission(user_id, user_text, question)
+    if submission is None:
+        return False
+    code, challenge = submission
+    # gcc 跟測資都是子行程，丟到執行緒裡等，不卡 event loop
+    result = await asyncio.to_thread(grader.grade, code, challenge["tests"])
+    if result is None:
+        return False
+
+    grader.settle(user_id, challenge, result)
+    reply_text = grader.format_result(result)
+    await _reply(ctx, event, reply_text)
+    save_message(user_id, bot_response=reply_text, message_type="bot")
+    if not result.passed:
+        try:
+            hint = await llm_gateway.aask(grader.FEEDBACK_SYSTEM_PROMPT,
+                                          grader.feedback_prompt(challenge["question"], code, result),
+                                          context="grade_feedback")
+            await _push(ctx.line_bot_api, user_id, f"💡 {hint}")
+            save_message(user_id, bot_response=f"💡 {hint}", message_type="bot")
+        except Exception as e:
+            print(f"❌ 評分提示產生失敗：{e}")
+    return True
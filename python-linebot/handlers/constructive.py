@@ -1,10 +1,14 @@
-import threading
-import openai
-import requests
+from persistence import save_message
 from linebot.models import TextSendMessage
+from worker_pool import submit, busy_notice
+import llm_gateway
+import reply_deadline
 
 
 
+CONSTRUCTIVE_SYSTEM_PROMPT = "你是一位會根據回答進一步追問的 C 語言助教，請先簡單回應使用者，再提出有深度的追問。"
+
+
 def get_waiting_message(context="answer_feedback"):
     return {
         "answer_feedback": "來看看你答得怎麼樣 🤔"
@@ -12,43 +16,30 @@ def get_waiting_message(context="answer_feedback"):
 
 def gpt_push_response(context, user_id, user_text, system_prompt, line_bot_api):
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_text}
-            ]
-        )
-        reply_text = response["choices"][0]["message"]["content"].strip()
+        reply_text = llm_gateway.ask(system_prompt, user_text, context=context)
         line_bot_api.push_message(user_id, TextSendMessage(text=reply_text))
 
         # 儲存回應
-        requests.post(f"{NODE_SERVER_URL}/save_message", json={
-            "user_id": user_id,
-            "message_text": "",
-            "bot_response": reply_text,
-            "message_type": "bot"
-        }, timeout=10)
+        save_message(user_id, bot_response=reply_text, message_type="bot")
 
     except Exception as e:
         print(f"❌ Constructive 回覆錯誤：{e}")
         line_bot_api.push_message(user_id, TextSendMessage(text="好像卡住了，再問我一次好嗎？🥲"))
 
 def handle_constructive_mode(event, user_id, user_text, line_bot_api):
-    wait_msg = get_waiting_message()
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=wait_msg))
+    # 答案在期限內好了就直接 reply，來不及才先回等待語、答案改 push
+    race = reply_deadline.start(line_bot_api, event, user_id, "constructive", get_waiting_message())
 
     # 在這個檔案裡不需要儲存 user_text，統一由 app.py 處理
 
 
     # 開始背景回覆
-    threading.Thread(
-        target=gpt_push_response,
-        args=(
-            "answer_feedback",
-            user_id,
-            user_text,
-            "你是一位會根據回答進一步追問的 C 語言助教，請先簡單回應使用者，再提出有深度的追問。",
-            line_bot_api
-        )
-    ).start()
+    submit(
+        gpt_push_response,
+        "answer_feedback",
+        user_id,
+        user_text,
+        CONSTRUCTIVE_SYSTEM_PROMPT,
+        race,
+        on_reject=busy_notice(race, user_id)
+    )
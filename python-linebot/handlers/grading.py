@@ -0,0 +1,38 @@
+from linebot.models import TextSendMessage
+
+import grader
+import llm_gateway
+from persistence import save_message
+from worker_pool import submit
+
+
+# === 💡 沒過的時候請 GPT 給提示（背景執行，結果先用 reply 送出了） ===
+def push_feedback(user_id, question, code, result, line_bot_api):
+    try:
+        hint = llm_gateway.ask(grader.FEEDBACK_SYSTEM_PROMPT, grader.feedback_prompt(question, code, result),
+                               context="grade_feedback")
+        text = f"💡 {hint}"
+        line_bot_api.push_message(user_id, TextSendMessage(text=text))
+        save_message(user_id, bot_response=text, message_type="bot")
+    except Exception as e:
+        print(f"❌ 評分提示產生失敗：{e}")
+
+
+# === 🧪 收到程式碼：本機編譯 + 跑測資，結果直接 reply ===
+def handle_code_submission(event, user_id, user_text, line_bot_api, question=None):
+    """有評分就回傳 True；不像程式、題目沒有測資或評分機太忙就回傳 False，交給原本的模式處理"""
+    submission = grader.match_submission(user_id, user_text, question)
+    if submission is None:
+        return False
+    code, challenge = submission
+    result = grader.grade(code, challenge["tests"])
+    if result is None:
+        return False
+
+    grader.settle(user_id, challenge, result)
+    reply_text = grader.format_result(result)
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    save_message(user_id, bot_response=reply_text, message_type="bot")
+    if not result.passed:
+        submit(push_feedback, user_id, challenge["question"], code, result, line_bot_api)
+    return True
@@ -1,7 +1,8 @@
-import threading
-import openai
-import requests
 from linebot.models import TextSendMessage
+from worker_pool import submit, busy_notice
+import llm_gateway
+import reply_deadline
+import response_cache
 
 
 
@@ -12,16 +13,10 @@ def get_waiting_message(context="general_chat"):
 
 def gpt_push_response(context, user_id, user_text, system_prompt, line_bot_api):
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_text}
-            ]
-        )
-        reply_text = response["choices"][0]["message"]["content"].strip()
+        reply_text = llm_gateway.ask(system_prompt, user_text, context=context)
 
         line_bot_api.push_message(user_id, TextSendMessage(text=reply_text))
+        response_cache.cache.store("passive", system_prompt, user_text, reply_text)
 
     except Exception as e:
         import traceback
@@ -31,20 +26,7 @@ def gpt_push_response(context, user_id, user_text, system_prompt, line_bot_api):
 
 
 
-def handle_passive_mode(event, user_id, user_text, line_bot_api):
-    wait_msg = get_waiting_message()
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=wait_msg))
-
-    # 在這個檔案裡不需要儲存 user_text，統一由 app.py 處理
-
-    # 開始背景回覆
-    threading.Thread(
-        target=gpt_push_response,
-        args=(
-            "general_chat",
-            user_id,
-            user_text,
-            """
+PASSIVE_SYSTEM_PROMPT = """
             你是一位具有歷史記憶、親切且會主動協助學習的 C 語言助教。你不只回答問題，還會根據使用者的興趣或問題內容，自然地提供補充知識、範例、相關主題延伸閱讀，甚至偶爾插入趣味語法冷知識。
             
             你可以：
@@ -52,7 +34,25 @@ def handle_passive_mode(event, user_id, user_text, line_bot_api):
             - 提供類似主題
             - 鼓勵與提醒複習
             - 偶爾主動推送知識點（如每日一句）
-            """,
-            line_bot_api
-        )
-    ).start()
+        """
+
+def handle_passive_mode(event, user_id, user_text, line_bot_api):
+    # 同樣的問題之前答過，直接用 reply token 回覆
+    if response_cache.try_reply(event, user_id, "passive", PASSIVE_SYSTEM_PROMPT, user_text, line_bot_api, save=False):
+        return
+
+    # 答案在期限內好了就直接 reply，來不及才先回等待語、答案改 push
+    race = reply_deadline.start(line_bot_api, event, user_id, "passive", get_waiting_message())
+
+    # 在這個檔案裡不需要儲存 user_text，統一由 app.py 處理
+
+    # 開始背景回覆
+    submit(
+        gpt_push_response,
+        "general_chat",
+        user_id,
+        user_text,
+        PASSIVE_SYSTEM_PROMPT,
+        race,
+        on_reject=busy_notice(race, user_id)
+    )
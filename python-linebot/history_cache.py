@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+# === ⚙️ 設定 ===
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "2000"))
+HISTORY_CACHE_TURNS = int(os.getenv("HISTORY_CACHE_TURNS", "20"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "1800"))
+
+
+def _record_key(record):
+    return (record.get("message_text", ""), record.get("bot_response", ""), record.get("message_type", ""))
+
+
+class _Entry:
+    __slots__ = ("turns", "loaded", "loaded_at")
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)
+        self.loaded = False
+        self.loaded_at = 0.0
+
+
+class ConversationCache:
+    """每位使用者一個環狀緩衝區的對話快取（LRU + TTL）"""
+
+    def __init__(self, max_users=HISTORY_CACHE_USERS, max_turns=HISTORY_CACHE_TURNS, ttl=HISTORY_CACHE_TTL):
+        self.max_users = max_users
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "appends": 0, "stale_served": 0}
+
+    def _entry(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = _Entry(self.max_turns)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        else:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    # --- 寫入（save_to_mongo 會同步寫進來） ---
+    def append(self, user_id, record):
+        with self._lock:
+            self._entry(user_id).turns.append(record)
+            self._stats["appends"] += 1
+
+    # --- 讀取：命中就直接回傳，沒命中才用 loader 從 Node 補齊 ---
+    def get(self, user_id, loader):
+        turns = self.peek(user_id)
+        if turns is not None:
+            return turns
+        return self.fill(user_id, loader(user_id))
+
+    def peek(self, user_id):
+        """只查快取：命中回傳對話，沒命中（或過期）回傳 None；async 版自己去 Node 拿再 fill()"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.loaded:
+                if time.monotonic() - entry.loaded_at < self.ttl:
+                    self._entries.move_to_end(user_id)
+                    self._stats["hits"] += 1
+                    return list(entry.turns)
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            return None
+
+    def stale(self, user_id):
+        """Node 不能用時的降級讀取：不管有沒有從 Node 載入過、過期了沒，有什麼就回傳什麼"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            self._stats["stale_served"] += 1
+            return list(entry.turns) if entry is not None else []
+
+    def fill(self, user_id, remote):
+        """把從 Node 讀到的歷史放進快取，回傳合併後的對話"""
+        with self._lock:
+            entry = self._entry(user_id)
+            # 還沒批次送到 Node 的本地訊息要保留下來，接在遠端歷史後面
+            remote_keys = {_record_key(r) for r in remote}
+            pending = [r for r in entry.turns if _record_key(r) not in remote_keys]
+            entry.turns.clear()
+            entry.turns.extend(remote)
+            entry.turns.extend(pending)
+            entry.loaded = True
+            entry.loaded_at = time.monotonic()
+            return list(entry.turns)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["users"] = len(self._entries)
+        lookups = snapshot["hits"] + snapshot["misses"]
+        snapshot["hit_rate"] = snapshot["hits"] / lookups if lookups else 0.0
+        return snapshot
+
+
+# === 🌐 全域共用快取 ===
+cache = ConversationCache()
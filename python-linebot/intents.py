@@ -0,0 +1,148 @@
+import re
+
+
+# === 🧭 意圖定義 ===
+# 每個意圖：關鍵字（子字串比對）+ 正規表示式，各自帶權重。
+# 同一句話命中多個意圖時比總分，而不是看 if/elif 的順序；同分才看 INTENTS 的宣告順序。
+# 英文關鍵字前後不能接英文字母（避免 "int" 命中 "point"），中文照舊用子字串。
+# 輸入一律先轉小寫，所以關鍵字與 regex 都寫小寫。
+INTENTS = {
+    "answer_choice": {
+        "patterns": [
+            (r"^[a-d]$", 5.0),
+            (r"(?:我選|選|答案是|應該是|我覺得是|我猜)\s*[(（]?[a-d](?![a-z])", 4.0),
+            # 英文的 a 也是冠詞，後面要是句尾、標點或 because 才算選項
+            (r"(?:answer is|i choose|i pick|i think it'?s|option)\s*[(]?[a-d][)]?(?=\s*(?:$|[.,!?]|because))", 4.0),
+        ],
+    },
+    "ask_answer": {
+        "keywords": [("答案", 3.0), ("正確答案", 3.0), ("解答", 3.0), ("告訴我", 1.0), ("公布", 2.0),
+                     ("answer", 3.0), ("solution", 3.0), ("tell me", 1.0), ("give up", 2.0), ("放棄", 2.0)],
+    },
+    "next_question": {
+        "keywords": [("下一題", 3.0), ("下一個", 3.0), ("再一題", 3.0), ("再給一題", 3.0), ("再來一題", 3.0),
+                     ("換一題", 3.0), ("再來", 2.0), ("下一", 2.0),
+                     ("next", 3.0), ("another one", 3.0), ("another question", 3.0), ("skip", 3.0)],
+    },
+    "followup": {
+        "keywords": [("為什麼", 1.5), ("是什麼", 1.5), ("什麼意思", 1.5), ("有什麼關係", 1.5), ("差別", 1.5),
+                     ("差在哪", 1.5), ("代表", 1.0), ("怎麼", 1.0), ("如何", 1.0), ("為何", 1.5),
+                     ("why", 1.5), ("what is", 1.5), ("what's", 1.5), ("what does", 1.5), ("difference", 1.5),
+                     ("how", 1.0), ("mean", 1.0)],
+    },
+    "answer_attempt": {
+        "keywords": [("printf", 1.0), ("scanf", 1.0), ("int", 1.0), ("return", 1.0), ("指標", 1.0),
+                     ("陣列", 1.0), ("變數", 1.0), ("pointer", 1.0), ("array", 1.0), ("variable", 1.0)],
+        "patterns": [
+            (r"[;{}]|==|\+\+|&&|\|\||->", 1.5),   # 看起來像程式碼
+            (r"^-?\d+(?:\.\d+)?$", 2.0),           # 只回一個數字
+        ],
+    },
+    # 要求直接寫程式（模型路由用：交給用 C 程式範例微調過的模型）
+    "code_request": {
+        "keywords": [("幫我寫", 3.0), ("寫一個", 2.0), ("寫一段", 2.0), ("寫個", 2.0), ("範例程式", 2.0),
+                     ("實作", 2.0), ("write a", 2.0), ("write code", 3.0), ("implement", 2.0),
+                     ("c program", 2.0), ("程式碼", 1.0)],
+    },
+    "mode_switch": {
+        "keywords": [("mode_", 5.0), ("已切換至", 5.0)],
+    },
+}
+
+_ASCII_WORD = re.compile(r"^[a-z0-9_' ]+$")
+_ASCII_LETTER = re.compile(r"[a-z]")
+
+
+def _trie_regex(words):
+    """把關鍵字建成字典樹再轉成 regex：同字首的詞共用前綴，每個位置只要看一個字就知道有沒有機會"""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node):
+        alternatives = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alternatives:
+            return ""
+        body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        # 可以在這裡結束的詞：後面那段設成可選（貪婪），所以會先試最長的「下一題」再退回「下一」
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+def _compile(intents):
+    """所有意圖的 regex 與關鍵字編成一個 matcher：regex 各一個具名群組，關鍵字併成一棵字典樹"""
+    patterns, keywords = {}, {}
+    for intent, spec in intents.items():
+        for pattern, weight in spec.get("patterns", []):
+            patterns[f"p{len(patterns)}"] = (pattern, intent, weight)
+        for keyword, weight in spec.get("keywords", []):
+            keywords[keyword] = (intent, weight)
+
+    parts = [f"(?P<{name}>{pattern})" for name, (pattern, _, _) in patterns.items()]
+    parts.append(f"(?P<kw>{_trie_regex(keywords)})")
+    # 包在 lookahead 裡：每個位置都試一次，重疊的詞也抓得到，但整句只掃一遍；regex 排在前面優先
+    matcher = re.compile("(?=" + "|".join(parts) + ")")
+    groups = {name: (intent, weight) for name, (_, intent, weight) in patterns.items()}
+    return matcher, groups, keywords
+
+
+_MATCHER, _GROUPS, _KEYWORDS = _compile(INTENTS)
+_ORDER = {intent: i for i, intent in enumerate(INTENTS)}
+
+
+def _is_whole_word(text, term, start):
+    """英文關鍵字前後不能緊接英文字母（"int" 不算命中 "point"）；結尾是 "_" 的（mode_）允許後面接字"""
+    if not _ASCII_WORD.match(term):
+        return True
+    end = start + len(term)
+    if start > 0 and _ASCII_LETTER.match(text[start - 1]):
+        return False
+    return term.endswith("_") or end >= len(text) or not _ASCII_LETTER.match(text[end])
+
+
+class IntentResult:
+    """一次分類的結果：各意圖分數與命中的字詞"""
+
+    __slots__ = ("scores", "matches")
+
+    def __init__(self, scores, matches):
+        self.scores = scores
+        self.matches = matches
+
+    def has(self, intent):
+        return intent in self.scores
+
+    def best(self, allowed=None):
+        """回傳分數最高的意圖（可限定候選）；都沒命中回傳 None"""
+        candidates = [i for i in self.scores if allowed is None or i in allowed]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda i: (self.scores[i], -_ORDER[i]))
+
+    def __repr__(self):
+        return f"IntentResult({self.scores})"
+
+
+def classify(text):
+    """單次掃描回傳所有命中意圖的分數；同一個詞只算一次"""
+    text = text.strip().lower()
+    scores, matches, seen = {}, {}, set()
+    for m in _MATCHER.finditer(text):
+        name = m.lastgroup
+        term = m.group(name)
+        if name == "kw":
+            if not _is_whole_word(text, term, m.start()):
+                continue
+            intent, weight = _KEYWORDS[term]
+        else:
+            intent, weight = _GROUPS[name]
+        if (intent, term) in seen:
+            continue
+        seen.add((intent, term))
+        scores[intent] = scores.get(intent, 0.0) + weight
+        matches.setdefault(intent, []).append(term)
+    return IntentResult(scores, matches)
@@ -0,0 +1,222 @@
+import asyncio
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+import metrics
+import worker_pool
+from reply_deadline import DeadlineTimer
+
+
+# === ⚙️ 設定 ===
+KEYED_DEBOUNCE = float(os.getenv("KEYED_DEBOUNCE", "0.6"))       # 最後一則之後再等這麼久，沒有新訊息才開始處理
+KEYED_MAX_WAIT = float(os.getenv("KEYED_MAX_WAIT", "2"))         # 第一則最多等這麼久（一直連發也不會無限延後）
+KEYED_MAX_BATCH = int(os.getenv("KEYED_MAX_BATCH", "8"))          # 一次最多合併幾則
+KEYED_MAX_PENDING = int(os.getenv("KEYED_MAX_PENDING", "50"))     # 每位使用者最多排幾則
+KEYED_WORKERS = int(os.getenv("KEYED_WORKERS", str(worker_pool.WORKER_POOL_SIZE)))
+KEYED_RETRY_DELAY = 0.5
+
+
+def split_batches(items, is_barrier=None, max_batch=KEYED_MAX_BATCH):
+    """連續的一般訊息併成一批；is_barrier 為真的（例如切換模式）自己一批，前後不合併"""
+    batches, current = [], []
+    for item in items:
+        if is_barrier is not None and is_barrier(item):
+            if current:
+                batches.append(current)
+                current = []
+            batches.append([item])
+            continue
+        current.append(item)
+        if len(current) >= max_batch:
+            batches.append(current)
+            current = []
+    if current:
+        batches.append(current)
+    return batches
+
+
+class _KeyedBase:
+    def __init__(self, handler, is_barrier, debounce, max_wait, max_batch, max_pending):
+        self.handler = handler
+        self.is_barrier = is_barrier
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._keys = {}  # key → {"items": deque, "first": 到達時間, "last": 到達時間, ...}
+        self._stats_lock = threading.Lock()
+        self._stats = {"submitted": 0, "dropped": 0, "batches": 0, "merged_messages": 0,
+                       "llm_calls_saved": 0, "failed": 0, "rejected_retries": 0}
+
+    def _due(self, entry):
+        return min(entry["last"] + self.debounce, entry["first"] + self.max_wait)
+
+    def _enqueue(self, entry, item):
+        now = time.monotonic()
+        if len(entry["items"]) >= self.max_pending:
+            with self._stats_lock:
+                self._stats["dropped"] += 1
+            return False
+        entry["items"].append(item)
+        entry["last"] = now
+        if entry["first"] is None:
+            entry["first"] = now
+        with self._stats_lock:
+            self._stats["submitted"] += 1
+        return True
+
+    def _take(self, entry):
+        items = list(entry["items"])
+        entry["items"].clear()
+        entry["first"] = entry["last"] = None
+        return split_batches(items, self.is_barrier, self.max_batch)
+
+    def _record(self, batch, ok):
+        saved = len(batch) - 1
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["failed"] += 0 if ok else 1
+            if saved:
+                self._stats["merged_messages"] += len(batch)
+                self._stats["llm_calls_saved"] += saved
+        if saved:
+            # handler 裡已經設好這批是哪個模式
+            metrics.coalesced_messages_total.inc(saved, mode=metrics.current_mode())
+
+    def stats(self):
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        snapshot["active_keys"] = len(self._keys)
+        snapshot["pending"] = sum(len(entry["items"]) for entry in list(self._keys.values()))
+        return snapshot
+
+
+# === 🧵 執行緒版（app.py）：每位使用者同時只有一個批次在跑，不同使用者平行 ===
+class KeyedExecutor(_KeyedBase):
+    """同一個 key 的工作嚴格依序執行；短時間內連發的合併成一批交給 handler(key, batch)
+
+    handler 在自己的工作池執行，期間 worker_pool.submit 的背景工作會直接在同一條執行緒跑完，
+    所以同一位使用者的下一批一定等上一批的 GPT 回覆送出之後才開始。
+    """
+
+    def __init__(self, handler, is_barrier=None, debounce=KEYED_DEBOUNCE, max_wait=KEYED_MAX_WAIT,
+                 max_batch=KEYED_MAX_BATCH, max_pending=KEYED_MAX_PENDING, workers=KEYED_WORKERS, name="keyed"):
+        super().__init__(handler, is_barrier, debounce, max_wait, max_batch, max_pending)
+        self._lock = threading.Lock()
+        self._pool = worker_pool.WorkerPool(size=workers, overflow_policy="reject", name=name)
+        self._timer = DeadlineTimer(name=f"{name}-debounce")
+
+    def submit(self, key, item):
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is None:
+                entry = self._keys[key] = {"items": deque(), "first": None, "last": None,
+                                           "running": False, "scheduled": False}
+            if not self._enqueue(entry, item):
+                return False
+            if entry["running"] or entry["scheduled"]:
+                return True  # 正在跑的批次結束後會接著處理
+            entry["scheduled"] = True
+        self._timer.call_later(self.debounce, lambda: self._on_due(key))
+        return True
+
+    def _on_due(self, key):
+        """計時器執行緒：還在連發就延後，時間到就丟進工作池"""
+        with self._lock:
+            entry = self._keys[key]
+            wait = self._due(entry) - time.monotonic()
+            if wait <= 0:
+                entry["scheduled"] = False
+                entry["running"] = True
+        if wait > 0:
+            self._timer.call_later(wait, lambda: self._on_due(key))
+            return
+        if not self._pool.submit(self._drain, key):
+            # 工作池滿了：訊息留在佇列裡，稍後再排
+            with self._lock:
+                entry["running"] = False
+                entry["scheduled"] = True
+            with self._stats_lock:
+                self._stats["rejected_retries"] += 1
+            self._timer.call_later(KEYED_RETRY_DELAY, lambda: self._on_due(key))
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                entry = self._keys[key]
+                if not entry["items"]:
+                    del self._keys[key]
+                    return
+                wait = self._due(entry) - time.monotonic()
+                if wait > 0:
+                    # 處理上一批時又來了新訊息，而且還在連發：照樣等去抖動時間
+                    entry["running"] = False
+                    entry["scheduled"] = True
+                    break
+                batches = self._take(entry)
+            for batch in batches:
+                ok = True
+                with metrics.mode_context(None), worker_pool.inline_jobs():
+                    try:
+                        self.handler(key, batch)
+                    except Exception as e:
+                        ok = False
+                        traceback.print_exc()
+                        print(f"❌ 使用者 {key} 的訊息處理失敗 ({type(e).__name__}): {e}")
+                    self._record(batch, ok)
+        self._timer.call_later(wait, lambda: self._on_due(key))
+
+    def join(self, timeout=None):
+        """等所有使用者的訊息都處理完（關機或測試用）"""
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        while self._keys:
+            if give_up_at is not None and time.monotonic() >= give_up_at:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+# === ⚡ asyncio 版（async_app.py）：每位使用者一個 task，等去抖動時間不佔執行緒 ===
+class AsyncKeyedExecutor(_KeyedBase):
+    def __init__(self, handler, is_barrier=None, debounce=KEYED_DEBOUNCE, max_wait=KEYED_MAX_WAIT,
+                 max_batch=KEYED_MAX_BATCH, max_pending=KEYED_MAX_PENDING):
+        super().__init__(handler, is_barrier, debounce, max_wait, max_batch, max_pending)
+
+    def submit(self, key, item):
+        """要在 event loop 裡呼叫"""
+        entry = self._keys.get(key)
+        if entry is None:
+            entry = self._keys[key] = {"items": deque(), "first": None, "last": None, "task": None}
+        if not self._enqueue(entry, item):
+            return False
+        if entry["task"] is None:
+            entry["task"] = asyncio.create_task(self._drain(key))
+        return True
+
+    async def _drain(self, key):
+        entry = self._keys[key]
+        try:
+            while entry["items"]:
+                wait = self._due(entry) - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                for batch in self._take(entry):
+                    ok = True
+                    with metrics.mode_context(None):
+                        try:
+                            await self.handler(key, batch)
+                        except Exception as e:
+                            ok = False
+                            traceback.print_exc()
+                            print(f"❌ 使用者 {key} 的訊息處理失敗 ({type(e).__name__}): {e}")
+                        self._record(batch, ok)
+        finally:
+            # 這裡到上面 while 的檢查之間沒有 await，不會漏掉剛進來的訊息
+            del self._keys[key]
+
+    def tasks(self):
+        return {entry["task"] for entry in self._keys.values() if entry["task"] is not None}
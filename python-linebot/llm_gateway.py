@@ -0,0 +1,479 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import openai
+
+import metrics
+import model_router
+from worker_pool import llm_slot
+
+
+# === ⚙️ 設定 ===
+DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))            # 單次呼叫的 HTTP timeout
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "60"))          # 含重試在內的總時限
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", "8"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+LLM_USAGE_RECORDS = int(os.getenv("LLM_USAGE_RECORDS", "1000"))
+LLM_PROMPT_LOG = os.getenv("LLM_PROMPT_LOG")  # 設了就把每次呼叫的 prompt 寫成 JSONL，給 benchmarks/replay_router.py 重播
+
+# 可以重試的錯誤：429、5xx、逾時、連線問題
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.TryAgain,
+)
+
+
+class LLMError(Exception):
+    """GPT 呼叫失敗（包含重試用盡）"""
+
+
+class CircuitOpenError(LLMError):
+    """斷路器開啟中：OpenAI 狀況不好，直接失敗不等待"""
+
+
+class DeadlineExceeded(LLMError):
+    """超過整體時限"""
+
+
+# === 🔌 斷路器 ===
+class CircuitBreaker:
+    def __init__(self, failure_threshold=LLM_BREAKER_THRESHOLD, reset_timeout=LLM_BREAKER_RESET, name="OpenAI"):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._half_open_probe = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """closed 時都放行；half_open 時只放一個探測請求（回傳 "probe"，結束時一定要 record_* 或 release）"""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._half_open_probe:
+                self._half_open_probe = True
+                return "probe"
+            return False
+
+    def release(self, probe):
+        """探測請求沒有成敗結果就結束了（4xx、被取消、串流被關掉）：名額還回去，下一個請求再探"""
+        if probe == "probe":
+            with self._lock:
+                self._half_open_probe = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._half_open_probe = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._half_open_probe or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._half_open_probe:
+                    print(f"⚠️ {self.name} 斷路器開啟（連續失敗 {self._failures} 次）")
+                self._opened_at = time.monotonic()
+            self._half_open_probe = False
+
+
+# 每個模型各一個斷路器：便宜 / 微調模型出狀況不會擋住預設模型
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(model):
+    with _breakers_lock:
+        breaker_ = _breakers.get(model)
+        if breaker_ is None:
+            breaker_ = _breakers[model] = CircuitBreaker()
+        return breaker_
+
+
+breaker = breaker_for(DEFAULT_MODEL)
+
+# === 📊 用量紀錄 ===
+_usage_lock = threading.Lock()
+_usage_records = deque(maxlen=LLM_USAGE_RECORDS)
+_usage_totals = {}  # context → {"calls", "errors", "prompt_tokens", "completion_tokens", "latency_total"}
+
+
+def _record_usage(context, model, latency, attempts, response=None, error=None, **extra):
+    usage = (response or {}).get("usage") or {}
+    route = model_router.current_route()
+    record = {
+        "ts": time.time(),
+        "context": context,
+        "model": model,
+        "route": route.name if route else None,
+        "latency": latency,
+        "attempts": attempts,
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "total_tokens": usage.get("total_tokens", 0),
+        "ok": error is None,
+        "error": type(error).__name__ if error else None,
+        **extra,
+    }
+    with _usage_lock:
+        _usage_records.append(record)
+        totals = _usage_totals.setdefault(context, {
+            "calls": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_total": 0.0
+        })
+        totals["calls"] += 1
+        totals["errors"] += 0 if error is None else 1
+        totals["prompt_tokens"] += record["prompt_tokens"]
+        totals["completion_tokens"] += record["completion_tokens"]
+        totals["latency_total"] += latency
+    metrics.llm_seconds.observe(latency, mode=metrics.current_mode(), context=context, model=model)
+    if error is not None:
+        metrics.errors_total.inc(mode=metrics.current_mode(), stage=f"llm:{context}", type=record["error"])
+    if usage:
+        metrics.llm_tokens_total.inc(record["prompt_tokens"], context=context, kind="prompt")
+        metrics.llm_tokens_total.inc(record["completion_tokens"], context=context, kind="completion")
+    return record
+
+
+_prompt_log_lock = threading.Lock()
+
+
+def _log_prompt(messages, context, route, response, latency):
+    if not LLM_PROMPT_LOG:
+        return
+    usage = response.get("usage") or {}
+    line = json.dumps({
+        "ts": time.time(),
+        "mode": metrics.current_mode(),
+        "context": context,
+        "route": route.name,
+        "model": route.model,
+        "latency": round(latency, 4),
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "messages": messages,
+    }, ensure_ascii=False)
+    try:
+        with _prompt_log_lock, open(LLM_PROMPT_LOG, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(f"⚠️ prompt 紀錄寫入失敗: {e}")
+
+
+def usage_records():
+    with _usage_lock:
+        return list(_usage_records)
+
+
+def usage_summary():
+    with _usage_lock:
+        return {ctx: dict(t) for ctx, t in _usage_totals.items()}
+
+
+def _backoff(attempt, error=None):
+    """指數退避 + full jitter；429 有 Retry-After 就照它的"""
+    retry_after = None
+    headers = getattr(error, "headers", None) or {}
+    if isinstance(error, openai.error.RateLimitError) and headers.get("retry-after"):
+        try:
+            retry_after = float(headers["retry-after"])
+        except ValueError:
+            pass
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(LLM_BACKOFF_CAP, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+
+@contextmanager
+def _in_flight(context):
+    """拿一個 LLM 併發名額，同時記在進行中 GPT 呼叫的 gauge"""
+    with llm_slot(), metrics.llm_in_flight.track(context=context):
+        yield
+
+
+@contextmanager
+def _breaker_call(model, context, start):
+    """一次 GPT 呼叫（不論重試幾次）對斷路器只算一次成敗
+
+    正常結束 → record_success；重試用完（LLMError）或串流中途斷線 → record_failure；
+    其他結束方式（4xx、取消、串流被關掉）不算 OpenAI 故障，只把半開的探測名額還回去。
+    """
+    breaker_ = breaker_for(model)
+    probe = breaker_.allow()
+    if not probe:
+        error = CircuitOpenError(f"{breaker_.name} 斷路器開啟中")
+        _record_usage(context, model, time.monotonic() - start, 0, error=error)
+        raise error
+    recorded = False
+    try:
+        yield
+        breaker_.record_success()
+        recorded = True
+    except (LLMError, *RETRYABLE_ERRORS):
+        breaker_.record_failure()
+        recorded = True
+        raise
+    finally:
+        if not recorded:
+            breaker_.release(probe)
+
+
+def _retry_delay(error, attempt, model, context, deadline, max_retries, start):
+    """可重試的錯誤：回傳要等幾秒；超過時限或次數就記錄後丟出 LLMError"""
+    delay = _backoff(attempt - 1, error)
+    if time.monotonic() + delay >= start + deadline:
+        _record_usage(context, model, time.monotonic() - start, attempt, error=error)
+        raise DeadlineExceeded(f"GPT 呼叫超過時限 {deadline}s（{type(error).__name__}: {error}）") from error
+    if attempt > max_retries:
+        _record_usage(context, model, time.monotonic() - start, attempt, error=error)
+        raise LLMError(f"GPT 呼叫重試 {attempt} 次仍失敗（{type(error).__name__}: {error}）") from error
+    print(f"⚠️ GPT 呼叫失敗（第 {attempt} 次，{type(error).__name__}），{delay:.1f}s 後重試")
+    return delay
+
+
+# === 🚪 唯一的 GPT 呼叫入口 ===
+def _create_with_retries(messages, model, context, timeout, deadline, max_retries, start, use_slot=True, **params):
+    """送出 ChatCompletion.create（含重試），回傳 (response, 嘗試次數)；斷路器由呼叫端的 _breaker_call 管"""
+    give_up_at = start + deadline
+    attempt = 0
+    while True:
+        remaining = give_up_at - time.monotonic()
+        attempt += 1
+        try:
+            with (_in_flight(context) if use_slot else nullcontext()):
+                response = openai.ChatCompletion.create(
+                    model=model,
+                    messages=messages,
+                    request_timeout=max(1.0, min(timeout, remaining)),
+                    **params
+                )
+            return response, attempt
+        except RETRYABLE_ERRORS as e:
+            time.sleep(_retry_delay(e, attempt, model, context, deadline, max_retries, start))
+        except Exception as e:
+            # 4xx（參數錯誤、權限）重試也沒用，也不算 OpenAI 故障
+            _record_usage(context, model, time.monotonic() - start, attempt, error=e)
+            raise
+
+
+def _chat_completion(messages, model, context, timeout, deadline, max_retries, **params):
+    start = time.monotonic()
+    with _breaker_call(model, context, start):
+        response, attempt = _create_with_retries(messages, model, context, timeout, deadline, max_retries, start,
+                                                 **params)
+    _record_usage(context, model, time.monotonic() - start, attempt, response=response)
+    return response
+
+
+def _stream_chat(messages, model, context, timeout, deadline, max_retries, **params):
+    start = time.monotonic()
+    first_chunk_latency = None
+    chunks = 0
+    with _breaker_call(model, context, start), _in_flight(context):
+        stream, attempt = _create_with_retries(messages, model, context, timeout, deadline, max_retries, start,
+                                               use_slot=False, stream=True, **params)
+        try:
+            for event in stream:
+                delta = event["choices"][0].get("delta", {}).get("content")
+                if not delta:
+                    continue
+                if first_chunk_latency is None:
+                    first_chunk_latency = time.monotonic() - start
+                chunks += 1
+                yield delta
+        except Exception as e:
+            _record_usage(context, model, time.monotonic() - start, attempt, error=e,
+                          first_chunk_latency=first_chunk_latency, stream_chunks=chunks)
+            raise
+    _record_usage(context, model, time.monotonic() - start, attempt,
+                  first_chunk_latency=first_chunk_latency, stream_chunks=chunks)
+
+
+# === 🧭 模型路由：沒指定 model 時交給 model_router 挑，非預設等級失敗就退回預設模型 ===
+def _limits(route, timeout, deadline, max_retries):
+    """呼叫端有指定就用呼叫端的（timeout 取兩者較小），否則用該等級的設定，再退回全域預設"""
+    tier_timeout = route.timeout or LLM_TIMEOUT
+    return (
+        min(timeout, tier_timeout) if timeout else tier_timeout,
+        deadline or route.deadline or LLM_DEADLINE,
+        max_retries if max_retries is not None else (route.max_retries if route.max_retries is not None
+                                                     else LLM_MAX_RETRIES),
+    )
+
+
+def _routes(messages, model, context):
+    """回傳依序要嘗試的路由：指定 model 就只有它；路由到非預設等級時，後面再接預設等級"""
+    if model is not None:
+        route = model_router.Route("explicit", model_router.DEFAULT_TIER)
+        route.model = model
+        return [route]
+    route = model_router.route(messages, context)
+    return [route] if route.is_default else [route, model_router.default_route()]
+
+
+def models_for(messages, context="general", model=None):
+    """這次呼叫可能用到的模型（路由挑的，加上失敗時退回的預設模型），給呼叫端算 prompt 預算"""
+    return [route.model for route in _routes(messages, model, context)]
+
+
+def chat_completion(messages, model=None, context="general", timeout=None,
+                    deadline=None, max_retries=None, **params):
+    """呼叫 ChatCompletion，回傳原始 response；會重試、套斷路器、記錄用量、依路由表挑模型"""
+    routes = _routes(messages, model, context)
+    for i, route in enumerate(routes):
+        start = time.monotonic()
+        with model_router.using(route):
+            try:
+                response = _chat_completion(messages, route.model, context,
+                                            *_limits(route, timeout, deadline, max_retries), **params)
+            except Exception as e:
+                if i == len(routes) - 1:
+                    raise
+                print(f"⚠️ {route.model} 失敗（{type(e).__name__}），改用預設模型")
+                model_router.record(route, fell_back=True)
+                continue
+        model_router.record(route)
+        _log_prompt(messages, context, route, response, time.monotonic() - start)
+        return response
+
+
+def stream_chat(messages, model=None, context="general", timeout=None,
+                deadline=None, max_retries=None, **params):
+    """串流版本：一段一段 yield 文字；只有在收到第一段之前會重試 / 退回預設模型"""
+    routes = _routes(messages, model, context)
+    for i, route in enumerate(routes):
+        started = False
+        with model_router.using(route):
+            try:
+                for delta in _stream_chat(messages, route.model, context,
+                                          *_limits(route, timeout, deadline, max_retries), **params):
+                    started = True
+                    yield delta
+            except Exception as e:
+                if started or i == len(routes) - 1:
+                    raise
+                print(f"⚠️ {route.model} 串流失敗（{type(e).__name__}），改用預設模型")
+                model_router.record(route, fell_back=True)
+                continue
+        model_router.record(route)
+        return
+
+
+def chat(messages, model=None, context="general", **kwargs):
+    """呼叫 GPT 並只回傳文字內容"""
+    response = chat_completion(messages, model=model, context=context, **kwargs)
+    return response["choices"][0]["message"]["content"].strip()
+
+
+def ask(system_prompt, user_prompt, model=None, context="general", **kwargs):
+    """最常見的 system + user 兩段式呼叫"""
+    return chat(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        model=model, context=context, **kwargs
+    )
+
+
+# === ⚡ asyncio 版本（async_app 用）：同一套重試、斷路器、用量紀錄，但等待時不佔執行緒 ===
+ASYNC_LLM_CONCURRENCY = int(os.getenv("ASYNC_LLM_CONCURRENCY", "256"))
+_async_slots = {}  # event loop → Semaphore
+
+
+def _async_slot():
+    loop = asyncio.get_running_loop()
+    slot = _async_slots.get(loop)
+    if slot is None:
+        slot = _async_slots[loop] = asyncio.Semaphore(ASYNC_LLM_CONCURRENCY)
+    return slot
+
+
+async def _achat_completion(messages, model, context, timeout, deadline, max_retries, **params):
+    start = time.monotonic()
+    give_up_at = start + deadline
+    attempt = 0
+    with _breaker_call(model, context, start):
+        while True:
+            remaining = give_up_at - time.monotonic()
+            attempt += 1
+            try:
+                async with _async_slot():
+                    with metrics.llm_in_flight.track(context=context):
+                        response = await openai.ChatCompletion.acreate(
+                            model=model,
+                            messages=messages,
+                            request_timeout=max(1.0, min(timeout, remaining)),
+                            **params
+                        )
+                break
+            except RETRYABLE_ERRORS as e:
+                await asyncio.sleep(_retry_delay(e, attempt, model, context, deadline, max_retries, start))
+            except Exception as e:
+                _record_usage(context, model, time.monotonic() - start, attempt, error=e)
+                raise
+    _record_usage(context, model, time.monotonic() - start, attempt, response=response)
+    return response
+
+
+async def achat_completion(messages, model=None, context="general", timeout=None,
+                           deadline=None, max_retries=None, **params):
+    """chat_completion 的 async 版；連線用 openai.aiosession 設定的共用 aiohttp session"""
+    routes = _routes(messages, model, context)
+    for i, route in enumerate(routes):
+        start = time.monotonic()
+        with model_router.using(route):
+            try:
+                response = await _achat_completion(messages, route.model, context,
+                                                   *_limits(route, timeout, deadline, max_retries), **params)
+            except Exception as e:
+                if i == len(routes) - 1:
+                    raise
+                print(f"⚠️ {route.model} 失敗（{type(e).__name__}），改用預設模型")
+                model_router.record(route, fell_back=True)
+                continue
+        model_router.record(route)
+        _log_prompt(messages, context, route, response, time.monotonic() - start)
+        return response
+
+
+async def achat(messages, model=None, context="general", **kwargs):
+    response = await achat_completion(messages, model=model, context=context, **kwargs)
+    return response["choices"][0]["message"]["content"].strip()
+
+
+async def aask(system_prompt, user_prompt, model=None, context="general", **kwargs):
+    return await achat(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        model=model, context=context, **kwargs
+    )
@@ -0,0 +1,278 @@
+import bisect
+import contextvars
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+# === ⚙️ 設定 ===
+# 秒；涵蓋驗簽（毫秒級）到 GPT 長回覆（數十秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# ContextVar：每條執行緒、每個 asyncio task 各自一份
+_mode = contextvars.ContextVar("linebot_mode", default="none")
+
+
+# === 🏷️ 目前請求的模式（給背景工作、GPT、LINE 呼叫貼 mode 標籤） ===
+def current_mode():
+    return _mode.get()
+
+
+@contextmanager
+def mode_context(mode):
+    token = _mode.set(mode or "none")
+    try:
+        yield
+    finally:
+        _mode.reset(token)
+
+
+def set_mode(mode):
+    _mode.set(mode or "none")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# === 📏 指標型別 ===
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """區塊執行期間 +1（例如進行中的 GPT 呼叫數）"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [各 bucket 非累積計數..., +Inf], sum, count
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        with self._lock:
+            items = [(k, list(counts), total, n) for k, (counts, total, n) in self._values.items()]
+        lines = self._header()
+        for key, counts, total, n in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {n}")
+        return lines
+
+
+# === 🗃️ 註冊表 ===
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []  # (prefix, fn)：fn() 回傳 stats dict，輸出時轉成 gauge
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, prefix, fn):
+        """把既有的 stats() 接上來：數值欄位輸出成 <prefix>_<key>，一層巢狀 dict 轉成 key 標籤"""
+        with self._lock:
+            self._collectors.append((prefix, fn))
+
+    def _render_collector(self, prefix, fn):
+        try:
+            stats = fn()
+        except Exception as e:
+            return [f"# collector {prefix} failed: {type(e).__name__}"]
+        lines = []
+        for key, value in sorted(stats.items()):
+            name = f"{prefix}_{key}"
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+            elif isinstance(value, dict):
+                rows = []
+                for sub_key, sub_value in sorted(value.items()):
+                    if isinstance(sub_value, (int, float)) and not isinstance(sub_value, bool):
+                        rows.append(f'{name}{{key="{_escape(sub_key)}"}} {sub_value}')
+                    elif isinstance(sub_value, dict):
+                        for field, v in sorted(sub_value.items()):
+                            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                                rows.append(f'{name}_{field}{{key="{_escape(sub_key)}"}} {v}')
+                lines += rows
+        return lines
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for prefix, fn in collectors:
+            lines += self._render_collector(prefix, fn)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# === 📊 共用指標 ===
+# 背景工作也記在這裡，stage 為 "job:<模組>.<函式>"
+stage_seconds = registry.register(Histogram(
+    "linebot_stage_seconds", "各處理階段耗時（秒）", labels=("mode", "stage")))
+job_wait_seconds = registry.register(Histogram(
+    "linebot_job_wait_seconds", "背景工作在佇列中等待的時間（秒）", labels=("mode",)))
+errors_total = registry.register(Counter(
+    "linebot_errors_total", "各階段發生的例外次數", labels=("mode", "stage", "type")))
+llm_seconds = registry.register(Histogram(
+    "linebot_llm_seconds", "GPT 呼叫耗時（含重試，秒）", labels=("mode", "context", "model")))
+llm_route_total = registry.register(Counter(
+    "linebot_llm_route_total", "模型路由結果（fallback = 退回 default 等級）", labels=("route", "tier", "result")))
+llm_in_flight = registry.register(Gauge(
+    "linebot_llm_in_flight", "進行中的 GPT 呼叫數", labels=("context",)))
+llm_tokens_total = registry.register(Counter(
+    "linebot_llm_tokens_total", "GPT 使用的 token 數", labels=("context", "kind")))
+webhook_events_total = registry.register(Counter(
+    "linebot_webhook_events_total", "收到的 webhook 事件", labels=("type", "result")))
+reply_path_total = registry.register(Counter(
+    "linebot_reply_path_total", "GPT 答案走 reply token（reply/cached）還是等待語 + push（fallback）",
+    labels=("mode", "path")))
+coalesced_messages_total = registry.register(Counter(
+    "linebot_coalesced_messages_total", "連發訊息合併後省下的 GPT 呼叫數", labels=("mode",)))
+grade_seconds = registry.register(Histogram(
+    "linebot_grade_seconds", "本機編譯 + 跑測資的總時間（秒）", labels=("result",)))
+outbox_delivery_seconds = registry.register(Histogram(
+    "linebot_outbox_delivery_seconds", "push 訊息從進出件匣到 LINE 收下的時間（秒）", labels=("mode",)))
+
+
+@contextmanager
+def stage(name, mode=None):
+    """量一個處理階段：耗時進 linebot_stage_seconds，例外依型別計數後照樣往外丟
+
+    沒指定 mode 時在結束那一刻取 current_mode()，所以區塊裡才決定的模式也標得到。
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        errors_total.inc(mode=mode or current_mode(), stage=name, type=type(e).__name__)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, mode=mode or current_mode(), stage=name)
+
+
+def timed(name):
+    """stage() 的 decorator 版本（async 函式會量到 await 結束為止）"""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument(obj, method_names, prefix=""):
+    """把物件上的方法包一層 stage()，例如 LINE 的 reply_message / push_message"""
+    for method_name in method_names:
+        original = getattr(obj, method_name)
+        setattr(obj, method_name, timed(prefix + method_name)(original))
+    return obj
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,186 @@
+import contextvars
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import intents
+import metrics
+
+
+# === ⚙️ 模型等級 ===
+# timeout / deadline / max_retries 是這個等級自己的；便宜模型時限短一點，失敗或逾時就退回 default
+DEFAULT_TIER = "default"
+MODEL_TIERS = {
+    "default": {"model": os.getenv("OPENAI_MODEL", "gpt-4o")},
+    "cheap": {"model": os.getenv("OPENAI_CHEAP_MODEL", "gpt-4o-mini"),
+              "timeout": 10, "deadline": 15, "max_retries": 1},
+    "finetuned": {"model": os.getenv("OPENAI_FINETUNED_MODEL", "ft:gpt-4o-2024-08-06:personal::B5sbnkYa"),
+                  "timeout": 20, "deadline": 25, "max_retries": 1},
+}
+
+# 每百萬 token 的美元價格（輸入, 輸出），給用量與離線評估估成本
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "ft:gpt-4o": (3.75, 15.00),
+}
+
+# === 🧭 路由表 ===
+# 由上往下比對，第一條符合的生效；沒寫的條件就不限制
+#   modes    目前請求的模式（metrics.current_mode()）
+#   contexts llm_gateway 的 context 參數
+#   intents  最後一則 user 訊息分類出的意圖（任一命中即可）
+#   length   預期回答長度 short / medium / long
+DEFAULT_ROUTES = [
+    {"name": "rolling_summary", "contexts": ["rolling_summary"], "tier": "cheap"},
+    {"name": "code_request", "modes": ["passive", "interactive"], "intents": ["code_request"], "tier": "finetuned"},
+    {"name": "passive_short", "modes": ["passive"], "length": ["short"], "tier": "cheap"},
+    {"name": "default", "tier": "default"},
+]
+MODEL_ROUTES_FILE = os.getenv("MODEL_ROUTES_FILE")  # JSON 檔，格式同 DEFAULT_ROUTES
+MODEL_ROUTER_ENABLED = os.getenv("MODEL_ROUTER_ENABLED", "1") == "1"
+
+# 預期回答長度：這些 context 本來就要長篇解釋
+LONG_CONTEXTS = {"explain_answer", "interactive_learning", "active_question", "daily_challenge"}
+LONG_ANSWER_HINTS = ("解釋", "為什麼", "範例", "比較", "差別", "詳細", "步驟", "explain", "why", "example", "compare")
+SHORT_PROMPT_CHARS = 40
+
+
+class Route:
+    __slots__ = ("name", "tier", "model", "timeout", "deadline", "max_retries")
+
+    def __init__(self, name, tier):
+        spec = MODEL_TIERS[tier]
+        self.name = name
+        self.tier = tier
+        self.model = spec["model"]
+        self.timeout = spec.get("timeout")
+        self.deadline = spec.get("deadline")
+        self.max_retries = spec.get("max_retries")
+
+    @property
+    def is_default(self):
+        return self.tier == DEFAULT_TIER
+
+    def __repr__(self):
+        return f"Route({self.name} → {self.tier}:{self.model})"
+
+
+def load_routes(path=MODEL_ROUTES_FILE):
+    if not path:
+        return DEFAULT_ROUTES
+    with open(path, encoding="utf-8") as f:
+        routes = json.load(f)
+    unknown = {r.get("tier") for r in routes} - set(MODEL_TIERS)
+    if unknown:
+        raise ValueError(f"路由表裡有未知的模型等級: {unknown}")
+    return routes
+
+
+ROUTES = load_routes()
+
+
+# === 🔍 請求特徵 ===
+def last_user_text(messages):
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return str(message.get("content") or "")
+    return ""
+
+
+def expected_length(context, text):
+    if context in LONG_CONTEXTS:
+        return "long"
+    lowered = text.lower()
+    if any(hint in lowered for hint in LONG_ANSWER_HINTS):
+        return "long"
+    return "short" if len(text.strip()) <= SHORT_PROMPT_CHARS else "medium"
+
+
+def features(messages, context, mode=None):
+    text = last_user_text(messages)
+    return {
+        "mode": mode or metrics.current_mode(),
+        "context": context,
+        "intents": set(intents.classify(text).scores),
+        "length": expected_length(context, text),
+    }
+
+
+def _matches(rule, feats):
+    if "modes" in rule and feats["mode"] not in rule["modes"]:
+        return False
+    if "contexts" in rule and feats["context"] not in rule["contexts"]:
+        return False
+    if "intents" in rule and not feats["intents"] & set(rule["intents"]):
+        return False
+    if "length" in rule and feats["length"] not in rule["length"]:
+        return False
+    return True
+
+
+def default_route():
+    return Route("default", DEFAULT_TIER)
+
+
+def route(messages, context, mode=None, routes=None):
+    """依模式、意圖、預期回答長度挑一個模型等級"""
+    if not MODEL_ROUTER_ENABLED:
+        return default_route()
+    feats = features(messages, context, mode)
+    for rule in routes or ROUTES:
+        if _matches(rule, feats):
+            return Route(rule["name"], rule["tier"])
+    return default_route()
+
+
+# === 🏷️ 目前這次呼叫走哪條路由（給用量紀錄貼標籤） ===
+_current = contextvars.ContextVar("linebot_route", default=None)
+
+
+def current_route():
+    return _current.get()
+
+
+@contextmanager
+def using(route_):
+    """區塊內的 GPT 用量紀錄都標上這條路由"""
+    token = _current.set(route_)
+    try:
+        yield route_
+    finally:
+        _current.reset(token)
+
+
+# === 📊 統計 ===
+_stats_lock = threading.Lock()
+_stats = {}  # route name → {"calls", "fallbacks"}
+
+
+def record(route_, fell_back=False):
+    with _stats_lock:
+        entry = _stats.setdefault(route_.name, {"calls": 0, "fallbacks": 0})
+        entry["calls"] += 1
+        entry["fallbacks"] += 1 if fell_back else 0
+    metrics.llm_route_total.inc(route=route_.name, tier=route_.tier, result="fallback" if fell_back else "ok")
+
+
+def stats():
+    with _stats_lock:
+        return {"routes": {name: dict(entry) for name, entry in _stats.items()}}
+
+
+def price_for(model):
+    """找價格：完全相同的名稱優先，否則用最長的前綴（ft:gpt-4o-2024-08-06:... → ft:gpt-4o）"""
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    prefixes = [name for name in MODEL_PRICES if model.startswith(name)]
+    return MODEL_PRICES[max(prefixes, key=len)] if prefixes else None
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    price = price_for(model)
+    if price is None:
+        return None
+    return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
@@ -0,0 +1,32 @@
+# === 🔀 學習模式切換（Flask 與 async 兩個入口共用） ===
+MODE_MAP = {
+    "mode_passive": "passive",
+    "mode_active": "active",
+    "mode_constructive": "constructive",
+    "mode_interactive": "interactive"
+}
+
+MODE_DESCRIPTIONS = {
+    "passive": "你會以閱讀為主，我會盡量簡潔地回答你，不主動提問。",
+    "active": "我會給你一些挑戰性的問題，讓你主動思考和作答。",
+    "constructive": "我會根據你的回答，進一步追問，幫助你深化想法。",
+    "interactive": "我們會像朋友一樣對話，一起討論主題和觀點。"
+}
+
+
+def switch_reply_text(user_text, question=None):
+    """切換模式後的回覆；主動模式會附上第一題"""
+    mode_key = MODE_MAP[user_text]
+    mode_name = user_text.replace("mode_", "").capitalize()
+    description = MODE_DESCRIPTIONS[mode_key]
+    if question is not None:
+        return f"已切換至『{mode_name}』模式\n\n{description}\n\n第一題：{question}\n\n你覺得答案是什麼？"
+    return f"已切換至『{mode_name}』模式\n\n{description}"
+
+
+def first_question_state(question):
+    return {
+        "mode": "active",
+        "last_question": question,
+        "awaiting_answer": True
+    }
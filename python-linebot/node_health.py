@@ -0,0 +1,387 @@
+"""Node/Mongo 這個依賴的健康狀態：探測、斷路器、對沖讀取、寫入落地
+
+Node 跑在 Render 上會冷啟動。以前 Node 睡著時 load_history 最久會卡住 webhook 將近 100 秒；
+現在由背景探測 /health 決定 Node 能不能用：
+
+- 讀：正常時第一個請求太慢就再送一個（對沖），先回來的贏；斷路器開著就直接丟 NodeUnavailable，
+  呼叫端改用本地快取（降級模式）
+- 寫：Node 不能用時整批寫進本地的落地檔（JSONL），恢復後背景依序補送
+- 探測本身也讓 Render 不會睡著，啟動時順便把連線池暖好
+"""
+import asyncio
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from llm_gateway import CircuitBreaker
+
+
+# === ⚙️ 設定 ===
+NODE_SERVER_URL = os.getenv("NODE_SERVER_URL", "https://node-mongo-b008.onrender.com")
+NODE_POOL_SIZE = int(os.getenv("PERSIST_POOL_SIZE", "10"))
+NODE_HEALTH_INTERVAL = float(os.getenv("NODE_HEALTH_INTERVAL", "30"))          # 正常時多久探測一次
+NODE_HEALTH_DOWN_INTERVAL = float(os.getenv("NODE_HEALTH_DOWN_INTERVAL", "5"))  # 掛掉時多久探測一次
+NODE_HEALTH_TIMEOUT = float(os.getenv("NODE_HEALTH_TIMEOUT", "5"))
+NODE_READ_TIMEOUT = float(os.getenv("NODE_READ_TIMEOUT", "4"))      # 讀取的總時限（含對沖）
+NODE_HEDGE_AFTER = float(os.getenv("NODE_HEDGE_AFTER", "0.8"))      # 第一個請求超過這麼久沒回來就再送一個
+NODE_BREAKER_THRESHOLD = int(os.getenv("NODE_BREAKER_THRESHOLD", "3"))
+NODE_BREAKER_RESET = float(os.getenv("NODE_BREAKER_RESET", "15"))
+NODE_SPOOL_DIR = os.getenv("NODE_SPOOL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "node_spool"))
+NODE_SPOOL_MAX_BYTES = int(os.getenv("NODE_SPOOL_MAX_BYTES", str(100 * 1024 * 1024)))
+NODE_REPLAY_TIMEOUT = 30
+
+
+class NodeUnavailable(Exception):
+    """Node 目前不能用（斷路器開著，或這次讀取失敗 / 逾時）"""
+
+
+def make_session(pool_size=NODE_POOL_SIZE):
+    """建立共用連線池的 Session（避免每次都重新 TLS 握手）"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@contextmanager
+def _file_lock(path, blocking=True):
+    """跨 process 的檔案鎖（flock）；blocking=False 時拿不到就 yield False"""
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# === 💾 寫入落地（Node 不能用時先寫到磁碟，恢復後補送） ===
+class WriteSpool:
+    """每行一筆 {"path": "/save_messages", "payload": {...}}；補送時先把檔案改名，新的寫入另開一個檔
+
+    落地目錄是所有 gunicorn worker 共用的：寫入和改名都拿 spool.lock，補送拿 replay.lock（同時只有一個 worker 在補送，
+    不會重複送）；解析不了的行（例如寫到一半當掉）移到 spool.bad，不會卡住後面的補送
+    """
+
+    def __init__(self, directory=NODE_SPOOL_DIR, max_bytes=NODE_SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._stats = {"spooled_requests": 0, "replayed_requests": 0, "dropped_requests": 0, "replay_failures": 0,
+                       "quarantined_lines": 0}
+
+    def _live_path(self):
+        return os.path.join(self.directory, "spool.jsonl")
+
+    def _lock_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _quarantine(self, line):
+        with open(os.path.join(self.directory, "spool.bad"), "a", encoding="utf-8") as f:
+            f.write(line if line.endswith("\n") else line + "\n")
+        with self._lock:
+            self._stats["quarantined_lines"] += 1
+
+    def _files(self):
+        """待補送的檔案，依時間順序：之前補送到一半的在前，live 檔最後"""
+        return sorted(glob.glob(os.path.join(self.directory, "spool-*.jsonl")))
+
+    def size(self):
+        total = 0
+        for path in self._files() + [self._live_path()]:
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                continue  # 不存在，或剛被別的 worker 補送完刪掉
+        return total
+
+    def append(self, path, payload):
+        line = json.dumps({"path": path, "payload": payload}, ensure_ascii=False) + "\n"
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with _file_lock(self._lock_path("spool.lock")):
+                if self.size() + len(line) > self.max_bytes:
+                    self._stats["dropped_requests"] += 1
+                    print(f"⚠️ 落地檔超過上限，丟棄一筆寫入 {path}")
+                    return False
+                data = line.encode("utf-8")
+                with open(self._live_path(), "ab+") as f:
+                    # 上一筆寫到一半就當掉的話先補換行，壞掉的只有那一行，這筆不會被黏進去
+                    if f.seek(0, os.SEEK_END):
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            data = b"\n" + data
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._stats["spooled_requests"] += 1
+        return True
+
+    def pending(self):
+        return bool(self._files()) or os.path.exists(self._live_path())
+
+    def replay(self, session, base_url):
+        """依序補送；某一筆失敗就停下來，剩下的留在檔案裡下次再送。回傳補送成功的筆數
+        別的 worker 正在補送就直接回傳 0"""
+        if not self._replay_lock.acquire(blocking=False):
+            return 0
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with _file_lock(self._lock_path("replay.lock"), blocking=False) as acquired:
+                return self._replay(session, base_url) if acquired else 0
+        finally:
+            self._replay_lock.release()
+
+    def _replay(self, session, base_url):
+        with self._lock, _file_lock(self._lock_path("spool.lock")):
+            if os.path.exists(self._live_path()):
+                os.replace(self._live_path(),
+                           os.path.join(self.directory, f"spool-{time.time_ns():020d}.jsonl"))
+        sent = 0
+        for spool_path in self._files():
+            with open(spool_path, encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+            for i, line in enumerate(lines):
+                try:
+                    entry = json.loads(line)
+                    path, payload = entry["path"], entry["payload"]
+                except (ValueError, TypeError, KeyError) as e:
+                    print(f"⚠️ 落地檔有一行解析不了，移到 spool.bad: {e}")
+                    self._quarantine(line)
+                    continue
+                try:
+                    response = session.post(f"{base_url}{path}", json=payload, timeout=NODE_REPLAY_TIMEOUT)
+                    response.raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    print(f"❌ 補送落地的寫入失敗，剩 {len(lines) - i} 筆下次再送: {e}")
+                    tmp_path = spool_path + ".tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        f.writelines(lines[i:])
+                    os.replace(tmp_path, spool_path)
+                    with self._lock:
+                        self._stats["replay_failures"] += 1
+                    return sent
+                sent += 1
+                with self._lock:
+                    self._stats["replayed_requests"] += 1
+            os.remove(spool_path)
+        if sent:
+            print(f"✅ 補送落地的寫入 {sent} 筆")
+        return sent
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["spool_bytes"] = self.size() if os.path.isdir(self.directory) else 0
+        return snapshot
+
+
+# === 🩺 健康狀態 ===
+class NodeHealth:
+    def __init__(self, base_url=NODE_SERVER_URL, session=None, pool_size=NODE_POOL_SIZE,
+                 interval=NODE_HEALTH_INTERVAL, down_interval=NODE_HEALTH_DOWN_INTERVAL,
+                 read_timeout=NODE_READ_TIMEOUT, hedge_after=NODE_HEDGE_AFTER, spool=None):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.session = session or make_session(pool_size)
+        self.interval = interval
+        self.down_interval = down_interval
+        self.read_timeout = read_timeout
+        self.hedge_after = hedge_after
+        self.breaker = CircuitBreaker(NODE_BREAKER_THRESHOLD, NODE_BREAKER_RESET, name="Node")
+        self.spool = spool or WriteSpool()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="node-read")
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {"probes": 0, "probe_failures": 0, "reads": 0, "read_failures": 0, "hedged": 0,
+                       "hedge_wins": 0, "short_circuited": 0, "outages": 0, "loop_errors": 0}
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    # --- 背景探測 ---
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="node-health", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # 只有這條執行緒會把斷路器關回來，所以任何例外都不能讓它結束
+        try:
+            self.prewarm()
+        except Exception as e:
+            print(f"❌ Node 連線池預熱失敗: {e}")
+        while True:
+            healthy = False
+            try:
+                healthy = self.probe()
+                if healthy and self.spool.pending():
+                    self.spool.replay(self.session, self.base_url)
+            except Exception as e:
+                self._count("loop_errors")
+                print(f"❌ Node 健康檢查迴圈發生錯誤 ({type(e).__name__}): {e}")
+            time.sleep(self.interval if healthy else self.down_interval)
+
+    def prewarm(self):
+        """同時打 pool_size 次 /health，把連線池裡的連線先建好（也順便叫醒冷啟動中的 Node）"""
+        list(self._executor.map(lambda _: self.probe(record=False), range(self.pool_size)))
+
+    def probe(self, record=True):
+        was_available = self.available()
+        try:
+            response = self.session.get(f"{self.base_url}/health", timeout=NODE_HEALTH_TIMEOUT)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if record:
+                self._count("probes")
+                self._count("probe_failures")
+                self.record_failure()
+                if not self.available() and was_available:
+                    print(f"⚠️ Node 探測失敗，切換到降級模式: {e}")
+            return False
+        if record:
+            self._count("probes")
+            self.breaker.record_success()
+            if not was_available:
+                print("✅ Node 恢復，離開降級模式")
+        return True
+
+    # --- 狀態 ---
+    def available(self):
+        """斷路器關著才算可用；半開時由背景探測去試，不拿學生的請求冒險"""
+        return self.breaker.state == "closed"
+
+    def record_failure(self):
+        was_available = self.available()
+        self.breaker.record_failure()
+        if was_available and not self.available():
+            self._count("outages")
+
+    # --- 對沖讀取 ---
+    def _get(self, path, params):
+        response = self.session.get(f"{self.base_url}{path}", params=params, timeout=self.read_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_json(self, path, params=None):
+        """GET 並回傳 JSON；第一個請求超過 hedge_after 秒就再送一個，先成功的贏。不能用時丟 NodeUnavailable"""
+        if not self.available():
+            self._count("short_circuited")
+            raise NodeUnavailable(f"Node 降級中，略過 {path}")
+        self.start()
+        self._count("reads")
+        start = time.monotonic()
+        first = self._executor.submit(self._get, path, params)
+        futures = [first]
+        done, _ = wait(futures, timeout=self.hedge_after)
+        if not done:
+            self._count("hedged")
+            futures.append(self._executor.submit(self._get, path, params))
+        error = None
+        while futures:
+            remaining = self.read_timeout - (time.monotonic() - start)
+            done, _ = wait(futures, timeout=max(remaining, 0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None:
+                    if future is not first:
+                        self._count("hedge_wins")
+                    self.breaker.record_success()
+                    return future.result()
+                error = future.exception()
+        self._count("read_failures")
+        self.record_failure()
+        metrics.errors_total.inc(mode=metrics.current_mode(), stage="node_read",
+                                 type=type(error).__name__ if error else "Timeout")
+        raise NodeUnavailable(f"讀取 {path} 失敗: {error or '逾時'}")
+
+    async def aget_json(self, session, path, params=None):
+        """asyncio 版（aiohttp session），一樣的對沖與斷路器"""
+        if not self.available():
+            self._count("short_circuited")
+            raise NodeUnavailable(f"Node 降級中，略過 {path}")
+        self.start()
+        self._count("reads")
+
+        async def _get():
+            async with session.get(f"{self.base_url}{path}", params=params,
+                                   timeout=aiohttp.ClientTimeout(total=self.read_timeout)) as response:
+                response.raise_for_status()
+                return await response.json()
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.read_timeout
+        first = asyncio.create_task(_get())
+        tasks = {first}
+        done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+        if not done:
+            self._count("hedged")
+            tasks.add(asyncio.create_task(_get()))
+        error = None
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=max(deadline - loop.time(), 0),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count("hedge_wins")
+                        self.breaker.record_success()
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+        self._count("read_failures")
+        self.record_failure()
+        metrics.errors_total.inc(mode=metrics.current_mode(), stage="node_read",
+                                 type=type(error).__name__ if error else "Timeout")
+        raise NodeUnavailable(f"讀取 {path} 失敗: {error or '逾時'}")
+
+    # --- 寫入 ---
+    def post_or_spool(self, path, payload, timeout=10):
+        """Node 可用就直接送，不能用或送失敗就寫進落地檔；回傳 "sent" / "spooled" / "dropped" """
+        if self.available():
+            try:
+                response = self.session.post(f"{self.base_url}{path}", json=payload, timeout=timeout)
+                response.raise_for_status()
+                return "sent"
+            except requests.exceptions.RequestException as e:
+                print(f"❌ 寫入 {path} 失敗，改寫進落地檔: {e}")
+                self.record_failure()
+        return "spooled" if self.spool.append(path, payload) else "dropped"
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["available"] = self.available()
+        snapshot["breaker_open"] = self.breaker.state == "open"
+        snapshot.update(self.spool.stats())
+        return snapshot
+
+
+# === 🌐 全域共用 ===
+monitor = NodeHealth()
@@ -0,0 +1,299 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from linebot.exceptions import LineBotApiError
+
+import metrics
+
+
+# === ⚙️ 設定 ===
+OUTBOX_COALESCE_WINDOW = float(os.getenv("OUTBOX_COALESCE_WINDOW", "0.3"))  # 同一位使用者在這段時間內的訊息合併成一次 push
+OUTBOX_MAX_MESSAGES = int(os.getenv("OUTBOX_MAX_MESSAGES", "5"))            # LINE 一次 push 最多 5 則
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "50"))                        # 每秒最多幾次 push
+OUTBOX_BURST = int(os.getenv("OUTBOX_BURST", "50"))
+OUTBOX_SENDERS = int(os.getenv("OUTBOX_SENDERS", "4"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "4"))
+OUTBOX_MAX_PENDING = int(os.getenv("OUTBOX_MAX_PENDING", "20000"))         # 所有使用者合計，超過就丟最舊的
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "1"))
+
+
+class TokenBucket:
+    """簡單的 token bucket：每秒補 rate 個，最多存 burst 個"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """拿一個 token，不夠就睡到補上為止；回傳等了幾秒"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class Outbox:
+    """LINE push 的出件匣：同一位使用者的訊息先等一小段時間合併，再用 token bucket 控制送出速度
+
+    - 每位使用者一條 FIFO；同一時間只會有一批在送，所以順序不會亂
+    - 一次 push 最多 OUTBOX_MAX_MESSAGES 則，多的下一批立刻接著送（不再等合併時間）
+    - 429 依 Retry-After（沒有就指數退避）暫停整個出件匣；5xx / 連線錯誤重試，4xx 直接丟棄
+    """
+
+    def __init__(self, line_bot_api, window=OUTBOX_COALESCE_WINDOW, max_messages=OUTBOX_MAX_MESSAGES,
+                 rate=OUTBOX_RATE, burst=OUTBOX_BURST, senders=OUTBOX_SENDERS,
+                 max_retries=OUTBOX_MAX_RETRIES, max_pending=OUTBOX_MAX_PENDING, name="outbox"):
+        self.line_bot_api = line_bot_api
+        self.window = window
+        self.max_messages = max_messages
+        self.senders = senders
+        self.max_retries = max_retries
+        self.max_pending = max_pending
+        self.name = name
+        self._bucket = TokenBucket(rate, burst)
+        self._cond = threading.Condition()
+        self._queues = {}      # user_id → deque[(enqueued_at, mode, message)]
+        self._ready = []       # heap[(due, seq, user_id)]：輪到誰送
+        self._scheduled = set()  # 已在 heap 裡或正在送的使用者
+        self._seq = itertools.count()
+        self._pending = 0
+        self._sending = 0
+        self._paused_until = 0.0
+        self._threads = []
+        self._stats = {
+            "enqueued": 0,
+            "delivered": 0,
+            "pushes": 0,
+            "coalesced": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "failed_pushes": 0,
+            "dropped": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+            "throttle_wait_total": 0.0,
+        }
+
+    # --- 啟動（第一次 push 才開執行緒） ---
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.senders):
+                t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    # --- 放進出件匣（不會卡住呼叫端） ---
+    def push(self, user_id, messages):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        if not messages:
+            return
+        self._ensure_started()
+        now = time.monotonic()
+        mode = metrics.current_mode()
+        with self._cond:
+            queue = self._queues.setdefault(user_id, deque())
+            queue.extend((now, mode, m) for m in messages)
+            self._pending += len(messages)
+            self._stats["enqueued"] += len(messages)
+            if self._pending > self.max_pending:
+                self._drop_oldest(queue)
+            if user_id not in self._scheduled:
+                self._scheduled.add(user_id)
+                heapq.heappush(self._ready, (now + self.window, next(self._seq), user_id))
+                self._cond.notify()
+
+    def _drop_oldest(self, queue):
+        # 出件匣爆了（通常是 LINE 長時間 429）：從這位使用者最舊的訊息開始丟
+        overflow = min(len(queue), self._pending - self.max_pending)
+        for _ in range(overflow):
+            queue.popleft()
+        self._pending -= overflow
+        self._stats["dropped"] += overflow
+        print(f"⚠️ 推播佇列過長，丟棄 {overflow} 則訊息")
+
+    # --- 送出 ---
+    def _take(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                if self._ready:
+                    due = max(self._ready[0][0], self._paused_until)
+                    if due <= now:
+                        _, _, user_id = heapq.heappop(self._ready)
+                        queue = self._queues.get(user_id) or deque()
+                        batch = [queue.popleft() for _ in range(min(self.max_messages, len(queue)))]
+                        self._pending -= len(batch)
+                        self._sending += 1
+                        return user_id, batch
+                    timeout = due - now
+                self._cond.wait(timeout)
+
+    def _finish(self, user_id):
+        with self._cond:
+            self._sending -= 1
+            queue = self._queues.get(user_id)
+            if queue:
+                # 送的時候又有新訊息（或超過 5 則）：接著送，不用再等合併時間
+                heapq.heappush(self._ready, (time.monotonic(), next(self._seq), user_id))
+                self._cond.notify()
+            else:
+                self._queues.pop(user_id, None)
+                self._scheduled.discard(user_id)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            user_id, batch = self._take()
+            try:
+                if batch:
+                    self._deliver(user_id, batch)
+            finally:
+                self._finish(user_id)
+
+    def _pause(self, delay):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            return self._paused_until
+
+    def _deliver(self, user_id, batch):
+        messages = [m for _, _, m in batch]
+        mode = batch[0][1]
+        retry_key = str(uuid.uuid4())  # 重試時讓 LINE 去重，不會重複推播
+        for attempt in range(self.max_retries + 1):
+            with self._cond:
+                resume_at = self._paused_until
+            if resume_at > time.monotonic():
+                time.sleep(resume_at - time.monotonic())
+            throttled = self._bucket.acquire()
+            try:
+                with metrics.mode_context(mode):
+                    self.line_bot_api.push_message(user_id, messages, retry_key=retry_key)
+            except LineBotApiError as e:
+                status = e.status_code
+                if status == 409:
+                    break  # 同一個 retry key 已經送過了
+                if status == 429:
+                    delay = _retry_after(e) or OUTBOX_BACKOFF * 2 ** attempt
+                    self._pause(delay)
+                    with self._cond:
+                        self._stats["rate_limited"] += 1
+                    print(f"⏳ LINE push 被限流，{delay:.1f}s 後再送")
+                elif status < 500:
+                    print(f"❌ LINE push 失敗（{status}），丟棄 {len(messages)} 則: {e}")
+                    self._fail(batch)
+                    return
+                else:
+                    print(f"❌ LINE push 失敗（{status}），準備重試: {e}")
+                    time.sleep(OUTBOX_BACKOFF * 2 ** attempt)
+            except Exception as e:
+                print(f"❌ LINE push 連線錯誤，準備重試: {e}")
+                time.sleep(OUTBOX_BACKOFF * 2 ** attempt)
+            else:
+                break
+            with self._cond:
+                self._stats["retries"] += 1
+        else:
+            print(f"❌ LINE push 重試 {self.max_retries} 次仍失敗，丟棄 {len(messages)} 則")
+            self._fail(batch)
+            return
+
+        now = time.monotonic()
+        with self._cond:
+            self._stats["pushes"] += 1
+            self._stats["delivered"] += len(batch)
+            self._stats["coalesced"] += len(batch) - 1
+            self._stats["throttle_wait_total"] += throttled
+            for enqueued_at, _, _ in batch:
+                latency = now - enqueued_at
+                self._stats["latency_total"] += latency
+                self._stats["latency_max"] = max(self._stats["latency_max"], latency)
+        for enqueued_at, msg_mode, _ in batch:
+            metrics.outbox_delivery_seconds.observe(now - enqueued_at, mode=msg_mode)
+
+    def _fail(self, batch):
+        with self._cond:
+            self._stats["failed_pushes"] += 1
+            self._stats["dropped"] += len(batch)
+        metrics.errors_total.inc(mode=batch[0][1], stage="outbox_push", type="dropped")
+
+    # --- 查詢 / 關機 ---
+    def depth(self, user_id):
+        with self._cond:
+            return len(self._queues.get(user_id) or ())
+
+    def flush(self, timeout=10):
+        """等出件匣清空（關機前用）；回傳是否全部送完"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self, top=5):
+        with self._cond:
+            snapshot = dict(self._stats)
+            depths = {user_id: len(q) for user_id, q in self._queues.items() if q}
+            snapshot["pending"] = self._pending
+            snapshot["sending"] = self._sending
+            snapshot["users_waiting"] = len(depths)
+            snapshot["paused"] = self._paused_until > time.monotonic()
+        delivered = snapshot["delivered"]
+        snapshot["latency_avg"] = snapshot["latency_total"] / delivered if delivered else 0.0
+        snapshot["depth_max"] = max(depths.values(), default=0)
+        snapshot["deepest"] = dict(sorted(depths.items(), key=lambda kv: -kv[1])[:top])
+        return snapshot
+
+
+class OutboxLineBotApi:
+    """包住 LineBotApi：push_message 改走出件匣，其餘（reply / multicast ...）照舊直接呼叫"""
+
+    def __init__(self, line_bot_api, outbox):
+        self.api = line_bot_api
+        self.outbox = outbox
+
+    def push_message(self, to, messages, **kwargs):
+        self.outbox.push(to, messages)
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+
+class AsyncOutboxLineBotApi(OutboxLineBotApi):
+    """給 async_app 用：await push_message 只是放進出件匣，立刻返回"""
+
+    async def push_message(self, to, messages, **kwargs):
+        self.outbox.push(to, messages)
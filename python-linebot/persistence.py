@@ -0,0 +1,169 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+import history_cache
+import node_health
+from node_health import NODE_SERVER_URL, make_session  # noqa: F401（其他模組從這裡 import）
+
+
+# === ⚙️ 設定 ===
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "50"))
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "2"))
+PERSIST_MAX_BUFFER = int(os.getenv("PERSIST_MAX_BUFFER", "5000"))
+PERSIST_BULK_CHUNK = int(os.getenv("PERSIST_BULK_CHUNK", "1000"))
+
+
+class PersistenceClient:
+    """寫入 Node/Mongo 的客戶端：先暫存在記憶體，滿批次或到時間再一次送出
+
+    Node 不能用（node_health 的斷路器開著）時不等逾時，整批直接寫進落地檔，恢復後由 node_health 補送。
+    """
+
+    def __init__(self, base_url=NODE_SERVER_URL, batch_size=PERSIST_BATCH_SIZE,
+                 flush_interval=PERSIST_FLUSH_INTERVAL, max_buffer=PERSIST_MAX_BUFFER,
+                 session=None, health=None):
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.health = health or node_health.monitor
+        self.session = session or self.health.session  # 跟健康探測共用暖好的連線池
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stats = {"queued": 0, "sent": 0, "batches": 0, "failed_batches": 0, "dropped": 0, "spooled": 0}
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="persistence-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buffer) >= self.batch_size, timeout=self.flush_interval)
+            if self.flush() is False:
+                time.sleep(self.flush_interval)  # Node 掛掉時不要一直重打
+
+    # --- 寫入（非同步，不會卡住 webhook） ---
+    @staticmethod
+    def make_record(user_id, message_text="", bot_response="", message_type="text"):
+        return {
+            "user_id": user_id,
+            "message_text": message_text or "",
+            "bot_response": bot_response or "",
+            "message_type": message_type,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def save_message(self, user_id, message_text="", bot_response="", message_type="text"):
+        record = self.make_record(user_id, message_text, bot_response, message_type)
+        self._ensure_started()
+        with self._cond:
+            self._buffer.append(record)
+            self._stats["queued"] += 1
+            if len(self._buffer) > self.max_buffer:
+                overflow = len(self._buffer) - self.max_buffer
+                del self._buffer[:overflow]
+                self._stats["dropped"] += overflow
+                print(f"⚠️ 儲存佇列過長，丟棄最舊的 {overflow} 筆訊息")
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+        return record
+
+    def save_many(self, records, chunk_size=PERSIST_BULK_CHUNK):
+        """大量寫入（例如每日挑戰群發）：直接分塊送 /save_messages，失敗的塊才進暫存佇列"""
+        sent = 0
+        for i in range(0, len(records), chunk_size):
+            chunk = records[i:i + chunk_size]
+            # Node 不能用或送失敗就整塊寫進落地檔，恢復後補送
+            result = self.health.post_or_spool("/save_messages", {"messages": chunk}, timeout=30)
+            with self._cond:
+                if result == "sent":
+                    sent += len(chunk)
+                    self._stats["sent"] += len(chunk)
+                    self._stats["batches"] += 1
+                elif result == "spooled":
+                    self._stats["spooled"] += len(chunk)
+                else:
+                    self._stats["dropped"] += len(chunk)
+        return sent
+
+    def _spool(self, batch):
+        with self._cond:
+            self._stats["spooled" if self.health.spool.append("/save_messages", {"messages": batch})
+                        else "dropped"] += len(batch)
+
+    def flush(self):
+        """把暫存的訊息用 /save_messages 一次送出；失敗就放回佇列下次再試"""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+            if not batch:
+                return 0
+            if not self.health.available():
+                # 降級模式：不打 Node，直接落地
+                self._spool(batch)
+                return len(batch)
+            try:
+                response = self.session.post(f"{self.base_url}/save_messages",
+                                             json={"messages": batch}, timeout=10)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                print(f"❌ 批次儲存失敗（{len(batch)} 筆）: {e}")
+                self.health.record_failure()
+                with self._cond:
+                    self._buffer[:0] = batch
+                    self._stats["failed_batches"] += 1
+                return False
+            with self._cond:
+                self._stats["sent"] += len(batch)
+                self._stats["batches"] += 1
+            print(f"✅ 批次儲存 {len(batch)} 筆訊息")
+            return len(batch)
+
+    def flush_all(self, max_rounds=100):
+        """關機前盡量把所有暫存送完，送不出去的寫進落地檔，下次啟動再補送"""
+        for _ in range(max_rounds):
+            with self._cond:
+                if not self._buffer:
+                    return
+            if not self.flush():
+                break
+        with self._cond:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            self._spool(batch)
+
+    def stats(self):
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot["buffered"] = len(self._buffer)
+        return snapshot
+
+
+# === 🌐 全域共用客戶端 ===
+client = PersistenceClient()
+atexit.register(client.flush_all)
+
+
+def save_message(user_id, message_text="", bot_response="", message_type="text"):
+    record = client.save_message(user_id, message_text, bot_response, message_type)
+    history_cache.cache.append(user_id, record)  # write-through，讓下一輪不用再回 Node 讀
+    return record
+
+
+def save_messages(records):
+    """一次儲存多筆（records 由 PersistenceClient.make_record 產生）"""
+    for record in records:
+        history_cache.cache.append(record["user_id"], record)
+    return client.save_many(records)
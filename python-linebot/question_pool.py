@@ -0,0 +1,225 @@
+import os
+import threading
+from collections import OrderedDict, deque
+
+import grader
+import llm_gateway
+import state_store
+from similarity import fingerprint, shingles, jaccard
+from worker_pool import submit
+
+
+# === ⚙️ 設定 ===
+QUESTION_POOL_TARGET = int(os.getenv("QUESTION_POOL_TARGET", "6"))          # 每個難度預先準備幾題
+QUESTION_POOL_LOW_WATERMARK = int(os.getenv("QUESTION_POOL_LOW_WATERMARK", "2"))
+QUESTION_POOL_SIMILARITY = float(os.getenv("QUESTION_POOL_SIMILARITY", "0.75"))  # Jaccard 超過視為重複
+QUESTION_POOL_RECENT = int(os.getenv("QUESTION_POOL_RECENT", "50"))          # 用來比對重複的近期題目數
+QUESTION_POOL_SEEN_USERS = int(os.getenv("QUESTION_POOL_SEEN_USERS", "5000"))
+QUESTION_POOL_SEEN_PER_USER = int(os.getenv("QUESTION_POOL_SEEN_PER_USER", "200"))
+QUESTION_POOL_WARMUP = os.getenv("QUESTION_POOL_WARMUP", "1") == "1"
+QUESTION_POOL_WARMUP_DELAY = float(os.getenv("QUESTION_POOL_WARMUP_DELAY", "10"))    # 開機後等多久才預熱
+QUESTION_POOL_WARMUP_EVERY = float(os.getenv("QUESTION_POOL_WARMUP_EVERY", "3600"))  # 這段時間內所有 worker / 重啟只預熱一次
+
+ACTIVE_LEVELS = (1, 2, 3)
+DAILY_LEVELS = ("beginner", "intermediate", "advanced")
+
+
+# === 🎯 出題 prompt ===
+def generate_active_question(level=1):
+    system_message = (
+        "你是一位 C 語言教學助手，會根據題目難度產生挑戰性問題。\n"
+        "Level 1：選擇題（簡單）\n"
+        "Level 2：填空題（中等）\n"
+        "Level 3：簡答題（進階）\n"
+        "這些難度資訊只用於內部控制，請勿顯示給使用者。\n"
+        "出題範圍從 C 語言基本語法、變數、流程控制，到進階如指標與迴圈。"
+    )
+
+    user_prompt = (
+        f"請產生一題 C 語言的問題，難度為 Level {level}。\n"
+        "請從選擇題、填空題、簡答題中擇一產生，幫助學習者思考。\n"
+        "不要提供答案。"
+    )
+
+    return llm_gateway.ask(system_message, user_prompt, context="active_question")
+
+
+def generate_daily_challenge(user_level="beginner"):
+    system_prompt = (
+        "你是一位親切、有耐心的 C 語言教練，擅長根據學生程度出一題小挑戰。\n"
+        f"目前學生等級是：{user_level.upper()}。\n"
+        "請出一題不超過 100 字的 C 語言練習題（可以是 if 判斷、迴圈、字串、指標…），用自然中文描述，盡量生活化。\n"
+        "最後加一句鼓勵，例如「你會怎麼做？」或「寫完可以傳給我看看哦 👀」\n"
+        "題目敘述裡不要提供答案。\n"
+        + grader.GENERATE_TESTS_INSTRUCTIONS
+    )
+    raw = llm_gateway.ask(system_prompt, "請給我一題每日挑戰題", context="daily_challenge")
+    # 測資跟題目一起存；參考解答只拿來驗測資，不會送給學生
+    question, solution, tests = grader.parse_generated(raw)
+    grader.register(question, grader.verified_tests(solution, tests))
+    return question
+
+
+GENERATORS = {
+    "active": generate_active_question,
+    "daily": generate_daily_challenge,
+}
+
+
+# === 🗃️ 題庫池 ===
+class QuestionPool:
+    """每個 (類型, 難度) 一個預先產生好的題目佇列，低於水位就背景補貨"""
+
+    def __init__(self, generators=GENERATORS, target=QUESTION_POOL_TARGET,
+                 low_watermark=QUESTION_POOL_LOW_WATERMARK, threshold=QUESTION_POOL_SIMILARITY):
+        self.generators = generators
+        self.target = target
+        self.low_watermark = low_watermark
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._pools = {}       # (kind, level) → deque[(fingerprint, shingles, text)]
+        self._recent = {}      # (kind, level) → deque[shingles]，近期出過的題目
+        self._refilling = set()
+        self._seen = OrderedDict()  # user_id → OrderedDict[fingerprint → None]
+        self._stats = {"served_from_pool": 0, "served_direct": 0, "generated": 0,
+                       "duplicates_dropped": 0, "refills": 0, "refill_errors": 0}
+
+    # --- 使用者看過的題目 ---
+    def _has_seen(self, user_id, fp):
+        return user_id is not None and fp in self._seen.get(user_id, ())
+
+    def _mark_seen(self, user_id, fp):
+        if user_id is None:
+            return
+        seen = self._seen.get(user_id)
+        if seen is None:
+            seen = self._seen[user_id] = OrderedDict()
+            while len(self._seen) > QUESTION_POOL_SEEN_USERS:
+                self._seen.popitem(last=False)
+        else:
+            self._seen.move_to_end(user_id)
+        seen[fp] = None
+        while len(seen) > QUESTION_POOL_SEEN_PER_USER:
+            seen.popitem(last=False)
+
+    # --- 重複檢查 + 放入題庫 ---
+    def _is_duplicate(self, key, sh):
+        candidates = [item[1] for item in self._pools.get(key, ())] + list(self._recent.get(key, ()))
+        return any(jaccard(sh, other) >= self.threshold for other in candidates)
+
+    def _remember(self, key, sh):
+        self._recent.setdefault(key, deque(maxlen=QUESTION_POOL_RECENT)).append(sh)
+
+    def add(self, kind, level, text):
+        key = (kind, level)
+        sh = shingles(text)
+        with self._lock:
+            if self._is_duplicate(key, sh):
+                self._stats["duplicates_dropped"] += 1
+                return False
+            self._pools.setdefault(key, deque()).append((fingerprint(text), sh, text))
+            return True
+
+    # --- 背景補貨 ---
+    def _schedule_refill(self, kind, level):
+        key = (kind, level)
+        with self._lock:
+            if key in self._refilling or len(self._pools.get(key, ())) >= self.low_watermark:
+                return
+            self._refilling.add(key)
+        if not submit(self._refill, kind, level, background=True):
+            with self._lock:
+                self._refilling.discard(key)
+
+    def _refill(self, kind, level):
+        key = (kind, level)
+        generator = self.generators[kind]
+        try:
+            # 重複題也算一次嘗試，避免 GPT 一直出一樣的題目時無限迴圈
+            for _ in range(self.target * 2):
+                with self._lock:
+                    if len(self._pools.get(key, ())) >= self.target:
+                        break
+                try:
+                    text = generator(level)
+                except Exception as e:
+                    with self._lock:
+                        self._stats["refill_errors"] += 1
+                    print(f"❌ 題庫補貨失敗 {key}: {e}")
+                    break
+                with self._lock:
+                    self._stats["generated"] += 1
+                self.add(kind, level, text)
+            with self._lock:
+                self._stats["refills"] += 1
+                size = len(self._pools.get(key, ()))
+            print(f"✅ 題庫補貨完成 {key}：目前 {size} 題")
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+    def warm_up(self, keys=None):
+        keys = keys or [("active", lvl) for lvl in ACTIVE_LEVELS] + [("daily", lvl) for lvl in DAILY_LEVELS]
+        for kind, level in keys:
+            self._schedule_refill(kind, level)
+
+    def warm_up_later(self, delay=QUESTION_POOL_WARMUP_DELAY, keys=None):
+        """開機後在背景等 delay 秒再預熱，不拖慢啟動；每個 gunicorn worker 都會呼叫，
+        但 QUESTION_POOL_WARMUP_EVERY 秒內只有先搶到 state_store 標記的那個會真的出題，
+        其他 worker 的題庫等第一次取題時再補（memory:// 沒辦法跨 process，每個 process 各自預熱）"""
+        def run():
+            try:
+                if not _warmups.claim("warm_up", os.getpid()):
+                    print("ℹ️ 別的 worker 已經預熱過題庫，略過")
+                    return
+                self.warm_up(keys)
+            except Exception as e:
+                print(f"❌ 題庫預熱失敗: {e}")
+
+        timer = threading.Timer(delay, run)
+        timer.name = "question-warmup"
+        timer.daemon = True
+        timer.start()
+
+    # --- 取題：記憶體 pop，題庫空了才同步呼叫 GPT ---
+    def next_question(self, kind, level, user_id=None):
+        key = (kind, level)
+        text = None
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                for i, (fp, sh, candidate) in enumerate(pool):
+                    if not self._has_seen(user_id, fp):
+                        del pool[i]
+                        self._mark_seen(user_id, fp)
+                        self._remember(key, sh)
+                        self._stats["served_from_pool"] += 1
+                        text = candidate
+                        break
+        self._schedule_refill(kind, level)
+        if text is not None:
+            return text
+
+        print(f"⚠️ 題庫 {key} 沒有可用題目，直接呼叫 GPT 出題")
+        text = self.generators[kind](level)
+        with self._lock:
+            self._stats["served_direct"] += 1
+            self._stats["generated"] += 1
+            self._mark_seen(user_id, fingerprint(text))
+            self._remember(key, shingles(text))
+        return text
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["pool_sizes"] = {f"{k}:{lvl}": len(q) for (k, lvl), q in self._pools.items()}
+        return snapshot
+
+
+# === 🌐 全域共用題庫 ===
+pool = QuestionPool()
+_warmups = state_store.make_store("question_pool_warmup", ttl=QUESTION_POOL_WARMUP_EVERY)
+
+
+def next_question(kind, level, user_id=None):
+    return pool.next_question(kind, level, user_id)
@@ -0,0 +1,230 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+import metrics
+from worker_pool import WorkerPool
+
+
+# === ⚙️ 設定 ===
+# 答案在這段時間內準備好就直接用 reply token 送（免費、少一次 API 呼叫），超過才先回等待語再 push
+REPLY_DEADLINE = float(os.getenv("REPLY_DEADLINE", "2.5"))
+# 個別模式覆寫，例如 "interactive:4,active:2"；設 0 就是舊行為（一律先回等待語）
+REPLY_DEADLINES = {
+    mode.strip(): float(seconds)
+    for mode, _, seconds in (item.partition(":") for item in os.getenv("REPLY_DEADLINES", "").split(","))
+    if mode.strip() and seconds
+}
+REPLY_SENDERS = int(os.getenv("REPLY_SENDERS", "4"))  # 送等待語的執行緒數（計時器本身不打 API）
+REPLY_FALLBACK_WAIT = 5.0                              # 等待語送出前，後面的 push 最多等它幾秒（保持先後順序）
+
+PENDING, REPLIED, FALLBACK = "pending", "replied", "fallback"
+
+_expiring = set()  # asyncio 版排好的期限 task，留參考避免被 GC
+_stats_lock = threading.Lock()
+_stats = {}  # mode → {"reply": n, "fallback": n, "reply_failed": n, "cached": n}
+
+
+def deadline_for(mode):
+    return REPLY_DEADLINES.get(mode, REPLY_DEADLINE)
+
+
+def record(mode, path):
+    """path：reply（期限內直接回）、cached（快取命中）、fallback（等待語 + push）、reply_failed"""
+    with _stats_lock:
+        counts = _stats.setdefault(mode, {"reply": 0, "cached": 0, "fallback": 0, "reply_failed": 0})
+        counts[path] += 1
+    metrics.reply_path_total.inc(mode=mode, path=path)
+
+
+def stats():
+    with _stats_lock:
+        snapshot = {mode: dict(counts) for mode, counts in _stats.items()}
+    for counts in snapshot.values():
+        total = counts["reply"] + counts["cached"] + counts["fallback"]
+        counts["fast_path_rate"] = round((counts["reply"] + counts["cached"]) / total, 4) if total else 0.0
+    return {"modes": snapshot}
+
+
+# === ⏰ 期限計時器（一條執行緒管所有 reply token，不用每則訊息開一個 Timer） ===
+class DeadlineTimer:
+    def __init__(self, name="reply-deadline"):
+        self.name = name
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def call_later(self, delay, fn):
+        self._ensure_started()
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), fn))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, fn = heapq.heappop(self._heap)
+            try:
+                fn()
+            except Exception as e:
+                print(f"❌ reply 期限處理失敗: {e}")
+
+
+timer = DeadlineTimer()
+# 等待語的 reply 在這裡送：計時器只負責改狀態，不會被 LINE API 的延遲卡住，害別人的期限一起延後；
+# 佇列滿了由計時器自己送（caller_runs），至少不會掉
+senders = WorkerPool(size=REPLY_SENDERS, queue_size=1000, llm_concurrency=1, overflow_policy="caller_runs",
+                     name="reply-send")
+
+
+# === 🏁 reply token 競賽 ===
+class ReplyRace:
+    """一個 reply token 的競賽：可以直接當 line_bot_api 傳給背景工作
+
+    期限內第一則 push_message 給這位使用者的訊息改用 reply token 送；
+    期限一到還沒送，就用 reply token 送等待語，之後的訊息照常 push。
+    _lock 只保護狀態，拿著鎖的時候不打 API。
+    """
+
+    def __init__(self, line_bot_api, reply_token, user_id, mode, waiting_text):
+        self.api = line_bot_api
+        self.reply_token = reply_token
+        self.user_id = user_id
+        self.mode = mode
+        self.waiting_text = waiting_text
+        self._state = PENDING
+        self._lock = threading.Lock()
+        self._fallback_done = threading.Event()
+
+    def _claim(self, state):
+        with self._lock:
+            if self._state != PENDING:
+                return False
+            self._state = state
+            return True
+
+    def push_message(self, to, messages, **kwargs):
+        if to == self.user_id:
+            if self._claim(REPLIED):
+                try:
+                    self.api.reply_message(self.reply_token, messages)
+                    record(self.mode, "reply")
+                    return
+                except LineBotApiError as e:
+                    print(f"⚠️ reply token 用不了，改用 push: {e}")
+                    record(self.mode, "reply_failed")
+            elif self._state == FALLBACK:
+                # 等待語還在送的話等一下，不然答案可能比等待語先到
+                self._fallback_done.wait(REPLY_FALLBACK_WAIT)
+        self.api.push_message(to, messages, **kwargs)
+
+    def expire(self):
+        """期限到了（在計時器執行緒上）：只改狀態，等待語交給 senders 送"""
+        if self._claim(FALLBACK):
+            senders.submit(self._send_waiting)
+
+    def _send_waiting(self):
+        try:
+            self.api.reply_message(self.reply_token, TextSendMessage(text=self.waiting_text))
+        except LineBotApiError as e:
+            print(f"❌ 等待語送出失敗: {e}")
+        finally:
+            self._fallback_done.set()
+        record(self.mode, "fallback")
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+
+def start(line_bot_api, event, user_id, mode, waiting_text):
+    """開一場競賽並排好期限；回傳的物件交給背景工作當 line_bot_api 用"""
+    race = ReplyRace(line_bot_api, event.reply_token, user_id, mode, waiting_text)
+    deadline = deadline_for(mode)
+    if deadline <= 0:
+        race.expire()
+    else:
+        timer.call_later(deadline, race.expire)
+    return race
+
+
+# === 🏁 asyncio 版本（給 async_app） ===
+class AsyncReplyRace:
+    def __init__(self, line_bot_api, reply_token, user_id, mode, waiting_text):
+        self.api = line_bot_api
+        self.reply_token = reply_token
+        self.user_id = user_id
+        self.mode = mode
+        self.waiting_text = waiting_text
+        self._state = PENDING
+        self._fallback_done = asyncio.Event()
+
+    def _claim(self, state):
+        # 單一事件迴圈裡沒有 await 就不會被插隊，不用鎖
+        if self._state != PENDING:
+            return False
+        self._state = state
+        return True
+
+    async def push_message(self, to, messages, **kwargs):
+        if to == self.user_id:
+            if self._claim(REPLIED):
+                try:
+                    await self.api.reply_message(self.reply_token, messages)
+                    record(self.mode, "reply")
+                    return
+                except LineBotApiError as e:
+                    print(f"⚠️ reply token 用不了，改用 push: {e}")
+                    record(self.mode, "reply_failed")
+            elif self._state == FALLBACK:
+                try:
+                    await asyncio.wait_for(self._fallback_done.wait(), REPLY_FALLBACK_WAIT)
+                except asyncio.TimeoutError:
+                    pass
+        await self.api.push_message(to, messages, **kwargs)
+
+    async def expire(self):
+        if not self._claim(FALLBACK):
+            return
+        try:
+            await self.api.reply_message(self.reply_token, TextSendMessage(text=self.waiting_text))
+        except LineBotApiError as e:
+            print(f"❌ 等待語送出失敗: {e}")
+        finally:
+            self._fallback_done.set()
+        record(self.mode, "fallback")
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+
+async def astart(line_bot_api, event, user_id, mode, waiting_text):
+    race = AsyncReplyRace(line_bot_api, event.reply_token, user_id, mode, waiting_text)
+    deadline = deadline_for(mode)
+    if deadline <= 0:
+        await race.expire()
+    else:
+        asyncio.get_running_loop().call_later(deadline, _spawn_expire, race)
+    return race
+
+
+def _spawn_expire(race):
+    task = asyncio.get_running_loop().create_task(race.expire())
+    _expiring.add(task)
+    task.add_done_callback(_expiring.discard)
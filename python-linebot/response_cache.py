@@ -0,0 +1,171 @@
+import hashlib
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from linebot.models import TextSendMessage
+
+import reply_deadline
+from persistence import save_message
+from similarity import fingerprint, normalize, shingles, symbols, jaccard, MinHasher
+
+
+# === ⚙️ 設定 ===
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.7"))  # 近似命中的 Jaccard 門檻
+RESPONSE_CACHE_SHINGLE = int(os.getenv("RESPONSE_CACHE_SHINGLE", "2"))       # 中文問題短，用 2-gram 比較敏感
+RESPONSE_CACHE_MIN_LENGTH = int(os.getenv("RESPONSE_CACHE_MIN_LENGTH", "4"))    # 太短的問題不做近似比對
+# 哪些模式要開快取（逗號分隔）
+RESPONSE_CACHE_MODES = {m.strip() for m in os.getenv("RESPONSE_CACHE_MODES", "passive,active").split(",") if m.strip()}
+
+
+def _namespace(mode, system_prompt):
+    """同一個模式 + 同一段 system prompt 才能共用回覆"""
+    return hashlib.sha1(f"{mode}\0{system_prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+class _Entry:
+    __slots__ = ("namespace", "exact_key", "shingles", "symbols", "signature", "response", "expires_at")
+
+    def __init__(self, namespace, exact_key, shingle_set, symbol_seq, signature, response, expires_at):
+        self.namespace = namespace
+        self.exact_key = exact_key
+        self.shingles = shingle_set
+        self.symbols = symbol_seq
+        self.signature = signature
+        self.response = response
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """GPT 回覆快取：完全相同的 prompt 直接命中，換句話說的用 MinHash/LSH 找近似的"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 threshold=RESPONSE_CACHE_THRESHOLD, modes=RESPONSE_CACHE_MODES, shingle_size=RESPONSE_CACHE_SHINGLE):
+        self.max_entries = max_entries
+        self.shingle_size = shingle_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.modes = set(modes)
+        self.hasher = MinHasher()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._entries = OrderedDict()   # entry_id → _Entry（LRU 順序）
+        self._exact = {}                # (namespace, fingerprint) → entry_id
+        self._bands = {}                # (namespace, band_key) → set(entry_id)
+        self._stats = {}                # mode → {"exact_hits", "near_hits", "misses", "stores", "evictions"}
+
+    def enabled(self, mode):
+        return mode in self.modes
+
+    def _mode_stats(self, mode):
+        return self._stats.setdefault(mode, {"exact_hits": 0, "near_hits": 0, "misses": 0, "stores": 0, "evictions": 0})
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        if self._exact.get((entry.namespace, entry.exact_key)) == entry_id:
+            del self._exact[(entry.namespace, entry.exact_key)]
+        if entry.signature is not None:
+            for band in self.hasher.band_keys(entry.signature):
+                bucket = self._bands.get((entry.namespace, band))
+                if bucket:
+                    bucket.discard(entry_id)
+                    if not bucket:
+                        del self._bands[(entry.namespace, band)]
+
+    # --- 查詢 ---
+    def lookup(self, mode, system_prompt, prompt):
+        if not self.enabled(mode):
+            return None
+        ns = _namespace(mode, system_prompt)
+        exact_key = fingerprint(prompt)
+        now = time.monotonic()
+        with self._lock:
+            stats = self._mode_stats(mode)
+            entry_id = self._exact.get((ns, exact_key))
+            if entry_id is not None:
+                entry = self._entries[entry_id]
+                if entry.expires_at > now:
+                    self._entries.move_to_end(entry_id)
+                    stats["exact_hits"] += 1
+                    return entry.response
+                self._remove(entry_id)
+
+            # 近似比對：LSH 分段挑候選，再用真正的 Jaccard 確認；數字和運算子不同的不算（a++ / a--、7/2 / 7%2）
+            sh = shingles(prompt, self.shingle_size)
+            symbol_seq = symbols(prompt)
+            if len(normalize(prompt)) >= RESPONSE_CACHE_MIN_LENGTH:
+                signature = self.hasher.signature(sh)
+                candidates = set()
+                for band in self.hasher.band_keys(signature):
+                    candidates |= self._bands.get((ns, band), set())
+                best_id, best_score = None, 0.0
+                for cid in candidates:
+                    entry = self._entries.get(cid)
+                    if entry is None or entry.expires_at <= now or entry.symbols != symbol_seq:
+                        continue
+                    score = jaccard(sh, entry.shingles)
+                    if score > best_score:
+                        best_id, best_score = cid, score
+                if best_id is not None and best_score >= self.threshold:
+                    self._entries.move_to_end(best_id)
+                    stats["near_hits"] += 1
+                    return self._entries[best_id].response
+
+            stats["misses"] += 1
+            return None
+
+    # --- 寫入 ---
+    def store(self, mode, system_prompt, prompt, response):
+        if not self.enabled(mode) or not response:
+            return
+        ns = _namespace(mode, system_prompt)
+        exact_key = fingerprint(prompt)
+        sh = shingles(prompt, self.shingle_size)
+        signature = self.hasher.signature(sh)
+        with self._lock:
+            old_id = self._exact.get((ns, exact_key))
+            if old_id is not None:
+                self._remove(old_id)
+            entry_id = next(self._ids)
+            self._entries[entry_id] = _Entry(ns, exact_key, sh, symbols(prompt), signature, response,
+                                             time.monotonic() + self.ttl)
+            self._exact[(ns, exact_key)] = entry_id
+            for band in self.hasher.band_keys(signature):
+                self._bands.setdefault((ns, band), set()).add(entry_id)
+            stats = self._mode_stats(mode)
+            stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = {mode: dict(s) for mode, s in self._stats.items()}
+            size = len(self._entries)
+        for s in snapshot.values():
+            hits = s["exact_hits"] + s["near_hits"]
+            s["hit_rate"] = hits / (hits + s["misses"]) if hits + s["misses"] else 0.0
+        return {"size": size, "modes": snapshot}
+
+
+# === 🌐 全域共用快取 ===
+cache = ResponseCache()
+
+
+def try_reply(event, user_id, mode, system_prompt, prompt, line_bot_api, save=True):
+    """快取命中就直接用 reply token 回覆（不用等待語 + push），回傳是否命中"""
+    cached = cache.lookup(mode, system_prompt, prompt)
+    if cached is None:
+        return False
+    print(f"⚡ 回覆快取命中（{mode}）")
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=cached))
+    reply_deadline.record(mode, "cached")
+    if save:
+        save_message(user_id, bot_response=cached, message_type="bot")
+    return True
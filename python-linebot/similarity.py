@@ -0,0 +1,76 @@
+import hashlib
+import random
+import re
+
+
+# === 🔍 文字正規化與近似比對（題庫去重、回覆快取共用） ===
+# C 的運算子和標點（+ - * / % & | ^ ! < > = ~ ? : ; ( ) [ ] { } , . 還有引號、#、底線）都要留著：
+# 「a++ 跟 ++a」和「a-- 跟 --a」、「7/2」和「7%2」是不同的問題。
+# 只拿掉空白、中文 / 全形標點（非 ASCII 的符號），以及接在空白或句尾的 ASCII 句讀（「是什麼?」的 ?）
+_SENTENCE_PUNCT = re.compile(r"[?!.,;:]+(?=\s|$)")
+_NORMALIZE = re.compile(r"\s+|[^\w\x00-\x7f]+", re.UNICODE)
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def normalize(text):
+    """轉小寫並拿掉空白與句讀，讓「指標是什麼？」和「指標 是什麼」視為相同（程式符號不動）"""
+    return _NORMALIZE.sub("", _SENTENCE_PUNCT.sub("", text.lower()))
+
+
+# 數字和 ASCII 符號：近似比對時這些要完全一樣才算同一題（7/2 和 7%2、8/2 只差一兩個字，Jaccard 分不出來）
+_SYMBOLS = re.compile(r"[0-9!-/:-@\[-`{-~]")
+
+
+def symbols(text):
+    """正規化之後的數字與符號序列"""
+    return "".join(_SYMBOLS.findall(normalize(text)))
+
+
+def fingerprint(text):
+    return hashlib.sha1(normalize(text).encode("utf-8")).hexdigest()
+
+
+def shingles(text, k=3):
+    norm = normalize(text)
+    if len(norm) <= k:
+        return {norm}
+    return {norm[i:i + k] for i in range(len(norm) - k + 1)}
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _shingle_hash(shingle):
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "big")
+
+
+class MinHasher:
+    """MinHash 簽章 + LSH 分段，用來快速找出近似重複的文字"""
+
+    def __init__(self, num_perm=64, bands=16, seed=42):
+        if num_perm % bands:
+            raise ValueError("num_perm 必須能被 bands 整除")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+
+    def signature(self, shingle_set):
+        hashes = [_shingle_hash(s) for s in shingle_set]
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._perms
+        )
+
+    def band_keys(self, signature):
+        return [(i, signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+    @staticmethod
+    def estimate(sig_a, sig_b):
+        return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
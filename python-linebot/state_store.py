@@ -0,0 +1,221 @@
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# === ⚙️ 設定 ===
+# memory://（預設，單一 process）或 sqlite:///path/to/state.db（多個 gunicorn worker 共用）
+STATE_STORE_URL = os.getenv("STATE_STORE_URL", "memory://")
+STATE_TTL = float(os.getenv("STATE_TTL", str(7 * 24 * 3600)))
+STATE_MAX_USERS = int(os.getenv("STATE_MAX_USERS", "10000"))
+STATE_LOCK_TIMEOUT = float(os.getenv("STATE_LOCK_TIMEOUT", "10"))
+STATE_LOCK_LEASE = float(os.getenv("STATE_LOCK_LEASE", "30"))  # 持有鎖的 process 掛掉時，多久後可被搶走
+
+
+class StateLockTimeout(Exception):
+    """等不到使用者狀態鎖"""
+
+
+class StateStore:
+    """使用者狀態存放介面：get / set / delete，以及 edit() 原子性的讀-改-寫"""
+
+    def get(self, user_id, default=None):
+        raise NotImplementedError
+
+    def set(self, user_id, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    def claim(self, user_id, value, ttl=None):
+        """還沒有值（或已過期）才寫入，回傳有沒有寫進去；不用鎖，本身就是原子的"""
+        raise NotImplementedError
+
+    @contextmanager
+    def edit(self, user_id):
+        """鎖住這位使用者 → 讀出 dict → 區塊內修改 → 離開時寫回（例外時不寫）"""
+        with self._user_lock(user_id):
+            original = self.get(user_id) or {}
+            state = copy.deepcopy(original)
+            yield state
+            if state != original:
+                if state:
+                    self.set(user_id, state)
+                else:
+                    self.delete(user_id)
+
+    def _user_lock(self, user_id):
+        raise NotImplementedError
+
+
+# === 🧠 記憶體版（LRU + TTL） ===
+class MemoryStateStore(StateStore):
+    def __init__(self, max_users=STATE_MAX_USERS, ttl=STATE_TTL, lock_stripes=64):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._data = OrderedDict()  # user_id → (value, expires_at)
+        self._lock = threading.Lock()
+        # 分段鎖：同一位使用者一定拿到同一把鎖，又不會因為使用者變多而無限長鎖表
+        self._stripes = [threading.RLock() for _ in range(lock_stripes)]
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[user_id]
+                return default
+            self._data.move_to_end(user_id)
+            return copy.deepcopy(value)
+
+    def set(self, user_id, value, ttl=None):
+        with self._lock:
+            self._put(user_id, value, ttl)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def claim(self, user_id, value, ttl=None):
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is not None and item[1] > time.monotonic():
+                return False
+            self._put(user_id, value, ttl)
+            return True
+
+    def _put(self, user_id, value, ttl):
+        """呼叫端要先拿著 self._lock"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[user_id] = (copy.deepcopy(value), expires_at)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_users:
+            self._data.popitem(last=False)
+
+    def _user_lock(self, user_id):
+        return self._stripes[hash(user_id) % len(self._stripes)]
+
+    def __len__(self):
+        return len(self._data)
+
+
+# === 🗄️ SQLite 版（WAL，多個 process 共用同一個檔案） ===
+class SQLiteStateStore(StateStore):
+    def __init__(self, path, namespace, ttl=STATE_TTL, lock_timeout=STATE_LOCK_TIMEOUT, lock_lease=STATE_LOCK_LEASE):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.lock_lease = lock_lease
+        self._local = threading.local()
+        self._local_locks = [threading.RLock() for _ in range(64)]  # 同一個 process 內先排隊，少打資料庫
+        self._writes = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_state ("
+            " namespace TEXT NOT NULL, user_id TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, user_id))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_lock ("
+            " namespace TEXT NOT NULL, user_id TEXT NOT NULL, owner TEXT NOT NULL, expires_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, user_id))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS user_state_expires ON user_state (expires_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None → autocommit，每個語句本身就是原子的
+            conn = sqlite3.connect(self.path, timeout=self.lock_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id, default=None):
+        row = self._conn().execute(
+            "SELECT value FROM user_state WHERE namespace = ? AND user_id = ? AND expires_at > ?",
+            (self.namespace, user_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, user_id, value, ttl=None):
+        self._conn().execute(
+            "INSERT INTO user_state (namespace, user_id, value, expires_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (namespace, user_id) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (self.namespace, user_id, json.dumps(value, ensure_ascii=False),
+             time.time() + (self.ttl if ttl is None else ttl))
+        )
+        self._count_write()
+
+    def delete(self, user_id):
+        self._conn().execute("DELETE FROM user_state WHERE namespace = ? AND user_id = ?", (self.namespace, user_id))
+
+    def claim(self, user_id, value, ttl=None):
+        # 等同 INSERT OR IGNORE，只是過期的那一列可以直接蓋掉（不用等 purge_expired）
+        now = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO user_state (namespace, user_id, value, expires_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (namespace, user_id) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at"
+            " WHERE user_state.expires_at <= ?",
+            (self.namespace, user_id, json.dumps(value, ensure_ascii=False),
+             now + (self.ttl if ttl is None else ttl), now)
+        )
+        self._count_write()
+        return cur.rowcount == 1
+
+    def _count_write(self):
+        self._writes += 1
+        if self._writes % 500 == 0:
+            self.purge_expired()
+
+    def purge_expired(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM user_state WHERE expires_at <= ?", (time.time(),))
+        conn.execute("DELETE FROM user_lock WHERE expires_at <= ?", (time.time(),))
+
+    @contextmanager
+    def _user_lock(self, user_id):
+        """跨 process 的單一使用者鎖：在 user_lock 表搶一列（過期的可以搶走），不會鎖住整個資料庫"""
+        with self._local_locks[hash(user_id) % len(self._local_locks)]:
+            owner = uuid.uuid4().hex
+            conn = self._conn()
+            give_up_at = time.monotonic() + self.lock_timeout
+            while True:
+                now = time.time()
+                cur = conn.execute(
+                    "INSERT INTO user_lock (namespace, user_id, owner, expires_at) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (namespace, user_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+                    " WHERE user_lock.expires_at <= ?",
+                    (self.namespace, user_id, owner, now + self.lock_lease, now)
+                )
+                if cur.rowcount == 1:
+                    break
+                if time.monotonic() >= give_up_at:
+                    raise StateLockTimeout(f"等不到使用者 {user_id} 的狀態鎖")
+                time.sleep(0.02)
+            try:
+                yield
+            finally:
+                conn.execute("DELETE FROM user_lock WHERE namespace = ? AND user_id = ? AND owner = ?",
+                             (self.namespace, user_id, owner))
+
+
+def make_store(namespace, url=STATE_STORE_URL, ttl=STATE_TTL, max_users=STATE_MAX_USERS):
+    """依 STATE_STORE_URL 建立對應的狀態存放；max_users 只有記憶體版用得到"""
+    if url.startswith("sqlite:///"):
+        return SQLiteStateStore(url[len("sqlite:///"):], namespace, ttl=ttl)
+    if url.startswith("memory://"):
+        return MemoryStateStore(max_users=max_users, ttl=ttl)
+    raise ValueError(f"不支援的 STATE_STORE_URL: {url}")
@@ -0,0 +1,91 @@
+import os
+import re
+import time
+
+from linebot.models import TextSendMessage
+
+import llm_gateway
+
+
+# === ⚙️ 設定 ===
+# 哪些模式的 GPT 回覆要用串流（逗號分隔的 context / 模式名稱）
+STREAMING_MODES = {m.strip() for m in os.getenv("GPT_STREAMING_MODES", "active,interactive").split(",") if m.strip()}
+STREAM_FIRST_CHUNK_MIN = int(os.getenv("STREAM_FIRST_CHUNK_MIN", "30"))     # 第一段至少累積幾個字才送
+STREAM_FIRST_CHUNK_MAX = int(os.getenv("STREAM_FIRST_CHUNK_MAX", "400"))    # 找不到斷點時最多等幾個字
+LINE_MAX_MESSAGES_PER_PUSH = 5
+LINE_MAX_TEXT_LENGTH = 5000
+
+# 段落 > 句子的斷點（中英文標點都算）
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_BREAK = re.compile(r"[。！？!?]\s*|\.\s+|\n")
+
+
+def streaming_enabled(mode):
+    return mode in STREAMING_MODES
+
+
+def find_cut(text, min_len=STREAM_FIRST_CHUNK_MIN):
+    """回傳可以切開的位置（段落優先，其次句子）；還不能切就回傳 None"""
+    for pattern in (_PARAGRAPH_BREAK, _SENTENCE_BREAK):
+        for match in pattern.finditer(text):
+            # 不要切在 ``` 程式碼區塊中間
+            if match.end() >= min_len and text.count("```", 0, match.end()) % 2 == 0:
+                return match.end()
+    return None
+
+
+def forced_cut(text):
+    """找不到斷點又已經等太久時的切點：直接切在目前長度，
+    但在 ``` 程式碼區塊裡的話退到區塊開頭；區塊前面沒有內容就回傳 None（繼續等）"""
+    if text.count("```") % 2 == 0:
+        return len(text)
+    fence = text.rfind("```")
+    return fence if text[:fence].strip() else None
+
+
+def pack_messages(text, max_messages=LINE_MAX_MESSAGES_PER_PUSH, max_length=LINE_MAX_TEXT_LENGTH):
+    """把文字依段落切好，再盡量合併成最少則訊息；回傳每次 push 的訊息清單"""
+    paragraphs = [p.strip() for p in _PARAGRAPH_BREAK.split(text) if p.strip()]
+    if not paragraphs:
+        return []
+
+    # 段落盡量合併成同一則，超過單則上限才拆開
+    messages = []
+    for para in paragraphs:
+        while len(para) > max_length:
+            messages.append(para[:max_length])
+            para = para[max_length:]
+        if messages and len(messages[-1]) + 2 + len(para) <= max_length:
+            messages[-1] = f"{messages[-1]}\n\n{para}"
+        else:
+            messages.append(para)
+
+    return [messages[i:i + max_messages] for i in range(0, len(messages), max_messages)]
+
+
+def stream_reply(line_bot_api, user_id, messages, context="general", **kwargs):
+    """串流 GPT 回覆：第一段準備好就先推，剩下的合併成盡量少次 push；回傳完整文字"""
+    start = time.monotonic()
+    buffer = ""
+    first_sent = False
+    full_text = ""
+
+    for delta in llm_gateway.stream_chat(messages, context=context, **kwargs):
+        full_text += delta
+        buffer += delta
+        if first_sent:
+            continue
+        cut = find_cut(buffer)
+        if cut is None and len(buffer) >= STREAM_FIRST_CHUNK_MAX:
+            cut = forced_cut(buffer)
+        if cut is not None and buffer[:cut].strip():
+            line_bot_api.push_message(user_id, TextSendMessage(text=buffer[:cut].strip()))
+            print(f"⚡ 第一段回覆已送出（{time.monotonic() - start:.2f}s）")
+            buffer = buffer[cut:]
+            first_sent = True
+
+    # 剩下的內容（或整段太短、一直沒切開的情況）
+    for batch in pack_messages(buffer):
+        line_bot_api.push_message(user_id, [TextSendMessage(text=t) for t in batch])
+    print(f"✅ 串流回覆完成（{time.monotonic() - start:.2f}s，{len(full_text)} 字）")
+    return full_text.strip()
@@ -0,0 +1,36 @@
+from response_cache import ResponseCache
+from similarity import fingerprint
+
+
+def make_cache():
+    return ResponseCache(modes={"passive"})
+
+
+def test_operators_are_part_of_the_key():
+    assert fingerprint("a++ 跟 ++a 有什麼差別") != fingerprint("a-- 跟 --a 有什麼差別")
+    assert fingerprint('printf("%d", 7/2)') != fingerprint('printf("%d", 7%2)')
+
+
+def test_sentence_punctuation_and_spaces_still_ignored():
+    assert fingerprint("指標是什麼？") == fingerprint("指標 是什麼")
+    assert fingerprint("What is a pointer?") == fingerprint("what is a pointer")
+
+
+def test_increment_and_decrement_do_not_share_an_answer():
+    cache = make_cache()
+    cache.store("passive", "sys", "a++ 跟 ++a 有什麼差別", "前置 / 後置遞增")
+    assert cache.lookup("passive", "sys", "a-- 跟 --a 有什麼差別") is None
+    assert cache.lookup("passive", "sys", "a++ 跟 ++a 有什麼差別") == "前置 / 後置遞增"
+
+
+def test_division_and_modulo_do_not_share_an_answer():
+    cache = make_cache()
+    cache.store("passive", "sys", 'printf("%d", 7/2)', "3")
+    assert cache.lookup("passive", "sys", 'printf("%d", 7%2)') is None
+    assert cache.lookup("passive", "sys", 'printf("%d", 7/2)') == "3"
+
+
+def test_paraphrase_still_near_hits():
+    cache = make_cache()
+    cache.store("passive", "sys", "請問 C 語言的指標是什麼", "指標存的是位址")
+    assert cache.lookup("passive", "sys", "C 語言的指標是什麼？") == "指標存的是位址"
@@ -0,0 +1,147 @@
+import atexit
+import os
+import threading
+import time
+import uuid
+
+import requests
+
+import node_health
+import persistence
+from persistence import NODE_SERVER_URL
+
+
+# === ⚙️ 設定 ===
+USER_STATS_FLUSH_INTERVAL = float(os.getenv("USER_STATS_FLUSH_INTERVAL", "10"))
+USER_STATS_BULK_CHUNK = int(os.getenv("USER_STATS_BULK_CHUNK", "1000"))    # 一次 POST 最多幾位使用者
+USER_STATS_MAX_USERS = int(os.getenv("USER_STATS_MAX_USERS", "100000"))   # Node 長時間掛掉時的上限
+
+
+class UserStatsAggregator:
+    """用戶統計的累加器：每則互動只在記憶體裡 +1，定時用 /update_user_stats_bulk 一次送出
+
+    Node 端對每位使用者做一筆 $inc（bulkWrite）。每一批都帶 batch_id：送失敗（包括 Node 其實寫進去了、
+    只是回應逾時）的那一批原封不動、用同一個 batch_id 重送，Node 端記得每位使用者最近套用過的 batch_id，
+    重複的會略過，所以不會遺失也不會重複計算。還沒送出的批次則併回去，下次換新的 batch_id。
+    """
+
+    def __init__(self, base_url=NODE_SERVER_URL, flush_interval=USER_STATS_FLUSH_INTERVAL,
+                 chunk_size=USER_STATS_BULK_CHUNK, max_users=USER_STATS_MAX_USERS, session=None):
+        self.base_url = base_url
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.max_users = max_users
+        self.session = session or persistence.client.session
+        self._pending = {}  # user_id → {欄位: 增量}
+        self._retry = []    # [(batch_id, [(user_id, 增量)])]：送了但不知道有沒有寫進去的批次
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stats = {"recorded": 0, "flushed_users": 0, "requests": 0, "failed_requests": 0, "dropped_users": 0,
+                       "skipped_flushes": 0}
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="user-stats-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    # --- 累加 ---
+    def add(self, user_id, **deltas):
+        """例如 add(uid, interaction_rounds=1, constructive_count=1)；欄位名稱照 Node 端的 UserStats"""
+        if not user_id:
+            return
+        self._ensure_started()
+        with self._lock:
+            entry = self._pending.get(user_id)
+            if entry is None:
+                if len(self._pending) >= self.max_users:
+                    self._stats["dropped_users"] += 1
+                    return
+                entry = self._pending[user_id] = {}
+            for field, value in deltas.items():
+                if value:
+                    entry[field] = entry.get(field, 0) + value
+            self._stats["recorded"] += 1
+
+    def record_interaction(self, user_id, constructive):
+        self.add(user_id, interaction_rounds=1, constructive_count=1 if constructive else 0)
+
+    def record_mode(self, user_id, mode):
+        self.add(user_id, **{f"mode_rounds.{mode}": 1})
+
+    # --- 送出 ---
+    def _merge_back(self, pending):
+        with self._lock:
+            for user_id, inc in pending.items():
+                entry = self._pending.setdefault(user_id, {})
+                for field, value in inc.items():
+                    entry[field] = entry.get(field, 0) + value
+
+    def flush(self):
+        """把累積的增量送到 Node；回傳送出的使用者數，失敗回傳 False（沒送成功的下次再送）"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending and not self._retry:
+                return 0
+            if not node_health.monitor.available():
+                # Node 斷路器開著：增量留在記憶體繼續累加，不要每次都卡 10 秒逾時
+                self._merge_back(pending)
+                with self._lock:
+                    self._stats["skipped_flushes"] += 1
+                return False
+            items = list(pending.items())
+            # 上次失敗的批次先重送（同一個 batch_id），再送新的
+            batches = self._retry + [(uuid.uuid4().hex, items[i:i + self.chunk_size])
+                                     for i in range(0, len(items), self.chunk_size)]
+            self._retry = []
+            sent = 0
+            for n, (batch_id, chunk) in enumerate(batches):
+                try:
+                    response = self.session.post(f"{self.base_url}/update_user_stats_bulk", json={
+                        "batch_id": batch_id,
+                        "updates": [{"user_id": user_id, "inc": inc} for user_id, inc in chunk]
+                    }, timeout=10)
+                    response.raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    print(f"❌ 批次更新用戶統計失敗（{sum(len(c) for _, c in batches[n:])} 位）: {e}")
+                    node_health.monitor.record_failure()
+                    # 這一批可能已經寫進去了，留著原本的 batch_id 重送；後面還沒送的併回去
+                    self._retry = batches[n:n + 1]
+                    self._merge_back({user_id: inc for _, rest in batches[n + 1:] for user_id, inc in rest})
+                    with self._lock:
+                        self._stats["failed_requests"] += 1
+                    return False
+                sent += len(chunk)
+                with self._lock:
+                    self._stats["requests"] += 1
+                    self._stats["flushed_users"] += len(chunk)
+            return sent
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["pending_users"] = len(self._pending)
+            snapshot["retry_batches"] = len(self._retry)
+        return snapshot
+
+
+# === 🌐 全域共用累加器 ===
+aggregator = UserStatsAggregator()
+atexit.register(aggregator.flush)
+
+
+def record_interaction(user_id, constructive):
+    aggregator.record_interaction(user_id, constructive)
+
+
+def record_mode(user_id, mode):
+    aggregator.record_mode(user_id, mode)
@@ -0,0 +1,205 @@
+import os
+import queue
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from linebot.models import TextSendMessage
+
+import metrics
+
+
+# === ⚙️ 設定（可用環境變數調整） ===
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", "16"))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "200"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+# 佇列滿時的處理方式："reject"（立即拒絕）、"block"（等待一段時間再拒絕）、"caller_runs"（由呼叫端同步執行）
+WORKER_OVERFLOW_POLICY = os.getenv("WORKER_OVERFLOW_POLICY", "reject")
+WORKER_BLOCK_TIMEOUT = float(os.getenv("WORKER_BLOCK_TIMEOUT", "2"))
+
+OVERFLOW_POLICIES = ("reject", "block", "caller_runs")
+
+
+def _job_name(fn):
+    return f"job:{getattr(fn, '__module__', '?')}.{getattr(fn, '__qualname__', type(fn).__name__)}"
+
+
+class WorkerPool:
+    """固定大小的背景工作池：有上限的佇列 + LLM 併發上限 + 佇列統計"""
+
+    def __init__(self, size=WORKER_POOL_SIZE, queue_size=WORKER_QUEUE_SIZE,
+                 llm_concurrency=LLM_CONCURRENCY, overflow_policy=WORKER_OVERFLOW_POLICY,
+                 block_timeout=WORKER_BLOCK_TIMEOUT, name="worker"):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"未知的 overflow policy: {overflow_policy}")
+        self.size = size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.name = name
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._llm_slots = threading.BoundedSemaphore(llm_concurrency)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._started = False
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "caller_ran": 0,
+            "inline_ran": 0,
+            "running": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "llm_in_flight": 0,
+            "llm_wait_time_total": 0.0,
+        }
+
+    # --- 啟動（第一次 submit 時才開執行緒，避免 import 時就佔資源） ---
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            for i in range(self.size):
+                t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._started = True
+
+    def _run(self):
+        while True:
+            enqueued_at, mode, fn, args, kwargs = self._queue.get()
+            waited = time.monotonic() - enqueued_at
+            with self._lock:
+                self._stats["wait_time_total"] += waited
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+                self._stats["running"] += 1
+            metrics.job_wait_seconds.observe(waited, mode=mode)
+            try:
+                # 沿用送出工作那個請求的 mode，背景裡的 GPT / push 才標得到是哪個模式
+                with metrics.mode_context(mode), metrics.stage(_job_name(fn)):
+                    fn(*args, **kwargs)
+                ok = True
+            except Exception as e:
+                ok = False
+                traceback.print_exc()
+                print(f"❌ 背景工作失敗 ({type(e).__name__}): {e}")
+            finally:
+                with self._lock:
+                    self._stats["running"] -= 1
+                    self._stats["completed" if ok else "failed"] += 1
+                self._queue.task_done()
+
+    # --- 送出工作 ---
+    def _run_inline(self, fn, args, kwargs):
+        with self._lock:
+            self._stats["inline_ran"] += 1
+        try:
+            with metrics.stage(_job_name(fn)):
+                fn(*args, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"❌ 背景工作失敗 ({type(e).__name__}): {e}")
+
+    def submit(self, fn, *args, on_reject=None, background=False, **kwargs):
+        """把工作丟進佇列；成功回傳 True，被拒絕時呼叫 on_reject() 並回傳 False
+
+        background=True 的工作（補題庫、摘要）跟這則回覆無關，inline_jobs() 裡也照樣進佇列。
+        """
+        if not background and getattr(_inline, "active", False):
+            self._run_inline(fn, args, kwargs)
+            return True
+        self._ensure_started()
+        item = (time.monotonic(), metrics.current_mode(), fn, args, kwargs)
+        try:
+            if self.overflow_policy == "block":
+                self._queue.put(item, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow_policy == "caller_runs":
+                with self._lock:
+                    self._stats["caller_ran"] += 1
+                print(f"⚠️ 工作佇列已滿（{self._queue.qsize()}），改由呼叫端直接執行")
+                fn(*args, **kwargs)
+                return True
+            with self._lock:
+                self._stats["rejected"] += 1
+            print(f"⚠️ 工作佇列已滿（{self._queue.qsize()}），拒絕新工作")
+            if on_reject:
+                try:
+                    on_reject()
+                except Exception as e:
+                    print(f"❌ on_reject 執行失敗: {e}")
+            return False
+
+        with self._lock:
+            self._stats["submitted"] += 1
+        return True
+
+    # --- LLM 併發上限 ---
+    @contextmanager
+    def llm_slot(self):
+        """限制同時進行中的 GPT 呼叫數量"""
+        start = time.monotonic()
+        self._llm_slots.acquire()
+        with self._lock:
+            self._stats["llm_wait_time_total"] += time.monotonic() - start
+            self._stats["llm_in_flight"] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._stats["llm_in_flight"] -= 1
+            self._llm_slots.release()
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["queue_depth"] = self._queue.qsize()
+        snapshot["queue_capacity"] = self._queue.maxsize
+        snapshot["workers"] = self.size
+        dequeued = snapshot["completed"] + snapshot["failed"] + snapshot["running"]
+        snapshot["wait_time_avg"] = snapshot["wait_time_total"] / dequeued if dequeued else 0.0
+        return snapshot
+
+    def join(self):
+        """等待佇列中的工作全部完成（測試或關機時使用）"""
+        self._queue.join()
+
+
+# === 🌐 全域共用的工作池 ===
+pool = WorkerPool()
+_inline = threading.local()
+
+
+@contextmanager
+def inline_jobs():
+    """區塊內 submit 的工作直接在目前的執行緒跑完（keyed_executor 用：同一位使用者要等上一則回完）
+
+    只管回覆用的工作；background=True 送出的還是進共用工作池排隊。
+    """
+    previous = getattr(_inline, "active", False)
+    _inline.active = True
+    try:
+        yield
+    finally:
+        _inline.active = previous
+
+
+def submit(fn, *args, on_reject=None, background=False, **kwargs):
+    return pool.submit(fn, *args, on_reject=on_reject, background=background, **kwargs)
+
+
+def llm_slot():
+    return pool.llm_slot()
+
+
+def busy_notice(line_bot_api, user_id, text="現在問問題的人有點多 🥲 等一下再問我一次好嗎？"):
+    """佇列滿時用的拒絕回呼：推播一則忙碌提示給使用者"""
+    def _notify():
+        line_bot_api.push_message(user_id, TextSendMessage(text=text))
+    return _notify
+